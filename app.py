@@ -1,28 +1,35 @@
 #!/usr/bin/env python3
+import time
+_STARTUP_T0 = time.perf_counter()
+
 import os
-import glob
 import argparse
 import shutil
 import warnings
 import json
+import functools
+import contextlib
 from pathlib import Path
 from datetime import datetime
 
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-
-import spikeinterface as si
-import spikeinterface.extractors as se
-import spikeinterface.preprocessing as sp
-import spikeinterface.widgets as sw
-import spikeinterface.sorters as ss
-from spikeinterface.exporters import export_to_phy
-from probeinterface import get_probe, read_prb
+# spikeinterface, matplotlib, probeinterface and the sorters are imported inside the
+# functions that use them, so runs that find nothing to process start quickly.
+from scheduler import run_concurrent_batch, split_budget, estimate_scratch_bytes, parse_memory_size
+from pipeline import run_pipeline
+from metrics import stage_timer, write_metrics, summarize_batch
+from storage import preprocessed_folder_name
+from manifest import RecordingManifest, FINAL_STATUSES
+from work_queue import WorkQueue, LeaseKeeper
+from curation import parse_thresholds, QC_PROPERTIES
+from windowed import WHITENING_CHUNKS
+from stage_cache import (fingerprint_file, stage_key, read_marker, is_stage_cached, commit_stage,
+                         invalidate_stage, pin_stage, mark_in_progress, clear_in_progress, evict_lru)
 
 import signal
 import sys
 
+_IMPORT_SECONDS = time.perf_counter() - _STARTUP_T0
+
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 def handle_sigint(signum, frame):
@@ -31,10 +38,12 @@ def handle_sigint(signum, frame):
 
 signal.signal(signal.SIGINT, handle_sigint)
 
+@functools.lru_cache(maxsize=None)
 def is_gpu_available():
     """
     Check if a GPU is available.
-    Attempts to import cupy and torch to query GPU availability.
+    Attempts to import cupy and torch to query GPU availability. The result is cached,
+    so the device is only probed once per process.
     """
     try:
         import cupy
@@ -50,139 +59,878 @@ def is_gpu_available():
         pass
     return False
 
-def process_recording(recording_file, output_folder, probe_object, sort_params,
-                      stream_id, freq_min, freq_max, whiten_dtype, force_cpu,
-                      ms_before, ms_after, n_jobs, total_memory,
-                      compute_pc_features, compute_amplitudes,
-                      random_spikes_max, pc_n_components, pc_mode, spike_amp_peak_sign):
+def preload_stage_modules():
     """
-    Process a single recording file using supplied parameters.
-    Each recording's outputs will be stored in a subfolder under the user-specified
-    output folder (structure: <output_folder>/proc/<recording_basename>/).
+    Import the heavy dependencies of the processing stages up front, so worker processes
+    forked afterwards inherit them instead of each paying the import cost.
+    Returns the import time in seconds.
+    """
+    start = time.perf_counter()
+    import matplotlib.pyplot
+    import spikeinterface.preprocessing
+    import spikeinterface.sorters
+    import spikeinterface.exporters
+    import rec_reader
+    return time.perf_counter() - start
+
+def make_recording_job(recording_file, output_folder, **params):
+    """
+    Collect the output paths and parameters for one recording into a job dict.
+    Outputs are stored under <output_folder>/proc/<recording_basename>/. The job is
+    handed from stage to stage (and between processes in pipelined mode).
     """
     recording_basename = os.path.basename(recording_file)
     output_base = Path(output_folder) / "proc" / recording_basename
+    return {
+        "recording_file": recording_file,
+        "recording_basename": recording_basename,
+        "output_base": output_base,
+        "complete_marker": output_base / "complete.txt",
+        "phy_output_directory": output_base / "phy",
+        "ss_output_dir": output_base / "ss_output",
+        "preproc_rec_dir": output_base / preprocessed_folder_name(params.get("preproc_format", "binary")),
+        "waveform_output_dir": output_base / "waveforms",
+        "curation_dir": output_base / "curation",
+        "waveform_cache_dir": output_base / "waveform_cache",
+        "metrics_path": output_base / "metrics.json",
+        "spike_store_dir": Path(output_folder) / "spike_store",
+        "params": params,
+    }
 
-    # Define the completion marker file
-    complete_marker = output_base / "complete.txt"
+def compute_stage_keys(job):
+    """
+    Compute the cache key of every stage for this recording.
+    Each key covers the stage's own parameters and the keys of its upstream stages,
+    starting from a content fingerprint of the raw .rec file.
+    """
+    params = job["params"]
+    keys = {}
+    # Frequencies are hashed as floats, so 300 and 300.0 (argparse leaves defaults as
+    # given) from app.py, sweep.py or benchmark.py share one preprocessed recording.
+    preprocessing_params = {
+        "stream_id": params["stream_id"],
+        "freq_min": float(params["freq_min"]),
+        "freq_max": float(params["freq_max"]),
+        "whiten_dtype": params["whiten_dtype"],
+        "probe": params["probe_object"].to_dict(),
+    }
+    # Only added when set, so caches built with the default settings stay valid.
+    if params.get("split_by_group"):
+        preprocessing_params["split_by_group"] = True
+    if params.get("quantize"):
+        preprocessing_params["quantize"] = "global_gain"
+    if params.get("preproc_format", "binary") != "binary":
+        preprocessing_params["preproc_format"] = params["preproc_format"]
+        preprocessing_params["zarr_compression_level"] = params["zarr_compression_level"]
+    if params.get("window_duration"):
+        # Windowed runs whiten with a cached matrix from more, seeded chunks.
+        preprocessing_params["whitening"] = {"chunks": WHITENING_CHUNKS, "seed": 0}
+    fingerprint = job.get("fingerprint") or fingerprint_file(job["recording_file"])
+    keys["preprocessing"] = stage_key("preprocessing", preprocessing_params, [fingerprint])
+    sorting_params = {
+        "sorter": "kilosort4",
+        "sort_params": params["sort_params"],
+    }
+    if params.get("window_duration"):
+        keys["sorting_windows"] = stage_key("sorting_windows", {
+            "sort_params": params["sort_params"],
+            "duration": params["window_duration"],
+            "overlap": params["window_overlap"],
+        }, [keys["preprocessing"]])
+        sorting_params["windows"] = keys["sorting_windows"]
+    keys["sorting"] = stage_key("sorting", sorting_params, [keys["preprocessing"]])
+    analyzer_upstream = [keys["preprocessing"], keys["sorting"]]
+    if params.get("curation", "off") != "off":
+        keys["curation"] = stage_key("curation", {
+            "mode": params["curation"],
+            "thresholds": params["curation_thresholds"],
+            "peak_sign": params["spike_amp_peak_sign"],
+        }, [keys["preprocessing"], keys["sorting"]])
+        analyzer_upstream.append(keys["curation"])
+    keys["analyzer"] = stage_key("analyzer", {
+        "format": "sorting_analyzer",
+    }, analyzer_upstream)
+    waveforms_params = {
+        "ms_before": params["ms_before"],
+        "ms_after": params["ms_after"],
+        "random_spikes_max": params["random_spikes_max"],
+    }
+    if params.get("random_spikes_policy", "uniform") != "uniform":
+        waveforms_params["random_spikes_policy"] = params["random_spikes_policy"]
+    keys["waveforms"] = stage_key("waveforms", waveforms_params, [keys["analyzer"]])
+    keys["principal_components"] = stage_key("principal_components", {
+        "n_components": params["pc_n_components"],
+        "mode": params["pc_mode"],
+    }, [keys["waveforms"]])
+    keys["spike_amplitudes"] = stage_key("spike_amplitudes", {
+        "peak_sign": params["spike_amp_peak_sign"],
+    }, [keys["waveforms"]])
+    keys["phy"] = stage_key("phy", {
+        "compute_pc_features": params["compute_pc_features"],
+        "compute_amplitudes": params["compute_amplitudes"],
+        "phy_binary": params["phy_binary"],
+    }, [keys["principal_components"], keys["spike_amplitudes"]])
+    return keys
 
-    # Check for existing final output: if the 'phy' folder or completion marker exists, skip processing.
-    phy_output_directory = output_base / "phy"
-    if phy_output_directory.exists() or complete_marker.exists():
-        print(f"Skipping {recording_basename}: output already exists or processing is complete.")
-        return
+def recording_skip_reason(job):
+    """
+    Return why a recording does not need processing, or None if it does.
+    Only reads stage markers and fingerprints the .rec file, so it is cheap.
+    """
+    job["stage_keys"] = compute_stage_keys(job)
+    phy_marker = read_marker(job["phy_output_directory"], "phy")
+    if phy_marker is not None and phy_marker.get("key") == job["stage_keys"]["phy"]:
+        return "outputs are up to date with the requested parameters"
+    # Outputs from before the stage cache have no markers: keep skipping them as before.
+    legacy_output = read_marker(job["preproc_rec_dir"], "preprocessing") is None and phy_marker is None
+    if legacy_output and (job["phy_output_directory"].exists() or job["complete_marker"].exists()):
+        return "output already exists or processing is complete"
+    return None
+
+def prepare_recording_job(job):
+    """
+    Check whether a recording still needs processing and set up its output folder.
+    Returns False if the recording should be skipped.
+    """
+    recording_basename = job["recording_basename"]
+    reason = recording_skip_reason(job)
+    if reason is not None:
+        print(f"Skipping {recording_basename}: {reason}.")
+        return False
+
+    work_queue = job["params"].get("work_queue")
+    if work_queue is not None:
+        if not work_queue.claim(job["recording_file"]):
+            print(f"Skipping {recording_basename}: claimed by another worker.")
+            job["claimed_elsewhere"] = True
+            return False
+        # Another worker may have finished it between the check above and the claim.
+        reason = recording_skip_reason(job)
+        if reason is not None:
+            work_queue.release(job["recording_file"])
+            print(f"Skipping {recording_basename}: {reason}.")
+            return False
+
+    print(f"\nProcessing recording: {job['recording_file']}")
+    os.makedirs(job["output_base"], exist_ok=True)
+    mark_in_progress(job["output_base"])
+    return True
 
-    print(f"\nProcessing recording: {recording_file}")
-    os.makedirs(output_base, exist_ok=True)
-    
-    # Define directories for sorter output, preprocessed recording, and waveforms.
-    ss_output_dir = output_base / "ss_output"
-    preproc_rec_dir = output_base / "preprocessed_recording_output"
-    waveform_output_dir = output_base / "waveforms"
-    
-    # Remove the existing sorter output folder if it exists.
-    if ss_output_dir.exists():
-        print(f"Removing existing sorter output folder: {ss_output_dir}")
-        shutil.rmtree(str(ss_output_dir))
+def release_recording_job(job):
+    """
+    Clear the in-progress marker and give up the work queue lease, if any.
+    """
+    clear_in_progress(job["output_base"])
+    work_queue = job["params"].get("work_queue")
+    if work_queue is not None:
+        work_queue.release(job["recording_file"])
 
+@contextlib.contextmanager
+def job_stage(job, stage, device="cpu"):
+    """
+    Instrument one stage of a job; its metrics record is appended to job["metrics"].
+    An on_stage(stage, record) callback in the job parameters is called when the stage
+    starts (with record None) and when it ends.
+    """
+    params = job["params"]
+    on_stage = params.get("on_stage")
+    if on_stage is not None:
+        on_stage(stage, None)
+    record = None
     try:
+        with stage_timer(job.setdefault("metrics", []), stage, device=device,
+                         profile=params.get("profile_stages"), profile_dir=job["output_base"] / "profiles") as record:
+            yield record
+    finally:
+        if on_stage is not None:
+            on_stage(stage, record)
+
+def run_preprocessing_stage(job):
+    """
+    Load the recording, attach the probe, then bandpass filter and whiten it.
+    The filter+whiten chain is streamed over the raw file exactly once and written to
+    preproc_rec_dir. The sorter, the waveform stage and the Phy export all read that
+    memory-mapped binary instead of re-evaluating the lazy chain.
+    """
+    import spikeinterface as si
+    import spikeinterface.preprocessing as sp
+    from rec_reader import read_rec
+    from storage import save_preprocessed
+    from quantize import quantize_recording, quantization_error
+    from windowed import cached_whitening
+
+    params = job["params"]
+    probe_object = params["probe_object"]
+    preproc_rec_dir = job["preproc_rec_dir"]
+    key = job["stage_keys"]["preprocessing"]
+
+    with job_stage(job, "preprocessing") as record:
+        if is_stage_cached(preproc_rec_dir, "preprocessing", key):
+            print("Reusing cached preprocessed recording:", preproc_rec_dir)
+            job["recording_preprocessed"] = si.load_extractor(preproc_rec_dir)
+            record["cached"] = True
+            return job
+        invalidate_stage(preproc_rec_dir)
+
         # Load recording and attach probe using set_probe.
-        recording_obj = se.read_spikegadgets(recording_file, stream_id=stream_id)
+        recording_obj = read_rec(job["recording_file"], stream_id=params["stream_id"], reader=params["rec_reader"])
         recording_obj = recording_obj.set_probes(probe_object)
 
+        def whiten(recording, name):
+            if not params.get("window_duration"):
+                return sp.whiten(recording, dtype=params["whiten_dtype"])
+            # One matrix for the whole session, so all sorting windows see the same traces.
+            W = cached_whitening(recording, job["output_base"] / "whitening.npz", name=f"{key[:16]}_{name}")
+            return sp.whiten(recording, dtype=params["whiten_dtype"], W=W, M=None)
+
         # Preprocessing: bandpass filtering then whitening.
-        recording_filtered = sp.bandpass_filter(recording_obj, freq_min=freq_min, freq_max=freq_max)
-        recording_preprocessed = sp.whiten(recording_filtered, dtype=whiten_dtype)
+        recording_filtered = sp.bandpass_filter(recording_obj, freq_min=params["freq_min"], freq_max=params["freq_max"])
+        if params.get("split_by_group"):
+            # Channel groups are sorted independently, so each group is whitened on its own.
+            # The groups are then put back in the original channel order in one recording.
+            groups = recording_filtered.split_by("group")
+            recording_preprocessed = si.aggregate_channels(
+                [whiten(group_recording, group) for group, group_recording in groups.items()]
+            ).select_channels(recording_filtered.get_channel_ids())
+        else:
+            recording_preprocessed = whiten(recording_filtered, "all")
         # Re-attach the probe after processing.
         recording_preprocessed = recording_preprocessed.set_probes(probe_object)
 
+        if params["quantize"]:
+            # Store int16 with one gain for all channels; scaled reads give the float values back.
+            recording_float = recording_preprocessed
+            recording_preprocessed = quantize_recording(recording_float)
+            record["quantization"] = quantization_error(recording_float, recording_preprocessed)
+            print("Quantized preprocessed traces to int16 (RMS error %.2e of the channel std, %.1e clipped)." % (
+                record["quantization"]["rms_error_rel_std_mean"], record["quantization"]["clipped_fraction"]))
+
+        print("Saving preprocessed recording to disk...")
+        job["recording_preprocessed"], record["storage"] = save_preprocessed(
+            recording_preprocessed, preproc_rec_dir,
+            preproc_format=params["preproc_format"], compression_level=params["zarr_compression_level"],
+            n_jobs=params["n_jobs"], total_memory=params["total_memory"]
+        )
+        commit_stage(preproc_rec_dir, "preprocessing", key)
+        print("Preprocessed recording saved to:", preproc_rec_dir)
+    return job
+
+def run_sorting_stage(job):
+    """
+    Run Kilosort4 on the preprocessed recording and save the sorting to disk.
+    """
+    import numpy as np
+    import spikeinterface as si
+    import spikeinterface.sorters as ss
+
+    params = job["params"]
+    ss_output_dir = job["ss_output_dir"]
+    sorting_dir = ss_output_dir / "sorting"
+    key = job["stage_keys"]["sorting"]
+    torch_device = "cpu" if params["force_cpu"] or not is_gpu_available() else "cuda"
+
+    with job_stage(job, "sorting", device=torch_device) as record:
+        if is_stage_cached(ss_output_dir, "sorting", key):
+            print("Reusing cached sorting:", ss_output_dir)
+            job["sorting"] = si.load_extractor(sorting_dir)
+            record["cached"] = True
+            return job
+        # Remove the existing (stale or interrupted) sorter output folder if it exists.
+        invalidate_stage(ss_output_dir)
+
         # Prepare sorter parameters.
         default_sort_params = {
-            "torch_device": "cuda" if is_gpu_available() and not force_cpu else "cpu"
+            "torch_device": torch_device
         }
-        default_sort_params.update(sort_params)
-
-        print("Running sorting with Kilosort4 via unified interface...")
-        spike_sorted = ss.run_sorter(
-            'kilosort4',
-            recording=recording_preprocessed,
-            folder=str(ss_output_dir),
-            **default_sort_params
-        )
+        if not job["recording_preprocessed"].binary_compatible_with(time_axis=0, file_paths_length=1):
+            # Let Kilosort4 read a compressed recording lazily instead of writing a binary copy of it.
+            default_sort_params["use_binary_file"] = False
+        default_sort_params.update(params["sort_params"])
+        record["device"] = default_sort_params["torch_device"]
+        if params["force_cpu"]:
+            print("Forcing CPU for sorting.")
+        elif torch_device == "cuda":
+            print("GPU is available. Using GPU for sorting.")
+        else:
+            print("GPU not available. Using CPU for sorting.")
+
+        # The preprocessed recording is a saved binary, so Kilosort4 reads it in place
+        # instead of writing its own recording.dat copy.
+        recording_preprocessed = job["recording_preprocessed"]
+        num_groups = len(np.unique(recording_preprocessed.get_channel_groups()))
+        windowed = (params.get("window_duration") and recording_preprocessed.get_num_segments() == 1
+                    and recording_preprocessed.get_total_duration() > params["window_duration"] + params["window_overlap"])
+        if params.get("split_by_group") and num_groups > 1:
+            if windowed:
+                print("Channel groups are sorted over the whole recording; --window-duration is not applied.")
+            # Every channel group is sorted as an independent job; the unit sortings are
+            # aggregated into one sorting with a "group" unit property.
+            group_workers = min(num_groups, params.get("group_workers") or params["n_jobs"])
+            print(f"Running Kilosort4 on {num_groups} channel groups ({group_workers} in parallel)...")
+            spike_sorted = ss.run_sorter_by_property(
+                'kilosort4',
+                recording=recording_preprocessed,
+                grouping_property="group",
+                folder=str(ss_output_dir),
+                engine="joblib" if group_workers > 1 else "loop",
+                engine_kwargs={"n_jobs": group_workers},
+                **default_sort_params
+            )
+        elif windowed:
+            from windowed import run_windowed_sorter
+            print(f"Running Kilosort4 in {params['window_duration']:g} s windows "
+                  f"({params['window_overlap']:g} s overlap)...")
+            spike_sorted, record["windows"] = run_windowed_sorter(
+                recording_preprocessed, job["output_base"] / "sorting_windows", job["stage_keys"]["sorting_windows"],
+                default_sort_params, params["window_duration"], params["window_overlap"])
+        else:
+            print("Running sorting with Kilosort4 via unified interface...")
+            spike_sorted = ss.run_sorter(
+                'kilosort4',
+                recording=recording_preprocessed,
+                folder=str(ss_output_dir),
+                **default_sort_params
+            )
 
         # Save outputs.
         print("Saving spike sorted output to disk...")
-        spike_sorted_disk = spike_sorted.save(folder=str(ss_output_dir), overwrite=None)
-        print("Spike sorted output saved to:", ss_output_dir)
+        job["sorting"] = spike_sorted.save(folder=str(sorting_dir), overwrite=True)
+        commit_stage(ss_output_dir, "sorting", key, params=params["sort_params"])
+        print("Spike sorted output saved to:", sorting_dir)
+    return job
 
-        print("Saving preprocessed recording to disk...")
-        recording_preproc_disk = recording_preprocessed.save(folder=str(preproc_rec_dir), overwrite=None)
-        print("Preprocessed recording saved to:", preproc_rec_dir)
+def run_curation_stage(job):
+    """
+    Compute the quality metrics of all units and label them against the curation
+    thresholds. The metrics become unit properties (exported to Phy); with
+    --curation drop, units labelled 'noise' are removed from job["sorting"] before any
+    waveforms are extracted.
+    """
+    from curation import compute_quality_metrics, apply_thresholds, write_metrics_table, read_metrics_table, curate_sorting
+
+    params = job["params"]
+    curation_dir = job["curation_dir"]
+    table_path = curation_dir / "quality_metrics.tsv"
+    key = job["stage_keys"]["curation"]
+    sorting = job["sorting"]
+
+    with job_stage(job, "curation") as record:
+        if is_stage_cached(curation_dir, "curation", key):
+            print("Reusing cached quality metrics:", table_path)
+            record["cached"] = True
+        else:
+            invalidate_stage(curation_dir)
+            print(f"Computing quality metrics of {len(sorting.unit_ids)} units...")
+            metrics = compute_quality_metrics(sorting, job["recording_preprocessed"],
+                                              peak_sign=params["spike_amp_peak_sign"], n_jobs=params["n_jobs"])
+            labels, reasons = apply_thresholds(metrics, params["curation_thresholds"])
+            os.makedirs(curation_dir, exist_ok=True)
+            write_metrics_table(table_path, sorting.unit_ids, metrics, labels, reasons)
+            commit_stage(curation_dir, "curation", key, params=params["curation_thresholds"])
+        table = read_metrics_table(table_path)
+        job["sorting"] = curate_sorting(sorting, table, params["curation"])
+        record["units"] = len(table)
+        record["units_noise"] = sum(row["label"] == "noise" for row in table.values())
+        action = "dropped" if params["curation"] == "drop" else "labelled noise"
+        print(f"Curation: {record['units_noise']} of {record['units']} units {action}; "
+              f"metrics saved to {table_path}")
+    if len(job["sorting"].unit_ids) == 0:
+        raise ValueError("No non-empty units left after curation.")
+    return job
 
-        # Plot raster and save figure.
+def run_postprocessing_stage(job):
+    """
+    Raster plot, sorting analyzer extensions (waveforms, templates, principal components,
+    spike amplitudes) and the Phy export, followed by the completion marker. The analyzer
+    extensions and the Phy export are each reused when their stage key is unchanged.
+    """
+    from spikeinterface.exporters import export_to_phy
+    from raster import plot_raster
+    from waveform_cache import WaveformCache
+
+    params = job["params"]
+    keys = job["stage_keys"]
+    if "curation" in keys:
+        job = run_curation_stage(job)
+    recording_basename = job["recording_basename"]
+    output_base = job["output_base"]
+    phy_output_directory = job["phy_output_directory"]
+    spike_sorted_disk = job["sorting"]
+    recording_preproc_disk = job["recording_preprocessed"]
+
+    # Plot raster and save figure.
+    raster_plot_path = output_base / f"{recording_basename}_raster_plot.png"
+    with job_stage(job, "raster"):
         print("Generating and saving raster plot...")
-        sw.plot_rasters(spike_sorted)
-        plt.title(recording_basename)
-        plt.ylabel("Unit IDs")
-        raster_plot_path = output_base / f"{recording_basename}_raster_plot.png"
-        plt.savefig(str(raster_plot_path))
-        plt.close()
+        num_samples = [recording_preproc_disk.get_num_samples(segment_index)
+                       for segment_index in range(recording_preproc_disk.get_num_segments())]
+        plot_raster(spike_sorted_disk, raster_plot_path, num_samples, title=recording_basename,
+                    width=params["raster_width"], rate_strips=params["raster_rate_strips"])
         print("Raster plot saved at:", raster_plot_path)
 
-        # --- Use the new waveform extraction API ---
-        print("Extracting waveforms using si.extract_waveforms()...")
-        we = si.extract_waveforms(
-            recording=recording_preproc_disk,
-            sorting=spike_sorted_disk,
-            folder=str(waveform_output_dir),
-            ms_before=ms_before,
-            ms_after=ms_after,
-            max_spikes_per_unit=random_spikes_max,
-            n_jobs=n_jobs,
-            total_memory=total_memory,
-            overwrite=None
-        )
-        print("Waveform extraction initiated...")
-        we.extract_waveforms()
-        print("Waveforms extraction complete.")
-
-        # Compute additional extensions if desired.
-        print("Computing principal components (default: n_components=%d, mode='%s')..." % (pc_n_components, pc_mode))
-        we.compute_principal_components(n_components=pc_n_components, mode=pc_mode)
-        print("Principal components computed with n_components=%d and mode='%s'.\n" % (pc_n_components, pc_mode))
-
-        print("Computing spike amplitudes (default: peak_sign='%s')..." % spike_amp_peak_sign)
-        we.compute_spike_amplitudes(peak_sign=spike_amp_peak_sign)
-        print("Spike amplitudes computed with peak_sign='%s'.\n" % spike_amp_peak_sign)
-
-        # Export to Phy using WaveformExtractor.
-        print("Exporting to Phy using WaveformExtractor...")
-        we.export_to_phy()
+    job_kwargs = dict(n_jobs=params["n_jobs"], total_memory=params["total_memory"])
+    cache = WaveformCache(job["waveform_cache_dir"], keys["analyzer"], recording_preproc_disk)
+    with job_stage(job, "analyzer") as record:
+        analyzer = build_sorting_analyzer(job, record, cache)
+
+    # Export to Phy from the sorting analyzer.
+    invalidate_stage(phy_output_directory)
+    phy_binary = params["phy_binary"]
+    if phy_binary != "copy" and not recording_preproc_disk.binary_compatible_with(time_axis=0, file_paths_length=1):
+        print(f"Preprocessed recording is not a single binary file; using phy_binary='copy' instead of '{phy_binary}'.")
+        phy_binary = "copy"
+    with job_stage(job, "phy_export") as record:
+        print("Exporting to Phy from the sorting analyzer...")
+        # PC features of all spikes are linked from the waveform cache instead (see below).
+        export_to_phy(analyzer, output_folder=phy_output_directory, copy_binary=(phy_binary == "copy"),
+                      compute_pc_features=False,
+                      compute_amplitudes=params["compute_amplitudes"],
+                      additional_properties=QC_PROPERTIES if "curation" in keys else None,
+                      **job_kwargs)
+        if params["compute_pc_features"]:
+            saved = cache.pc_features(analyzer, keys["principal_components"], phy_output_directory, job_kwargs)
+            if saved is not None:
+                record["waveform_cache"] = {"pc_features": saved}
+        if params["quantize"]:
+            from quantize import rescale_phy_export
+            # Phy shows the int16 samples as they are, so templates and amplitudes use the same units.
+            rescale_phy_export(phy_output_directory, float(recording_preproc_disk.get_channel_gains()[0]))
+        if params.get("curation") == "label":
+            write_phy_cluster_groups(phy_output_directory / "cluster_group.tsv",
+                                     analyzer.sorting.get_property("qc_label"))
         print("PHY export saved!")
 
-        # Update params.py to include the correct relative path.
-        params_path = phy_output_directory / "params.py"
-        if params_path.exists():
-            with open(params_path, "r") as f:
-                lines = f.readlines()
-            lines[0] = "dat_path = r'./recording.dat'\n"
-            with open(params_path, "w") as f:
-                f.writelines(lines)
+    if params.get("spike_store"):
+        from spike_store import ingest_session
+        with job_stage(job, "spike_store") as record:
+            record["store"] = ingest_session(job["spike_store_dir"], recording_basename, analyzer, key=keys["phy"],
+                                             recording_file=job["recording_file"],
+                                             peak_sign=params["spike_amp_peak_sign"])
+            print(f"Added {record['store']['num_spikes']} spikes of {record['store']['num_units']} units "
+                  f"to the spike store: {job['spike_store_dir']}")
+
+    # Update params.py to include the correct relative path.
+    params_path = phy_output_directory / "params.py"
+    if params_path.exists():
+        if phy_binary == "copy":
+            write_phy_params(params_path, dat_path="./recording.dat")
         else:
-            print(f"Warning: params.py not found in {phy_output_directory}")
+            dat_path = link_phy_binary(recording_preproc_disk, phy_output_directory, phy_binary)
+            # Phy shares the preprocessed binary: evicting it would free no space (hardlink)
+            # or break the export (symlink/reference).
+            pin_stage(job["preproc_rec_dir"], "preprocessing")
+            binary = recording_preproc_disk.get_binary_description()
+            write_phy_params(params_path, dat_path=dat_path, dtype=str(binary["dtype"]), offset=binary["file_offset"])
+    else:
+        print(f"Warning: params.py not found in {phy_output_directory}")
+    # The Phy folder is the deliverable, so it is never evicted from the cache.
+    commit_stage(phy_output_directory, "phy", keys["phy"], evictable=False)
+
+    # Write the completion marker and the stage metrics next to it.
+    with open(job["complete_marker"], "w") as f:
+        f.write(f"Processing completed on {datetime.now()}\n")
+    write_metrics(job["metrics_path"], recording_basename, job["metrics"], "complete")
+    release_recording_job(job)
+
+    if params.get("cache_size_cap"):
+        evict_lru(output_base.parent, parse_memory_size(params["cache_size_cap"]))
+
+    print(f"Finished processing {recording_basename}")
+    return job
 
-        # Write the completion marker.
-        with open(complete_marker, "w") as f:
-            f.write(f"Processing completed on {datetime.now()}\n")
+def build_sorting_analyzer(job, record, cache):
+    """
+    Load or create the sorting analyzer in waveform_output_dir and compute the extensions
+    the Phy export needs, reusing those whose stage key is unchanged.
+
+    Waveforms and principal components are only computed with --compute-pc-features and
+    spike amplitudes only with --compute-amplitudes. The spike subsample, the waveforms
+    and the spike amplitudes come from the waveform cache (see waveform_cache.py), so a
+    changed --ms-before/--ms-after inside the cached window only slices the cached
+    waveforms; with a spikeinterface version the cache does not support, they are
+    computed by the analyzer instead. All other missing extensions are computed in one
+    analyzer.compute() call, spread across n_jobs.
+
+    The passes over the preprocessed traces are not merged: the cached waveforms, the
+    spike amplitudes (which need the templates' extremum channels and peak shifts first)
+    and the all-spike PC projection of the Phy export each read the traces once, unless
+    they are reused from the waveform cache.
+    """
+    import spikeinterface as si
+    from spikeinterface.core import ChannelSparsity
+    from waveform_cache import install_extension, average_templates, waveform_dtype, can_install_extensions
+
+    params = job["params"]
+    keys = job["stage_keys"]
+    analyzer_dir = job["waveform_output_dir"]
+    sorting = job["sorting"]
+    recording = job["recording_preprocessed"]
+    job_kwargs = dict(n_jobs=params["n_jobs"], total_memory=params["total_memory"])
+
+    if is_stage_cached(analyzer_dir, "analyzer", keys["analyzer"]):
+        print("Reusing sorting analyzer:", analyzer_dir)
+        analyzer = si.load_sorting_analyzer(analyzer_dir)
+        analyzer.set_temporary_recording(recording)
+    else:
+        invalidate_stage(analyzer_dir)
+        sparsity = None
+        if params.get("split_by_group") and sorting.get_property("group") is not None:
+            # Keep every unit's waveforms, PCs and templates on the channels of its own group.
+            sparsity = ChannelSparsity.from_property(sorting, recording, by_property="group")
+        print("Creating sorting analyzer...")
+        analyzer = si.create_sorting_analyzer(sorting, recording, format="binary_folder", folder=analyzer_dir,
+                                              sparse=True, sparsity=sparsity, **job_kwargs)
+        commit_stage(analyzer_dir, "analyzer", keys["analyzer"])
+
+    ms_before, ms_after = params["ms_before"], params["ms_after"]
+    stale = {}
+    base_stale = (not is_stage_cached(analyzer_dir, "waveforms", keys["waveforms"])
+                  or (params["compute_pc_features"] and not analyzer.has_extension("waveforms")))
+    if base_stale:
+        stale["random_spikes"] = {}
+        if params["compute_pc_features"]:
+            # PCs are fitted on the extracted waveforms, so they are only needed for PC features.
+            stale["waveforms"] = {}
+        stale["templates"] = {}
+        stale["template_similarity"] = {}
+    if params["compute_pc_features"] and (
+            base_stale or not is_stage_cached(analyzer_dir, "principal_components", keys["principal_components"])):
+        stale["principal_components"] = {"n_components": params["pc_n_components"], "mode": params["pc_mode"]}
+    amplitudes_stale = params["compute_amplitudes"] and (
+        base_stale or not is_stage_cached(analyzer_dir, "spike_amplitudes", keys["spike_amplitudes"]))
+
+    record["extensions"] = list(stale) + (["spike_amplitudes"] if amplitudes_stale else [])
+    if not record["extensions"]:
+        print("Reusing cached analyzer extensions.")
+        record["cached"] = True
+        return analyzer
+    print(f"Computing analyzer extensions: {', '.join(record['extensions'])}...")
+    reused = {}
+    ms_window = {"ms_before": float(ms_before), "ms_after": float(ms_after)}
+    if base_stale and not can_install_extensions():
+        print(f"The waveform cache is not supported with spikeinterface {si.__version__}; "
+              f"computing the spike subsample and waveforms from the recording.")
+        stale["random_spikes"] = {"method": "uniform", "max_spikes_per_unit": params["random_spikes_max"], "seed": 0}
+        if "waveforms" in stale:
+            stale["waveforms"] = ms_window
+        stale["templates"] = dict(ms_window, operators=["average"])
+    elif base_stale:
+        # Installing the subsample deletes every extension computed from the previous one.
+        policy = params.get("random_spikes_policy", "uniform")
+        indices = cache.random_spikes(sorting, params["random_spikes_max"], policy=policy)
+        install_extension(analyzer, "random_spikes", {"method": policy, "max_spikes_per_unit": params["random_spikes_max"],
+                                                      "seed": 0}, {"random_spikes_indices": indices})
+        some_spikes = analyzer.get_extension("random_spikes").get_random_spikes()
+        dtype = waveform_dtype(analyzer)
+        waveforms, reused["waveforms"] = cache.waveforms(analyzer, some_spikes, ms_before, ms_after,
+                                                         params.get("waveform_cache_margin", 0.5), dtype, job_kwargs)
+        if params["compute_pc_features"]:
+            install_extension(analyzer, "waveforms", dict(ms_window, dtype=dtype), {"waveforms": waveforms})
+        install_extension(analyzer, "templates", dict(ms_window, operators=["average"]),
+                          {"average": average_templates(analyzer, waveforms, some_spikes)})
+        for name in ("random_spikes", "waveforms", "templates"):
+            stale.pop(name, None)
+    if stale:
+        analyzer.compute(stale, **job_kwargs)
+    if amplitudes_stale:
+        reused["spike_amplitudes"] = cache.spike_amplitudes(analyzer, params["spike_amp_peak_sign"], job_kwargs)
+    if base_stale:
+        commit_stage(analyzer_dir, "waveforms", keys["waveforms"])
+    if "principal_components" in stale:
+        commit_stage(analyzer_dir, "principal_components", keys["principal_components"])
+    if amplitudes_stale:
+        commit_stage(analyzer_dir, "spike_amplitudes", keys["spike_amplitudes"])
+    record["waveform_cache"] = {name: saved for name, saved in reused.items() if saved is not None}
+    print("Analyzer extensions computed.")
+    return analyzer
+
+def link_phy_binary(recording, phy_output_directory, mode):
+    """
+    Make the saved preprocessed binary available to Phy without copying it.
+    mode='link' hardlinks it as recording.dat, falling back to a symlink and then to a
+    relative reference; mode='reference' only references it. Returns the dat_path for params.py.
+    """
+    binary_path = Path(recording.get_binary_description()["file_paths"][0]).resolve()
+    phy_dat = Path(phy_output_directory) / "recording.dat"
+    relative_path = os.path.relpath(binary_path, Path(phy_output_directory).resolve())
+    if mode == "link":
+        try:
+            os.link(binary_path, phy_dat)
+            print(f"Hardlinked {binary_path} as {phy_dat}")
+            return "./recording.dat"
+        except OSError:
+            pass
+        try:
+            os.symlink(relative_path, phy_dat)
+            print(f"Symlinked {binary_path} as {phy_dat}")
+            return "./recording.dat"
+        except OSError:
+            print("Hardlinks and symlinks are not supported here; referencing the preprocessed binary instead.")
+    return relative_path
+
+def write_phy_cluster_groups(cluster_group_path, labels):
+    """
+    Pre-label clusters in Phy: units labelled 'noise' by the curation go to the noise
+    group, all others stay unsorted.
+    """
+    with open(cluster_group_path, "w") as f:
+        f.write("cluster_id\tgroup\n")
+        for cluster_id, label in enumerate(labels):
+            f.write(f"{cluster_id}\t{'noise' if label == 'noise' else 'unsorted'}\n")
+
+def write_phy_params(params_path, **values):
+    """
+    Overwrite the given variables (e.g. dat_path, dtype, offset) in a Phy params.py,
+    keeping all other lines as written by export_to_phy.
+    """
+    with open(params_path, "r") as f:
+        lines = f.read().splitlines()
+    for key, value in values.items():
+        line = f"{key} = r'{value}'" if key == "dat_path" else f"{key} = {value!r}"
+        for i, existing in enumerate(lines):
+            if existing.split("=")[0].strip() == key:
+                lines[i] = line
+                break
+        else:
+            lines.append(line)
+    with open(params_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def report_recording_error(job, stage_name, e):
+    """
+    Print a per-recording error and return the status it maps to.
+    """
+    recording_basename = job["recording_basename"]
+    release_recording_job(job)
+    if job.get("metrics"):
+        write_metrics(job["metrics_path"], recording_basename, job["metrics"], "failed")
+    if "No non-empty units" in str(e):
+        print(f"Skipping {recording_basename}: {str(e)}")
+        return "skipped"
+    print(f"Error processing {recording_basename} ({stage_name} stage): {str(e)}")
+    return "failed"
 
-        print(f"Finished processing {recording_basename}")
+def process_recording(recording_file, output_folder, probe_object, sort_params,
+                      stream_id, freq_min, freq_max, whiten_dtype, force_cpu,
+                      ms_before, ms_after, n_jobs, total_memory,
+                      compute_pc_features, compute_amplitudes,
+                      random_spikes_max, pc_n_components, pc_mode, spike_amp_peak_sign,
+                      cache_size_cap=None, rec_reader="native", phy_binary="link", profile_stages=None,
+                      split_by_group=False, group_workers=None, raster_width=2000, raster_rate_strips=False,
+                      preproc_format="binary", zarr_compression_level=5, quantize=False, spike_store=False,
+                      curation="off", curation_thresholds=None, window_duration=None, window_overlap=60.0,
+                      random_spikes_policy="uniform", waveform_cache_margin=0.5, work_queue=None, on_stage=None):
+    """
+    Process a single recording file using supplied parameters.
+    Each recording's outputs will be stored in a subfolder under the user-specified
+    output folder (structure: <output_folder>/proc/<recording_basename>/).
+    With a work_queue, the recording is only processed if this worker can claim it.
+    on_stage(stage, record) is called when every stage starts and ends (see job_stage).
+    Returns 'complete', 'skipped', 'claimed' (by another worker) or 'failed'.
+    """
+    job = make_recording_job(
+        recording_file, output_folder,
+        probe_object=probe_object, sort_params=sort_params, stream_id=stream_id,
+        freq_min=freq_min, freq_max=freq_max, whiten_dtype=whiten_dtype, force_cpu=force_cpu,
+        ms_before=ms_before, ms_after=ms_after, n_jobs=n_jobs, total_memory=total_memory,
+        compute_pc_features=compute_pc_features, compute_amplitudes=compute_amplitudes,
+        random_spikes_max=random_spikes_max, pc_n_components=pc_n_components, pc_mode=pc_mode,
+        spike_amp_peak_sign=spike_amp_peak_sign, cache_size_cap=cache_size_cap, rec_reader=rec_reader,
+        phy_binary=phy_binary, profile_stages=profile_stages,
+        split_by_group=split_by_group, group_workers=group_workers,
+        raster_width=raster_width, raster_rate_strips=raster_rate_strips,
+        preproc_format=preproc_format, zarr_compression_level=zarr_compression_level, quantize=quantize,
+        spike_store=spike_store, curation=curation, curation_thresholds=curation_thresholds,
+        window_duration=window_duration, window_overlap=window_overlap,
+        random_spikes_policy=random_spikes_policy, waveform_cache_margin=waveform_cache_margin,
+        work_queue=work_queue, on_stage=on_stage
+    )
+    if not prepare_recording_job(job):
+        return "claimed" if job.get("claimed_elsewhere") else "skipped"
 
+    stage_name = "preprocessing"
+    try:
+        job = run_preprocessing_stage(job)
+        stage_name = "sorting"
+        job = run_sorting_stage(job)
+        stage_name = "postprocessing"
+        run_postprocessing_stage(job)
+        return "complete"
     except Exception as e:
-        if "No non-empty units" in str(e):
-            print(f"Skipping {recording_basename}: {str(e)}")
+        return report_recording_error(job, stage_name, e)
+
+class RecordingSkipped(Exception):
+    """
+    Raised inside a pipeline lane to drop a recording that does not need processing.
+    """
+
+def _pipeline_preprocessing_lane(job):
+    """
+    First pipeline lane: prepares the output folder and writes the preprocessed
+    recording, which the sorter lane then picks up from disk.
+    """
+    if not prepare_recording_job(job):
+        raise RecordingSkipped("output already exists, processing is complete or another worker claimed it.")
+    return run_preprocessing_stage(job)
+
+def report_pipeline_error(job, stage_name, e):
+    """
+    Error handler for pipeline lanes; skipped recordings are not reported as errors.
+    """
+    if isinstance(e, RecordingSkipped):
+        return "claimed" if job.get("claimed_elsewhere") else "skipped"
+    return report_recording_error(job, stage_name, e)
+
+def scan_data_folder(manifest, exclude=()):
+    """
+    Refresh the recording manifest and return the recordings that are ready to process,
+    leaving out those whose status is in exclude.
+    """
+    stats = manifest.refresh()
+    print(f"Scanned {manifest.data_folder} in {stats['seconds']:.2f} s: listed {stats['dirs_listed']} "
+          f"directories, {stats['dirs_reused']} unchanged; {stats['new']} new, {stats['changed']} changed, "
+          f"{stats['removed']} removed recording(s); {len(manifest.recordings)} recording(s) indexed.")
+    writing = manifest.still_writing()
+    if writing:
+        print(f"Holding back {len(writing)} recording(s) that are still being written "
+              f"(modified less than {manifest.settle_seconds:g} s ago or since the last scan).")
+    return manifest.settled_recordings(exclude)
+
+def select_pending_recordings(recording_files, recording_kwargs, manifest=None):
+    """
+    Return the recordings whose outputs are missing or out of date. With a manifest,
+    recordings it already records as done with the same parameters are dropped without
+    touching the output tree, and recordings found up to date are recorded as done.
+    """
+    pending = []
+    already_done = 0
+    for rec_file in recording_files:
+        job = make_recording_job(rec_file, **recording_kwargs)
+        if manifest is not None:
+            job["fingerprint"] = manifest.fingerprint(rec_file)
+            if manifest.is_done(rec_file, compute_stage_keys(job)["phy"]):
+                already_done += 1
+                continue
+        reason = recording_skip_reason(job)
+        if reason is None:
+            pending.append(rec_file)
+            continue
+        print(f"Skipping {os.path.basename(rec_file)}: {reason}.")
+        if manifest is not None:
+            manifest.set_status(rec_file, "complete", compute_stage_keys(job)["phy"])
+    if already_done:
+        print(f"Skipping {already_done} recording(s) the manifest records as processed with these parameters.")
+    return pending
+
+def plan_workers(recording_files, args):
+    """
+    Number of recordings that run at the same time in the configured execution mode.
+    The two CPU lanes of the pipelined mode count as two.
+    """
+    if args.pipeline:
+        return 2
+    return max(1, min(args.max_workers, len(recording_files)))
+
+def plan_recordings(recording_files, recording_kwargs, args):
+    """
+    Plan n_jobs, chunk size, peak memory and scratch disk of every recording against the
+    detected container limits and print the plan. Returns (plans by file, resources).
+    """
+    from planner import detect_resources, plan_batch, print_plan
+    resources = detect_resources(args.output_folder)
+    max_workers = plan_workers(recording_files, args)
+    plans = plan_batch(recording_files, recording_kwargs, resources, max_workers=max_workers,
+                       num_probe_channels=recording_kwargs["probe_object"].get_contact_count())
+    if args.pipeline:
+        # Only the concurrent scheduler waits for the memory of running recordings; the
+        # pipeline lanes would start a deferred recording next to another one.
+        for plan in plans:
+            if plan["action"] == "defer":
+                plan["action"] = "refuse"
+                plan["reason"] += " (recordings are not deferred in --pipeline mode)"
+    print_plan(plans, resources, max_workers)
+    return {plan["recording"]: plan for plan in plans}, resources
+
+def process_batch(recording_files, recording_kwargs, args, plans=None, resources=None):
+    """
+    Process recording_files with the configured execution mode (sequential, concurrent
+    or pipelined) and write the batch metrics summary. With plans (see plan_recordings),
+    every recording gets its planned n_jobs and chunk size, and concurrent workers are
+    only started while their estimated peak memory fits.
+    Returns a dict mapping every recording file to 'complete', 'skipped', 'claimed' or 'failed'.
+    """
+    max_workers = max(1, min(args.max_workers, len(recording_files)))
+    if args.pipeline:
+        # The preprocessing and post-processing lanes run at the same time and share the CPU budget.
+        max_workers = 1
+        n_jobs, total_memory = split_budget(args.n_jobs, args.total_memory, 2)
+    else:
+        n_jobs, total_memory = split_budget(args.n_jobs, args.total_memory, max_workers)
+    if max_workers > 1 and plans is None:
+        print(f"Sharing {args.n_jobs} core(s) and {args.total_memory} memory across {max_workers} workers: "
+              f"{n_jobs} core(s) and {total_memory} per recording.")
+    recording_kwargs = dict(recording_kwargs, n_jobs=n_jobs, total_memory=total_memory)
+
+    def kwargs_for(rec_file):
+        if plans is None:
+            return recording_kwargs
+        return dict(recording_kwargs, n_jobs=plans[rec_file]["n_jobs"], total_memory=plans[rec_file]["total_memory"])
+
+    if args.pipeline or max_workers > 1:
+        print(f"Loaded processing modules in {preload_stage_modules():.2f} s.")
+
+    statuses = {}
+    try:
+        if args.pipeline:
+            jobs = [make_recording_job(rec_file, **kwargs_for(rec_file)) for rec_file in recording_files]
+            lanes = [
+                ("preprocessing", _pipeline_preprocessing_lane, 1),
+                ("sorting", run_sorting_stage, 1),
+                ("postprocessing", run_postprocessing_stage, 1),
+            ]
+            results = run_pipeline(jobs, lanes, report_pipeline_error, queue_depth=args.pipeline_depth,
+                                   release=release_recording_job)
+            for job in jobs:
+                statuses[job["recording_file"]] = results.get(job["recording_basename"], "failed")
+        elif max_workers > 1:
+            if plans is None:
+                jobs = [(os.path.basename(rec_file),
+                         dict(recording_kwargs, recording_file=rec_file),
+                         estimate_scratch_bytes(rec_file, "int16" if args.quantize else args.whiten_dtype,
+                                                phy_copy=(args.phy_binary == "copy" or args.preproc_format == "zarr")))
+                        for rec_file in recording_files]
+                memory_budget = None
+            else:
+                from planner import MEMORY_HEADROOM
+                jobs = [(os.path.basename(rec_file), dict(kwargs_for(rec_file), recording_file=rec_file),
+                         plans[rec_file]["scratch"], plans[rec_file]["peak_memory"])
+                        for rec_file in recording_files]
+                memory_budget = int(resources["memory_available"] * MEMORY_HEADROOM)
+            max_scratch = parse_memory_size(args.max_scratch) if args.max_scratch else None
+            os.makedirs(args.output_folder, exist_ok=True)
+            results = run_concurrent_batch(process_recording, jobs, max_workers=max_workers, n_jobs=n_jobs,
+                                           scratch_budget=max_scratch, scratch_folder=args.output_folder,
+                                           memory_budget=memory_budget)
+            for rec_file in recording_files:
+                status = results.get(os.path.basename(rec_file), "failed")
+                statuses[rec_file] = "complete" if status == "ok" else status
         else:
-            print(f"Error processing {recording_basename}: {str(e)}")
-        return
+            for rec_file in recording_files:
+                statuses[rec_file] = process_recording(recording_file=rec_file, **kwargs_for(rec_file))
+    finally:
+        if recording_kwargs.get("work_queue") is not None:
+            # Leases of workers that crashed (e.g. OOM-killed) or were stopped are still ours: hand them back.
+            for rec_file in recording_files:
+                recording_kwargs["work_queue"].release(rec_file)
+
+    failed = [os.path.basename(rec_file) for rec_file, status in statuses.items() if status == "failed"]
+    if failed and (args.pipeline or max_workers > 1):
+        print(f"\n{len(failed)} recording(s) failed: {', '.join(failed)}")
+
+    metrics_files = [make_recording_job(rec_file, args.output_folder)["metrics_path"] for rec_file in recording_files]
+    summarize_batch([path for path in metrics_files if path.exists()],
+                    summary_path=Path(args.output_folder) / "batch_metrics.tsv")
+    return statuses
 
 def str2bool(v):
     """
@@ -197,11 +945,15 @@ def str2bool(v):
     else:
        raise argparse.ArgumentTypeError('Boolean value expected.')
 
-def main():
+def build_parser():
+    """
+    Command line parser of app.py; also used to validate job overrides in service mode.
+    """
     parser = argparse.ArgumentParser(description="Spike Sorting Command Line Tool with full parameter control")
     # Input and probe configuration.
-    parser.add_argument("--data-folder", type=str, required=True,
-                        help="Path to the folder containing recording files (searches recursively).")
+    parser.add_argument("--data-folder", type=str, default=None,
+                        help="Path to the folder containing recording files (searches recursively); "
+                             "required unless --serve is used.")
     parser.add_argument("--output-folder", type=str, default=".",
                         help="Directory where processed output will be saved (default: current directory).")
     parser.add_argument("--prb-file", type=str, default=None,
@@ -210,8 +962,29 @@ def main():
                         help="If set, only one recording file will be processed (batch processing disabled).")
     parser.add_argument("--recording-file", type=str, default=None,
                         help="Specify a single recording file to process (used when batch processing is disabled).")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Recording manifest used to find recordings in the data folder without a full recursive "
+                             "scan (default: <output-folder>/recording_manifest.json).")
+    parser.add_argument("--settle-seconds", type=float, default=30,
+                        help="Recordings modified less than this many seconds ago are treated as still being "
+                             "written and held back (default: 30).")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running: rescan the data folder every --watch-interval seconds and process "
+                             "newly finished recordings as they appear (stop with Ctrl-C).")
+    parser.add_argument("--watch-interval", type=float, default=60,
+                        help="Seconds between data folder scans in --watch mode (default: 60).")
+    parser.add_argument("--shared-queue", action="store_true",
+                        help="Share the batch with other workers (containers or nodes) that use the same data and "
+                             "output folders: every recording is claimed through a lease file under "
+                             "<output-folder>/work_queue before it is processed.")
+    parser.add_argument("--lease-seconds", type=float, default=600,
+                        help="With --shared-queue, a claim that has not been renewed for this many seconds is "
+                             "taken over by another worker; leases are renewed every quarter of it (default: 600).")
     parser.add_argument("--stream-id", type=str, default="trodes",
                         help="Stream ID to use when reading recording files (default: 'trodes').")
+    parser.add_argument("--rec-reader", type=str, default="native", choices=["native", "neo"],
+                        help="Reader for .rec files: 'native' memory-maps the 'trodes' stream directly, 'neo' uses "
+                             "spikeinterface's read_spikegadgets (default: 'native'; other streams always use 'neo').")
 
     # Preprocessing parameters.
     parser.add_argument("--freq-min", type=float, default=300,
@@ -220,12 +993,34 @@ def main():
                         help="Maximum frequency for bandpass filtering (default: 6000 Hz).")
     parser.add_argument("--whiten-dtype", type=str, default="float32",
                         help="Data type for whitening (default: 'float32').")
+    parser.add_argument("--preproc-format", type=str, default="binary", choices=["binary", "zarr"],
+                        help="Storage of the preprocessed recording: 'binary' (read in place by the sorter and Phy) or "
+                             "'zarr' (chunked, Blosc-zstd compressed; Phy then gets its own binary copy) (default: binary).")
+    parser.add_argument("--zarr-compression-level", type=int, default=5,
+                        help="Blosc-zstd compression level (0-9) for --preproc-format zarr (default: 5).")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Store the whitened traces as int16 with one gain shared by all channels and no offset "
+                             "(half the size of float32; scaling is applied transparently when reading, and the Phy "
+                             "templates and amplitudes are divided by the gain to match the int16 traces).")
 
     # Sorting parameters.
     parser.add_argument("--sort-params", type=str, default="{}",
                         help="JSON string to override default sorting parameters (e.g., '{\"parameter_name\": value}').")
     parser.add_argument("--force-cpu", action="store_true",
                         help="If set, forces sorting to run on CPU even if a GPU is available.")
+    parser.add_argument("--window-duration", type=float, default=None,
+                        help="Sort recordings longer than this many seconds in overlapping windows of this length "
+                             "and stitch them into one sorting, so the sorter's memory does not grow with the "
+                             "recording length (default: sort the whole recording at once).")
+    parser.add_argument("--window-overlap", type=float, default=60,
+                        help="Overlap in seconds between sorting windows, used to match units across "
+                             "windows (default: 60).")
+    parser.add_argument("--split-by-group", action="store_true",
+                        help="Whiten and sort every channel group of the .prb file as an independent job and "
+                             "merge the results into one Phy export labeled by group.")
+    parser.add_argument("--group-workers", type=int, default=None,
+                        help="Number of channel groups sorted in parallel with --split-by-group "
+                             "(default: up to --n-jobs).")
 
     # Waveform extraction parameters.
     parser.add_argument("--ms-before", type=float, default=1,
@@ -237,15 +1032,86 @@ def main():
     parser.add_argument("--total-memory", type=str, default="16G",
                         help="Total memory available for waveform extraction (default: '16G').")
 
+    # Stage cache parameters.
+    parser.add_argument("--cache-size-cap", type=str, default=None,
+                        help="Size cap for cached intermediate stage outputs under <output-folder>/proc, e.g. '500G'. "
+                             "Least recently used preprocessed recordings, sorter outputs and waveforms are evicted "
+                             "first; Phy exports are kept (default: no eviction).")
+
+    # Raster plot parameters.
+    parser.add_argument("--raster-width", type=int, default=2000,
+                        help="Number of time bins (pixels) of the raster plot (default: 2000).")
+    parser.add_argument("--raster-rate-strips", action="store_true",
+                        help="Add a per-unit firing-rate panel (1 s bins) below the raster plot.")
+
+    # Instrumentation parameters.
+    parser.add_argument("--profile-stages", type=str, default=None, choices=["cprofile", "py-spy"],
+                        help="Profile every stage and save the profiles under <recording output>/profiles "
+                             "('py-spy' requires py-spy to be installed; default: no profiling).")
+
+    # Service mode parameters.
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a long-lived worker service that keeps the libraries, probes and compute device "
+                             "initialized and processes jobs submitted over HTTP (see service.py). The other options "
+                             "are the defaults that every job can override.")
+    parser.add_argument("--serve-port", type=int, default=8765,
+                        help="Port of the service on 127.0.0.1 (default: 8765).")
+    parser.add_argument("--serve-socket", type=str, default=None,
+                        help="Listen on this Unix socket instead of the TCP port.")
+
+    # Resource planning parameters.
+    parser.add_argument("--auto-resources", action="store_true",
+                        help="Detect the container's CPU and memory limits and free scratch space, and pick n_jobs and "
+                             "the chunk size of every recording from per-stage memory and disk estimates (replaces "
+                             "--n-jobs and --total-memory). Recordings that cannot fit, alone or in the scratch left by the "
+                             "recordings planned before them, are not started. Only --max-workers defers recordings that "
+                             "need the memory of other workers; with --pipeline they are not started.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the resource plan of the recordings that need processing and exit.")
+
+    # Concurrent batch parameters.
+    parser.add_argument("--max-workers", type=int, default=1,
+                        help="Number of recordings processed concurrently (default: 1). When greater than 1, "
+                             "--n-jobs and --total-memory are the global budget shared by all workers.")
+    parser.add_argument("--max-scratch", type=str, default=None,
+                        help="Scratch disk budget for concurrent workers, e.g. '500G' (default: free space on the output folder).")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Pipelined mode: preprocessing, sorting and post-processing run in separate lanes so "
+                             "different recordings overlap (the sorter lane stays busy).")
+    parser.add_argument("--pipeline-depth", type=int, default=1,
+                        help="Maximum number of recordings waiting between two pipeline lanes (default: 1).")
+
     # Phy export parameters.
     parser.add_argument("--compute-pc-features", type=str2bool, default=True,
                         help="Compute PC features for Phy export (default: True).")
     parser.add_argument("--compute-amplitudes", type=str2bool, default=True,
                         help="Compute amplitudes for Phy export (default: True).")
+    parser.add_argument("--phy-binary", type=str, default="link", choices=["link", "reference", "copy"],
+                        help="How Phy gets the preprocessed traces: 'link' hardlinks (or symlinks) the saved "
+                             "preprocessed binary as recording.dat, 'reference' points dat_path in params.py at it, "
+                             "'copy' writes a separate recording.dat (default: 'link').")
+    parser.add_argument("--curation", type=str, default="off", choices=["off", "label", "drop"],
+                        help="Auto-curation after sorting: compute firing rate, ISI violations, presence ratio, "
+                             "amplitude cutoff and SNR of all units, then 'label' units that fail a threshold "
+                             "as noise in Phy or 'drop' them before waveforms and PCs are computed (default: 'off').")
+    parser.add_argument("--curation-thresholds", type=str, default="{}",
+                        help="JSON object of curation rules overriding the defaults, e.g. "
+                             "'{\"snr_min\": 4, \"presence_ratio_min\": null}' (see curation.py).")
+    parser.add_argument("--spike-store", action="store_true",
+                        help="Add every finished recording's spike times, amplitudes and unit channels to the "
+                             "consolidated spike store in <output-folder>/spike_store (see spike_store.py).")
 
     # New post-processing extension parameters.
     parser.add_argument("--random-spikes-max", type=int, default=200,
                         help="Max spikes per unit for random spikes computation (default: 200).")
+    parser.add_argument("--random-spikes-policy", type=str, default="uniform", choices=["uniform", "count_aware"],
+                        help="How many spikes per unit are sampled for waveforms and templates: 'uniform' takes up "
+                             "to --random-spikes-max of every unit, 'count_aware' gives units with more spikes than "
+                             "the median unit up to 4x as many (default: 'uniform'). Spikes are always spread "
+                             "evenly over the recording with a fixed seed.")
+    parser.add_argument("--waveform-cache-margin", type=float, default=0.5,
+                        help="Milliseconds added before and after the --ms-before/--ms-after window of the cached "
+                             "waveforms, so later runs within that window reuse them (default: 0.5).")
     parser.add_argument("--pc-n-components", type=int, default=3,
                         help="Number of principal components (default: 3).")
     parser.add_argument("--pc-mode", type=str, default="by_channel_local",
@@ -253,90 +1119,190 @@ def main():
     parser.add_argument("--spike-amp-peak-sign", type=str, default="neg",
                         help="Peak sign for spike amplitude computation (default: 'neg').")
 
-    args = parser.parse_args()
-    
+    return parser
+
+def normalize_args(args):
+    """
+    Turn empty optional strings (as passed by spikesort.bat) into None.
+    """
     if args.recording_file == "":
         args.recording_file = None
-
     if args.prb_file == "":
         args.prb_file = None
+    return args
+
+def load_probe(prb_file):
+    """
+    Read the probe configuration from prb_file, or the default probe file when it is None.
+    Returns None (after printing why) if the file does not exist.
+    """
+    from probeinterface import read_prb
+    if prb_file:
+        prb_path = Path(prb_file)
+        if not prb_path.exists():
+            print(f"Provided prb file '{prb_file}' does not exist. Exiting.")
+            return None
+        print(f"Using probe configuration from: {prb_file}")
+        return read_prb(str(prb_path))
+    default_probe_path = Path(__file__).parent / "nancyprobe_linearprobelargespace.prb"
+    if not default_probe_path.exists():
+        print(f"Default probe file not found at: {default_probe_path}. Exiting.")
+        return None
+    print(f"No prb file provided; using default probe file at: {default_probe_path}")
+    return read_prb(str(default_probe_path))
+
+def recording_kwargs_from_args(args, probe_object, sort_params):
+    """
+    Keyword arguments of process_recording (without n_jobs/total_memory) for the parsed options.
+    """
+    return dict(
+        output_folder=args.output_folder,
+        probe_object=probe_object,
+        sort_params=sort_params,
+        stream_id=args.stream_id,
+        freq_min=args.freq_min,
+        freq_max=args.freq_max,
+        whiten_dtype=args.whiten_dtype,
+        force_cpu=args.force_cpu,
+        ms_before=args.ms_before,
+        ms_after=args.ms_after,
+        compute_pc_features=args.compute_pc_features,
+        compute_amplitudes=args.compute_amplitudes,
+        random_spikes_max=args.random_spikes_max,
+        pc_n_components=args.pc_n_components,
+        pc_mode=args.pc_mode,
+        spike_amp_peak_sign=args.spike_amp_peak_sign,
+        cache_size_cap=args.cache_size_cap,
+        rec_reader=args.rec_reader,
+        phy_binary=args.phy_binary,
+        profile_stages=args.profile_stages,
+        split_by_group=args.split_by_group,
+        group_workers=args.group_workers,
+        raster_width=args.raster_width,
+        raster_rate_strips=args.raster_rate_strips,
+        preproc_format=args.preproc_format,
+        zarr_compression_level=args.zarr_compression_level,
+        quantize=args.quantize,
+        spike_store=args.spike_store,
+        curation=args.curation,
+        curation_thresholds=parse_thresholds(args.curation_thresholds),
+        window_duration=args.window_duration,
+        window_overlap=args.window_overlap,
+        random_spikes_policy=args.random_spikes_policy,
+        waveform_cache_margin=args.waveform_cache_margin
+    )
+
+def main():
+    parser = build_parser()
+    args = normalize_args(parser.parse_args())
+    if args.window_duration is not None and args.window_duration <= args.window_overlap:
+        parser.error("--window-duration must be longer than --window-overlap.")
+
+    if args.serve:
+        from service import serve
+        serve(parser, args)
+        return
+    if not args.data_folder:
+        parser.error("--data-folder is required (unless --serve is used).")
 
     try:
         sort_params = json.loads(args.sort_params)
     except json.JSONDecodeError as e:
         print("Error parsing sort parameters. Please provide a valid JSON string.")
         return
-
-    # Print GPU/CPU information.
-    gpu_available = is_gpu_available()
-    if args.force_cpu:
-        print("Forcing CPU for sorting.")
-    else:
-        if gpu_available:
-            print("GPU is available. Using GPU for sorting.")
-        else:
-            print("GPU not available. Using CPU for sorting.")
+    try:
+        parse_thresholds(args.curation_thresholds)
+    except ValueError as e:
+        print(f"Error parsing curation thresholds: {e}")
+        return
 
     # Load probe configuration.
-    if args.prb_file:
-        prb_path = Path(args.prb_file)
-        if not prb_path.exists():
-            print(f"Provided prb file '{args.prb_file}' does not exist. Exiting.")
-            return
-        probe_object = read_prb(str(prb_path))
-        print(f"Using probe configuration from: {args.prb_file}")
-    else:
-        default_probe_path = Path(__file__).parent / "nancyprobe_linearprobelargespace.prb"
-        if not default_probe_path.exists():
-            print(f"Default probe file not found at: {default_probe_path}. Exiting.")
-            return
-        print(f"No prb file provided; using default probe file at: {default_probe_path}")
-        probe_object = read_prb(str(default_probe_path))
-    
-    # Determine which recordings to process.
-    data_folder = args.data_folder
-    if args.disable_batch:
-        if args.recording_file:
-            recording_files = [args.recording_file]
-        else:
-            recording_files = glob.glob(os.path.join(data_folder, "**/*merged.rec"), recursive=True)
-            if recording_files:
-                recording_files = [recording_files[0]]
-            else:
-                print("No recording files found in the provided data folder.")
-                return
+    probe_object = load_probe(args.prb_file)
+    if probe_object is None:
+        return
+
+    # Determine which recordings to process. Batch mode finds them through the manifest,
+    # which only relists directories that changed since the previous run.
+    manifest = None
+    if args.disable_batch and args.recording_file:
+        recording_files = [args.recording_file]
     else:
-        recording_files = glob.glob(os.path.join(data_folder, "**/*merged.rec"), recursive=True)
-        if not recording_files:
+        manifest_path = args.manifest or os.path.join(args.output_folder, "recording_manifest.json")
+        manifest = RecordingManifest(manifest_path, args.data_folder, settle_seconds=args.settle_seconds)
+        recording_files = scan_data_folder(manifest)
+        if args.disable_batch:
+            recording_files = recording_files[:1]
+        if not recording_files and not args.watch:
+            manifest.save()
             print("No recording files found in the provided data folder.")
             return
 
     print(f"Found {len(recording_files)} recording file(s) to process.")
 
-    for rec_file in recording_files:
-        if os.path.isdir(rec_file):
-            continue
-        process_recording(
-            recording_file=rec_file,
-            output_folder=args.output_folder,
-            probe_object=probe_object,
-            sort_params=sort_params,
-            stream_id=args.stream_id,
-            freq_min=args.freq_min,
-            freq_max=args.freq_max,
-            whiten_dtype=args.whiten_dtype,
-            force_cpu=args.force_cpu,
-            ms_before=args.ms_before,
-            ms_after=args.ms_after,
-            n_jobs=args.n_jobs,
-            total_memory=args.total_memory,
-            compute_pc_features=args.compute_pc_features,
-            compute_amplitudes=args.compute_amplitudes,
-            random_spikes_max=args.random_spikes_max,
-            pc_n_components=args.pc_n_components,
-            pc_mode=args.pc_mode,
-            spike_amp_peak_sign=args.spike_amp_peak_sign
-        )
+    recording_kwargs = recording_kwargs_from_args(args, probe_object, sort_params)
+
+    work_queue = None
+    if args.shared_queue:
+        work_queue = WorkQueue(os.path.join(args.output_folder, "work_queue"), args.data_folder,
+                               lease_seconds=args.lease_seconds)
+        recording_kwargs["work_queue"] = work_queue
+        print(f"Sharing the batch through {work_queue.folder} as worker {work_queue.worker_id} "
+              f"({len(work_queue.active_leases())} recording(s) currently claimed).")
+
+    # Drop recordings whose outputs are up to date before any heavy module is imported.
+    attempted = set()
+    first_pass = True
+    keep_leases = LeaseKeeper(work_queue) if work_queue is not None else contextlib.nullcontext()
+    try:
+        with keep_leases:
+            while True:
+                pending_files = select_pending_recordings([f for f in recording_files if f not in attempted],
+                                                          recording_kwargs, manifest)
+                if first_pass:
+                    first_pass = False
+                    print(f"Startup took {time.perf_counter() - _STARTUP_T0:.2f} s ({_IMPORT_SECONDS:.2f} s of module "
+                          f"imports); {len(pending_files)} of {len(recording_files)} recording(s) need processing.")
+                plans = resources = None
+                if pending_files and (args.auto_resources or args.dry_run):
+                    plans, resources = plan_recordings(pending_files, recording_kwargs, args)
+                    if args.dry_run:
+                        if not args.auto_resources:
+                            print("Dry run: this plan is applied with --auto-resources.")
+                        return
+                    refused = [f for f in pending_files if plans[f]["action"] == "refuse"]
+                    for rec_file in refused:
+                        print(f"Not starting {os.path.basename(rec_file)}: {plans[rec_file]['reason']}.")
+                    # Refused recordings stay 'new' in the manifest and are planned again next time.
+                    attempted.update(refused)
+                    pending_files = [f for f in pending_files if f not in refused]
+                if pending_files:
+                    statuses = process_batch(pending_files, recording_kwargs, args, plans, resources)
+                    # Recordings claimed by another worker are retried on later passes, in case
+                    # that worker dies and its lease expires.
+                    attempted.update(rec_file for rec_file in pending_files if statuses.get(rec_file) != "claimed")
+                    if manifest is not None:
+                        for rec_file, status in statuses.items():
+                            if status == "claimed":
+                                continue
+                            phy_key = None
+                            if status != "failed":
+                                job = make_recording_job(rec_file, **recording_kwargs)
+                                job["fingerprint"] = manifest.fingerprint(rec_file)
+                                phy_key = compute_stage_keys(job)["phy"]
+                            manifest.set_status(rec_file, status, phy_key)
+                if manifest is not None:
+                    manifest.save()
+                if not args.watch:
+                    break
+                # Later scans only pick up new recordings and recordings claimed elsewhere; failed
+                # ones are not retried until the next start.
+                time.sleep(args.watch_interval)
+                recording_files = scan_data_folder(manifest, exclude=FINAL_STATUSES) if manifest is not None else []
+    finally:
+        if manifest is not None:
+            manifest.save()
+    if not attempted:
+        return
 
     print("\nBatch processing complete. SPIKES ARE SORTED! :)")
 
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Synthetic-data benchmark for the app.py pipeline (CPU only).
+
+Every benchmark case generates a ground-truth recording with spikeinterface, writes it
+to a Trodes-style .rec file and runs the full app.py pipeline on it on the CPU. The
+per-stage metrics (see metrics.py) are turned into throughput numbers (samples/s,
+spikes/s) and the sorter output is compared against the ground truth, so a speed-up
+that hurts sorting quality is visible in the same report.
+
+Results are written as JSON tagged with the git commit, and two result files can be
+compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import itertools
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from rec_reader import write_synthetic_rec
+
+# The synthetic .rec files use the Trodes scaling of 0.195 uV per bit.
+REC_GAIN_TO_UV = 0.195
+DEFAULT_PRB_FILE = Path(__file__).parent / "nancyprobe_linearprobelargespace.prb"
+
+def git_revision():
+    """
+    Commit hash of the working tree (with a '-dirty' suffix for uncommitted changes), or None.
+    """
+    repo_dir = str(Path(__file__).parent)
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir,
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir,
+                                        stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+def make_probe_group(num_channels, prb_file=DEFAULT_PRB_FILE):
+    """
+    Probe used for a benchmark case: the geometry from prb_file when it has num_channels
+    contacts (the 32-channel default probe), otherwise a linear probe with a 20 um pitch.
+    """
+    from probeinterface import ProbeGroup, read_prb, generate_linear_probe
+
+    if prb_file is not None and Path(prb_file).exists():
+        probe_group = read_prb(str(prb_file))
+        if probe_group.get_contact_count() == num_channels:
+            return probe_group, Path(prb_file).stem
+    probe = generate_linear_probe(num_elec=num_channels, ypitch=20)
+    probe.set_device_channel_indices(np.arange(num_channels))
+    probe_group = ProbeGroup()
+    probe_group.add_probe(probe)
+    return probe_group, f"linear_{num_channels}ch"
+
+class _Int16Traces:
+    """
+    Read-only (num_samples, num_channels) view of a recording, scaled to .rec counts
+    chunk by chunk, so write_synthetic_rec never holds the whole recording in memory.
+    """
+    def __init__(self, recording):
+        self.recording = recording
+        self.shape = (recording.get_num_samples(), recording.get_num_channels())
+
+    def __getitem__(self, frames):
+        traces = self.recording.get_traces(start_frame=frames.start, end_frame=frames.stop)
+        return np.clip(np.round(traces / REC_GAIN_TO_UV), -32768, 32767).astype("int16")
+
+def generate_case(rec_file, probe_group, duration, firing_rate, num_units, sampling_frequency,
+                  noise_level, seed):
+    """
+    Generate a ground-truth recording for one case and write it to rec_file.
+    Returns the ground-truth sorting.
+    """
+    import spikeinterface as si
+
+    # Generated channel k is written to .rec channel k, so order the contacts by the
+    # channel they are wired to.
+    probe = probe_group.probes[0]
+    probe = probe.get_slice(np.argsort(probe.device_channel_indices))
+    probe.set_device_channel_indices(np.arange(probe.get_contact_count()))
+
+    recording, gt_sorting = si.generate_ground_truth_recording(
+        durations=[duration],
+        sampling_frequency=sampling_frequency,
+        num_units=num_units,
+        probe=probe,
+        generate_sorting_kwargs={"firing_rates": firing_rate, "refractory_period_ms": 4.0},
+        noise_kwargs={"noise_levels": noise_level, "strategy": "on_the_fly"},
+        seed=seed,
+    )
+    write_synthetic_rec(rec_file, num_channels=recording.get_num_channels(),
+                        sampling_frequency=sampling_frequency, traces=_Int16Traces(recording))
+    return gt_sorting
+
+def sorting_accuracy(gt_sorting, sorting):
+    """
+    Compare a sorter output against the ground truth.
+    """
+    import spikeinterface.comparison as sc
+
+    comparison = sc.compare_sorter_to_ground_truth(gt_sorting, sorting, exhaustive_gt=True)
+    performance = comparison.get_performance(method="pooled_with_average")
+    return {
+        "num_gt_units": len(gt_sorting.unit_ids),
+        "num_sorted_units": len(sorting.unit_ids),
+        "accuracy": round(float(performance["accuracy"]), 4),
+        "recall": round(float(performance["recall"]), 4),
+        "precision": round(float(performance["precision"]), 4),
+        "num_well_detected": len(comparison.get_well_detected_units(well_detected_score=0.8)),
+        "num_false_positive": comparison.count_false_positive_units(),
+        "num_redundant": comparison.count_redundant_units(),
+        "num_overmerged": comparison.count_overmerged_units(),
+    }
+
+def stage_throughput(stages, num_samples, num_channels, gt_spikes, sorted_spikes):
+    """
+    Add samples/s and spikes/s to the stage records from metrics.json. Stages up to and
+    including sorting are measured against the ground-truth spikes, the post-processing
+    stages against the spikes the sorter found.
+    """
+    results = []
+    for record in stages:
+        record = dict(record)
+        wall_s = record.get("wall_s") or 0.0
+        spikes = gt_spikes if record["stage"] in ("preprocessing", "sorting") else sorted_spikes
+        if wall_s > 0:
+            record["samples_per_s"] = round(num_samples * num_channels / wall_s, 1)
+            record["spikes_per_s"] = round(spikes / wall_s, 1) if spikes is not None else None
+        results.append(record)
+    return results
+
+def run_case(work_dir, num_channels, duration, firing_rate, args):
+    """
+    Generate one case, run the app.py pipeline on it and collect its results.
+    """
+    import spikeinterface as si
+    import app
+
+    probe_group, probe_name = make_probe_group(num_channels, args.prb_file)
+    name = f"{probe_name}_{duration:g}s_{firing_rate:g}Hz"
+    case_dir = Path(work_dir) / name
+    os.makedirs(case_dir, exist_ok=True)
+    rec_file = case_dir / f"{name}.merged.rec"
+    output_folder = case_dir / "output"
+    print(f"\n=== Benchmark case {name} ===")
+
+    start = time.perf_counter()
+    gt_sorting = generate_case(rec_file, probe_group, duration, firing_rate, args.num_units,
+                               args.sampling_frequency, args.noise_level, args.seed)
+    generate_s = time.perf_counter() - start
+    gt_spikes = int(sum(len(gt_sorting.get_unit_spike_train(u)) for u in gt_sorting.unit_ids))
+
+    start = time.perf_counter()
+    status = app.process_recording(
+        recording_file=str(rec_file), output_folder=str(output_folder), probe_object=probe_group,
+        sort_params={}, stream_id="trodes", freq_min=args.freq_min, freq_max=args.freq_max,
+        whiten_dtype=args.whiten_dtype, force_cpu=True, ms_before=args.ms_before, ms_after=args.ms_after,
+        n_jobs=args.n_jobs, total_memory=args.total_memory, compute_pc_features=True, compute_amplitudes=True,
+        random_spikes_max=args.max_spikes_per_unit, pc_n_components=args.pc_n_components, pc_mode="by_channel_local",
+        spike_amp_peak_sign="neg", profile_stages=args.profile_stages, quantize=args.quantize
+    )
+    total_s = time.perf_counter() - start
+
+    job = app.make_recording_job(str(rec_file), str(output_folder))
+    try:
+        with open(job["metrics_path"], "r") as f:
+            stages = json.load(f)["stages"]
+    except (OSError, ValueError):
+        stages = []
+
+    accuracy = None
+    sorted_spikes = None
+    sorting_dir = job["ss_output_dir"] / "sorting"
+    if sorting_dir.exists():
+        sorting = si.load_extractor(sorting_dir)
+        sorted_spikes = int(sum(len(sorting.get_unit_spike_train(u)) for u in sorting.unit_ids))
+        accuracy = sorting_accuracy(gt_sorting, sorting)
+
+    num_samples = int(duration * args.sampling_frequency)
+    result = {
+        "name": name,
+        "status": status,
+        "dataset": {
+            "probe": probe_name,
+            "num_channels": num_channels,
+            "duration_s": duration,
+            "sampling_frequency": args.sampling_frequency,
+            "num_units": args.num_units,
+            "firing_rate_hz": firing_rate,
+            "noise_level_uv": args.noise_level,
+            "num_gt_spikes": gt_spikes,
+            "rec_file_bytes": os.path.getsize(rec_file),
+        },
+        "generate_s": round(generate_s, 3),
+        "total_wall_s": round(total_s, 3),
+        "samples_per_s": round(num_samples * num_channels / total_s, 1),
+        "stages": stage_throughput(stages, num_samples, num_channels, gt_spikes, sorted_spikes),
+        "accuracy": accuracy,
+    }
+    print_case(result)
+    return result
+
+def print_case(result):
+    print(f"\nCase {result['name']}: {result['status']}, {result['total_wall_s']:.1f} s total "
+          f"({result['samples_per_s'] / 1e6:.2f} M samples/s)")
+    print(f"{'stage':<22}{'wall_s':>9}{'cpu_s':>9}{'peak_rss_mb':>13}{'Msamples/s':>12}{'spikes/s':>12}")
+    for record in result["stages"]:
+        spikes_per_s = record.get("spikes_per_s")
+        print(f"{record['stage']:<22}{record.get('wall_s', 0):>9.2f}{record.get('cpu_s', 0):>9.2f}"
+              f"{record.get('peak_rss_mb', 0):>13.0f}{record.get('samples_per_s', 0) / 1e6:>12.2f}"
+              f"{spikes_per_s if spikes_per_s is not None else '-':>12}")
+    for record in result["stages"]:
+        if "quantization" in record:
+            quantization = record["quantization"]
+            print(f"int16 quantization error: RMS {quantization['rms_error_rel_std_mean']:.2e} of the channel std "
+                  f"(max {quantization['max_abs_error_rel_std']:.2e}), {quantization['snr_db']:.1f} dB SNR, "
+                  f"{quantization['clipped_fraction']:.1e} clipped.")
+    accuracy = result["accuracy"]
+    if accuracy:
+        print(f"Accuracy {accuracy['accuracy']:.3f}, recall {accuracy['recall']:.3f}, "
+              f"precision {accuracy['precision']:.3f}; {accuracy['num_well_detected']}/{accuracy['num_gt_units']} "
+              f"units well detected, {accuracy['num_false_positive']} false positive.")
+
+def compare_results(baseline_path, candidate_path):
+    """
+    Print the per-stage wall time and accuracy change between two result files.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    with open(candidate_path, "r") as f:
+        candidate = json.load(f)
+    print(f"Baseline:  {baseline.get('git_revision')} ({baseline.get('timestamp')})")
+    print(f"Candidate: {candidate.get('git_revision')} ({candidate.get('timestamp')})")
+
+    baseline_cases = {case["name"]: case for case in baseline["cases"]}
+    for case in candidate["cases"]:
+        base = baseline_cases.get(case["name"])
+        if base is None:
+            print(f"\n{case['name']}: not in baseline.")
+            continue
+        print(f"\n{case['name']}:")
+        print(f"{'stage':<22}{'baseline_s':>12}{'candidate_s':>13}{'speed-up':>10}")
+        base_stages = {record["stage"]: record for record in base["stages"]}
+        rows = [(record["stage"], base_stages.get(record["stage"], {}).get("wall_s"), record.get("wall_s"))
+                for record in case["stages"]]
+        rows.append(("total", base["total_wall_s"], case["total_wall_s"]))
+        for stage, base_s, cand_s in rows:
+            if base_s is None or not cand_s:
+                print(f"{stage:<22}{'-':>12}{cand_s or 0:>13.2f}{'-':>10}")
+            else:
+                print(f"{stage:<22}{base_s:>12.2f}{cand_s:>13.2f}{base_s / cand_s:>9.2f}x")
+        if base.get("accuracy") and case.get("accuracy"):
+            for metric in ("accuracy", "recall", "precision", "num_well_detected"):
+                print(f"{metric}: {base['accuracy'][metric]} -> {case['accuracy'][metric]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the spike sorting pipeline on synthetic ground-truth data (CPU only).")
+    parser.add_argument("--num-channels", type=int, nargs="+", default=[32],
+                        help="Channel counts to benchmark. A count matching --prb-file uses its geometry, "
+                             "others use a linear probe (default: 32).")
+    parser.add_argument("--durations", type=float, nargs="+", default=[60.0],
+                        help="Recording durations in seconds (default: 60).")
+    parser.add_argument("--firing-rates", type=float, nargs="+", default=[5.0],
+                        help="Mean unit firing rates in Hz (default: 5).")
+    parser.add_argument("--num-units", type=int, default=20,
+                        help="Ground-truth units per recording (default: 20).")
+    parser.add_argument("--sampling-frequency", type=float, default=30000.0,
+                        help="Sampling frequency in Hz (default: 30000).")
+    parser.add_argument("--noise-level", type=float, default=5.0,
+                        help="Noise standard deviation in uV (default: 5).")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for the generated recordings (default: 0).")
+    parser.add_argument("--prb-file", type=str, default=str(DEFAULT_PRB_FILE),
+                        help="Probe geometry for matching channel counts (default: the 32-channel default probe).")
+    parser.add_argument("--freq-min", type=float, default=300,
+                        help="Minimum frequency for bandpass filter (default: 300).")
+    parser.add_argument("--freq-max", type=float, default=6000,
+                        help="Maximum frequency for bandpass filter (default: 6000).")
+    parser.add_argument("--whiten-dtype", type=str, default="float32",
+                        help="Data type for whitening (default: float32).")
+    parser.add_argument("--ms-before", type=float, default=1.0,
+                        help="Time (ms) before a spike for waveform extraction (default: 1.0).")
+    parser.add_argument("--ms-after", type=float, default=2.0,
+                        help="Time (ms) after a spike for waveform extraction (default: 2.0).")
+    parser.add_argument("--max-spikes-per-unit", type=int, default=500,
+                        help="Maximum spikes per unit for waveform extraction (default: 500).")
+    parser.add_argument("--pc-n-components", type=int, default=5,
+                        help="Number of principal components (default: 5).")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Store the preprocessed recording as int16 and report the quantization error (see app.py).")
+    parser.add_argument("--n-jobs", type=int, default=os.cpu_count(),
+                        help="Number of jobs for parallel stages (default: all cores).")
+    parser.add_argument("--total-memory", type=str, default="1G",
+                        help="Chunk memory for parallel stages (default: 1G).")
+    parser.add_argument("--profile-stages", type=str, default=None, choices=["cprofile", "py-spy"],
+                        help="Profile every stage (see app.py).")
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="Folder for the generated recordings and outputs (default: a temporary folder that is removed).")
+    parser.add_argument("--results-dir", type=str, default="benchmark_results",
+                        help="Folder for the JSON results (default: benchmark_results).")
+    parser.add_argument("--compare", type=str, nargs=2, default=None, metavar=("BASELINE", "CANDIDATE"),
+                        help="Compare two result files instead of running the benchmark.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    # The benchmark is CPU only, also for sorters that would pick up a GPU on their own.
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    report = {
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": socket.gethostname(),
+        "cpu_count": os.cpu_count(),
+        "python": sys.version.split()[0],
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("work_dir", "results_dir", "compare")},
+        "cases": [],
+    }
+    cases = list(itertools.product(args.num_channels, args.durations, args.firing_rates))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        for num_channels, duration, firing_rate in cases:
+            report["cases"].append(run_case(work_dir, num_channels, duration, firing_rate, args))
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    revision = (report["git_revision"] or "nogit")[:12]
+    results_path = Path(args.results_dir) / f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}_{revision}.json"
+    with open(results_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nBenchmark results saved to: {results_path}")
+
+if __name__ == '__main__':
+    import multiprocessing as mp
+    mp.set_start_method('fork', force=True)
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Bulk quality metrics and threshold auto-curation of a sorting, for app.py.
+
+The metrics are computed for all units at once from the concatenated spike vector,
+sorted by unit and time, with bincount/searchsorted-style array operations instead of a
+Python loop per unit:
+
+    firing_rate            spikes per second over the whole recording
+    isi_violations_ratio   refractory period violation ratio (Hill et al. 2011), as spikeinterface
+    presence_ratio         fraction of 60 s bins with at least one spike
+    amplitude_cutoff       estimated fraction of spikes missing below the detection threshold
+    snr                    peak amplitude of the unit's mean waveform over the noise level of its channel
+
+The mean waveforms are estimated from a seeded subset of at most 100 spikes per unit.
+Every spike's amplitude is then read directly from the trace on its unit's peak channel
+at the unit's peak lag, from the memory-mapped preprocessed binary when possible, in
+parallel blocks. No waveforms or templates are
+needed, so curation runs right after sorting and units that fail a threshold never
+reach the waveform, PC and Phy export stages (mode 'drop'), or are only labelled
+'noise' in Phy (mode 'label').
+"""
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+METRICS = ("firing_rate", "isi_violations_ratio", "presence_ratio", "amplitude_cutoff", "snr")
+# Unit properties written by curate_sorting, exported to Phy as cluster_<name>.tsv.
+QC_PROPERTIES = list(METRICS) + ["qc_label"]
+# Rules are <metric>_min / <metric>_max; None disables a rule. A metric that cannot be
+# computed (e.g. the amplitude cutoff of a unit with few spikes) never fails a rule.
+DEFAULT_THRESHOLDS = {
+    "firing_rate_min": 0.1,
+    "isi_violations_ratio_max": 0.5,
+    "presence_ratio_min": 0.8,
+    "amplitude_cutoff_max": 0.1,
+    "snr_min": 3.0,
+}
+ISI_THRESHOLD_MS = 1.5
+PRESENCE_BIN_S = 60.0
+PEAK_WINDOW_MS = 0.4
+PEAK_CHANNEL_SPIKES = 100
+CUTOFF_BINS = 500
+CUTOFF_SMOOTHING = 3
+CUTOFF_MIN_RATIO = 5
+
+def parse_thresholds(text):
+    """
+    Curation thresholds: the defaults updated with a JSON object of rules.
+    Raises ValueError for malformed JSON or unknown rules.
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    overrides = json.loads(text) if text else {}
+    for rule, value in overrides.items():
+        metric, _, bound = rule.rpartition("_")
+        if metric not in METRICS or bound not in ("min", "max"):
+            raise ValueError(f"Unknown curation rule '{rule}' (use <metric>_min or <metric>_max with "
+                             f"metric one of {', '.join(METRICS)}).")
+        thresholds[rule] = value
+    return thresholds
+
+def gather_traces(recording, segment_index, samples, channels=None, n_jobs=1, block_size=65536):
+    """
+    Trace values at the given (sorted) sample indices of one segment: all channels
+    (shape (n, num_channels)) or one channel per sample (shape (n,)). Binary recordings
+    are memory-mapped, so only the pages holding the samples are read; other formats
+    are read chunk by chunk. Values are scaled when the recording has gains (int16).
+    """
+    num_samples = recording.get_num_samples(segment_index)
+    samples = np.clip(np.asarray(samples, dtype=np.int64), 0, num_samples - 1)
+    scaled = recording.has_scaleable_traces()
+    gains = recording.get_channel_gains() if scaled else None
+    offsets = recording.get_channel_offsets() if scaled else None
+
+    if recording.binary_compatible_with(time_axis=0):
+        description = recording.get_binary_description()
+        traces = np.memmap(description["file_paths"][segment_index], dtype=description["dtype"], mode="r",
+                           offset=description["file_offset"], shape=(num_samples, description["num_channels"]))
+
+        def read(block):
+            rows = samples[block]
+            return traces[rows] if channels is None else traces[rows, channels[block]]
+    else:
+        chunk_size = int(recording.sampling_frequency)
+
+        def read(block):
+            rows = samples[block]
+            out = []
+            # Samples are sorted, so each chunk that holds any of them is read once.
+            chunk_ids = rows // chunk_size
+            bounds = np.flatnonzero(np.diff(chunk_ids)) + 1
+            for part in np.split(np.arange(len(rows)), bounds):
+                if len(part) == 0:
+                    continue
+                start = int(chunk_ids[part[0]] * chunk_size)
+                chunk = recording.get_traces(segment_index=segment_index, start_frame=start,
+                                             end_frame=min(start + chunk_size, num_samples), return_scaled=False)
+                local = rows[part] - start
+                out.append(chunk[local] if channels is None else chunk[local, channels[block][part]])
+            return np.concatenate(out)
+
+    # Blocks are read in parallel threads; numpy releases the GIL while copying from the memmap.
+    blocks = [slice(start, start + block_size) for start in range(0, len(samples), block_size)]
+    if n_jobs > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(read, blocks))
+    else:
+        parts = [read(block) for block in blocks]
+    values = np.concatenate(parts).astype(np.float32) if parts else np.zeros(0, np.float32)
+    if scaled:
+        if channels is None:
+            values = values * gains.astype(np.float32) + offsets.astype(np.float32)
+        else:
+            values = values * gains[channels].astype(np.float32) + offsets[channels].astype(np.float32)
+    return values
+
+def _spike_amplitudes(recording, spikes, num_units, peak_sign, n_jobs, seed):
+    """
+    Peak channel, peak lag and peak amplitude of every unit's mean waveform (estimated
+    from a subset of its spikes within +-PEAK_WINDOW_MS), and the amplitude of every
+    spike: the trace value on its unit's peak channel at its unit's peak lag.
+    """
+    half_window = max(1, int(round(PEAK_WINDOW_MS * recording.sampling_frequency / 1000)))
+    offsets_in_window = np.arange(-half_window, half_window + 1)
+    num_channels = recording.get_num_channels()
+    unit_indices = spikes["unit_index"]
+
+    # Seeded subset of at most PEAK_CHANNEL_SPIKES spikes per unit: rank spikes within
+    # their unit by a random priority and keep the lowest ranks.
+    rng = np.random.default_rng(seed)
+    priority = rng.random(len(spikes))
+    by_priority = np.lexsort((priority, unit_indices))
+    unit_starts = np.searchsorted(unit_indices[by_priority], np.arange(num_units))
+    rank = np.arange(len(spikes)) - unit_starts[unit_indices[by_priority]]
+    subset = np.sort(by_priority[rank < PEAK_CHANNEL_SPIKES])
+
+    mean_snippets = np.zeros((num_units, len(offsets_in_window), num_channels), dtype=np.float64)
+    for segment_index in range(recording.get_num_segments()):
+        in_segment = subset[spikes["segment_index"][subset] == segment_index]
+        if len(in_segment) == 0:
+            continue
+        rows = (spikes["sample_index"][in_segment][:, None] + offsets_in_window[None, :]).ravel()
+        order = np.argsort(rows, kind="stable")
+        values = np.empty((len(rows), num_channels), dtype=np.float32)
+        values[order] = gather_traces(recording, segment_index, rows[order], n_jobs=n_jobs)
+        np.add.at(mean_snippets, unit_indices[in_segment],
+                  values.reshape(len(in_segment), len(offsets_in_window), num_channels))
+    subset_counts = np.maximum(np.bincount(unit_indices[subset], minlength=num_units), 1)
+    mean_snippets /= subset_counts[:, None, None]
+    flat = mean_snippets.reshape(num_units, -1)
+    if peak_sign == "neg":
+        peak_index = flat.argmin(axis=1)
+    elif peak_sign == "pos":
+        peak_index = flat.argmax(axis=1)
+    else:
+        peak_index = np.abs(flat).argmax(axis=1)
+    peak_amplitudes = flat[np.arange(num_units), peak_index]
+    peak_lags = offsets_in_window[peak_index // num_channels]
+    peak_channels = peak_index % num_channels
+
+    amplitudes = np.empty(len(spikes), dtype=np.float32)
+    for segment_index in range(recording.get_num_segments()):
+        in_segment = np.flatnonzero(spikes["segment_index"] == segment_index)
+        if len(in_segment) == 0:
+            continue
+        rows = spikes["sample_index"][in_segment] + peak_lags[unit_indices[in_segment]]
+        order = np.argsort(rows, kind="stable")
+        channels = peak_channels[unit_indices[in_segment]][order]
+        amplitudes[in_segment[order]] = gather_traces(recording, segment_index, rows[order], channels=channels,
+                                                      n_jobs=n_jobs)
+    return peak_channels, peak_amplitudes, amplitudes
+
+def _amplitude_cutoffs(amplitudes, unit_sorted, counts, peak_sign):
+    """
+    Amplitude cutoff of all units from one batched (units x bins) histogram; same
+    definition as spikeinterface's amplitude_cutoff.
+    """
+    from scipy.ndimage import gaussian_filter1d
+
+    num_units = len(counts)
+    values = amplitudes[unit_sorted].astype(np.float64)
+    values = -values if peak_sign == "neg" else (np.abs(values) if peak_sign == "both" else values)
+    unit_of_spike = np.repeat(np.arange(num_units), counts)
+    has_spikes = counts > 0
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    unit_min = np.full(num_units, np.nan)
+    unit_max = np.full(num_units, np.nan)
+    unit_min[has_spikes] = np.minimum.reduceat(values, starts[has_spikes])
+    unit_max[has_spikes] = np.maximum.reduceat(values, starts[has_spikes])
+    width = (unit_max - unit_min) / CUTOFF_BINS
+    valid = has_spikes & (counts / CUTOFF_BINS >= CUTOFF_MIN_RATIO) & (width > 0)
+
+    cutoffs = np.full(num_units, np.nan)
+    if not valid.any():
+        return cutoffs
+    spike_valid = valid[unit_of_spike]
+    bins = np.floor((values[spike_valid] - unit_min[unit_of_spike[spike_valid]])
+                    / width[unit_of_spike[spike_valid]]).astype(np.int64)
+    bins = np.clip(bins, 0, CUTOFF_BINS - 1)
+    histograms = np.bincount(unit_of_spike[spike_valid] * CUTOFF_BINS + bins,
+                             minlength=num_units * CUTOFF_BINS).reshape(num_units, CUTOFF_BINS)[valid]
+    smoothed = gaussian_filter1d(histograms.astype(np.float64), CUTOFF_SMOOTHING, axis=1)
+    peak = smoothed.argmax(axis=1)
+    columns = np.arange(CUTOFF_BINS)[None, :]
+    distance = np.where(columns >= peak[:, None], np.abs(smoothed - smoothed[:, :1]), np.inf)
+    lowest = distance.argmin(axis=1)
+    tail = np.cumsum(smoothed[:, ::-1], axis=1)[:, ::-1]
+    cutoffs[valid] = np.minimum(tail[np.arange(len(lowest)), lowest] / counts[valid], 0.5)
+    return cutoffs
+
+def compute_quality_metrics(sorting, recording, peak_sign="neg", n_jobs=1, seed=0):
+    """
+    All quality metrics of all units. Returns a dict of per-unit arrays (in the order of
+    sorting.unit_ids), plus 'peak_channel'.
+    """
+    from spikeinterface.core import get_noise_levels
+
+    unit_ids = sorting.unit_ids
+    num_units = len(unit_ids)
+    sampling_frequency = recording.sampling_frequency
+    segment_lengths = np.array([recording.get_num_samples(segment_index)
+                                for segment_index in range(recording.get_num_segments())], dtype=np.int64)
+    duration_s = segment_lengths.sum() / sampling_frequency
+
+    spikes = sorting.to_spike_vector()
+    unit_indices = spikes["unit_index"].astype(np.int64)
+    counts = np.bincount(unit_indices, minlength=num_units)
+    # Spikes ordered by unit, then segment, then time: every unit is one contiguous run.
+    unit_sorted = np.lexsort((spikes["sample_index"], spikes["segment_index"], unit_indices))
+    sorted_units = unit_indices[unit_sorted]
+    sorted_segments = spikes["segment_index"][unit_sorted]
+    sorted_samples = spikes["sample_index"][unit_sorted].astype(np.int64)
+
+    firing_rate = counts / duration_s
+
+    # ISI violations: consecutive spikes of the same unit in the same segment closer than the threshold.
+    same_train = (sorted_units[1:] == sorted_units[:-1]) & (sorted_segments[1:] == sorted_segments[:-1])
+    isis = np.diff(sorted_samples)
+    violating = same_train & (isis < ISI_THRESHOLD_MS / 1000 * sampling_frequency)
+    num_violations = np.bincount(sorted_units[1:][violating], minlength=num_units)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        violation_rate = num_violations / (2 * counts * ISI_THRESHOLD_MS / 1000)
+        isi_violations_ratio = np.where(counts > 0, violation_rate / firing_rate, np.nan)
+
+    # Presence ratio over bins of PRESENCE_BIN_S spanning all segments.
+    bin_samples = int(PRESENCE_BIN_S * sampling_frequency)
+    bins_per_segment = np.maximum(1, segment_lengths // bin_samples)
+    segment_bin_starts = np.concatenate([[0], np.cumsum(bins_per_segment)[:-1]])
+    num_bins = int(bins_per_segment.sum())
+    bins = segment_bin_starts[sorted_segments] + np.minimum(sorted_samples // bin_samples,
+                                                            bins_per_segment[sorted_segments] - 1)
+    occupied = np.unique(sorted_units * num_bins + bins)
+    presence_ratio = np.bincount(occupied // num_bins, minlength=num_units) / num_bins
+
+    peak_channels, peak_amplitudes, amplitudes = _spike_amplitudes(recording, spikes, num_units, peak_sign,
+                                                                   n_jobs=n_jobs, seed=seed)
+    amplitude_cutoff = _amplitude_cutoffs(amplitudes, unit_sorted, counts, peak_sign)
+
+    noise_levels = get_noise_levels(recording, return_scaled=recording.has_scaleable_traces(),
+                                    random_slices_kwargs={"seed": seed})
+    snr = np.where(counts > 0, np.abs(peak_amplitudes) / noise_levels[peak_channels], np.nan)
+
+    return {
+        "num_spikes": counts,
+        "firing_rate": firing_rate,
+        "isi_violations_ratio": isi_violations_ratio,
+        "presence_ratio": presence_ratio,
+        "amplitude_cutoff": amplitude_cutoff,
+        "snr": snr,
+        "peak_channel": peak_channels,
+    }
+
+def apply_thresholds(metrics, thresholds):
+    """
+    Label every unit 'good' or 'noise'. Returns (labels, reasons) with the failed rules
+    of every unit joined by ','.
+    """
+    num_units = len(metrics["num_spikes"])
+    failed = [[] for _ in range(num_units)]
+    for rule, value in thresholds.items():
+        if value is None:
+            continue
+        metric, _, bound = rule.rpartition("_")
+        values = np.asarray(metrics[metric], dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            fails = values < value if bound == "min" else values > value
+        for unit_index in np.flatnonzero(fails):
+            failed[unit_index].append(rule)
+    # Units without spikes have no metric values, but are never worth keeping.
+    for unit_index in np.flatnonzero(metrics["num_spikes"] == 0):
+        failed[unit_index].append("num_spikes_min")
+    labels = ["noise" if reasons else "good" for reasons in failed]
+    return labels, [",".join(reasons) for reasons in failed]
+
+def write_metrics_table(path, unit_ids, metrics, labels, reasons):
+    """
+    Write the metrics and labels of all units as a TSV table.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write("\t".join(["unit_id", "num_spikes", *METRICS, "peak_channel", "label", "reason"]) + "\n")
+        for i, unit_id in enumerate(unit_ids):
+            row = [str(unit_id), str(int(metrics["num_spikes"][i]))]
+            row += [f"{metrics[name][i]:.6g}" for name in METRICS]
+            row += [str(int(metrics["peak_channel"][i])), labels[i], reasons[i]]
+            f.write("\t".join(row) + "\n")
+    os.replace(tmp_path, path)
+
+def read_metrics_table(path):
+    """
+    Read a table written by write_metrics_table. Returns a dict of columns keyed by
+    unit id string.
+    """
+    with open(path, "r") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    return {row[0]: dict(zip(header, row)) for row in rows}
+
+def curate_sorting(sorting, table, mode):
+    """
+    Apply a metrics table to a sorting: the metrics and labels become unit properties
+    (shown in Phy), and with mode 'drop' only the 'good' units are kept.
+    """
+    unit_rows = [table[str(unit_id)] for unit_id in sorting.unit_ids]
+    for name in METRICS:
+        sorting.set_property(name, np.array([float(row[name]) for row in unit_rows]))
+    sorting.set_property("qc_label", np.array([row["label"] for row in unit_rows]))
+    if mode == "drop":
+        keep = [unit_id for unit_id, row in zip(sorting.unit_ids, unit_rows) if row["label"] == "good"]
+        sorting = sorting.select_units(keep)
+    return sorting
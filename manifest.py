@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Persistent index of the recordings in a data folder, for app.py.
+
+A full recursive glob of a network share with tens of thousands of files takes minutes.
+The manifest remembers every directory's mtime together with its subdirectories and
+recordings; a directory whose mtime is unchanged (nothing was added, removed or renamed
+in it) is not listed again, only stat'ed. Every recording keeps its size, mtime,
+content fingerprint and processing status, so finished recordings are recognised
+without touching the output tree, and recordings that are still being written are
+held back until they have settled.
+"""
+import os
+import json
+import time
+import uuid
+import contextlib
+
+from stage_cache import fingerprint_file
+
+FINAL_STATUSES = ("complete", "skipped")
+# Fields a worker sets when it processes a recording; merged by their 'updated' time.
+STATUS_FIELDS = ("status", "phy_key", "updated")
+# A lock file older than this is left over from a worker that died while saving.
+LOCK_STALE_SECONDS = 60.0
+
+@contextlib.contextmanager
+def _file_lock(lock_path, poll_interval=0.05):
+    """
+    Hold an O_EXCL lock file next to the manifest while it is read, merged and replaced.
+    """
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > LOCK_STALE_SECONDS:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll_interval)
+    os.close(fd)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+class RecordingManifest:
+    """
+    Recordings below data_folder whose file name ends with suffix, stored as JSON in path.
+    Status values: 'new' (not processed yet), 'complete', 'skipped' (no units) and 'failed'.
+    """
+    def __init__(self, path, data_folder, suffix="merged.rec", settle_seconds=30.0):
+        self.path = str(path)
+        self.data_folder = os.path.abspath(data_folder)
+        self.suffix = suffix
+        self.settle_seconds = settle_seconds
+        self.dirs = {}
+        self.recordings = {}
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("data_folder") == self.data_folder:
+                self.dirs = data.get("dirs", {})
+                self.recordings = data.get("recordings", {})
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        """
+        Write the manifest. Workers sharing it (--shared-queue) save under a lock file and
+        merge: for every recording, the status set most recently by any worker is kept,
+        so no worker overwrites the others' results.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with _file_lock(f"{self.path}.lock"):
+            self._merge_saved()
+            # Workers in different containers can share the output folder (and have equal pids).
+            tmp_path = f"{self.path}.tmp{uuid.uuid4().hex}"
+            with open(tmp_path, "w") as f:
+                json.dump({"data_folder": self.data_folder, "dirs": self.dirs, "recordings": self.recordings}, f)
+            os.replace(tmp_path, self.path)
+
+    def _merge_saved(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("data_folder") != self.data_folder:
+            return
+        for rec_path, saved in data.get("recordings", {}).items():
+            entry = self.recordings.get(rec_path)
+            if entry is not None and saved.get("updated", 0) > entry.get("updated", 0):
+                for field in STATUS_FIELDS:
+                    if field in saved:
+                        entry[field] = saved[field]
+                    else:
+                        entry.pop(field, None)
+
+    def refresh(self):
+        """
+        Bring the manifest up to date with the data folder. Returns scan statistics.
+        """
+        start = time.perf_counter()
+        stats = {"dirs_listed": 0, "dirs_reused": 0, "new": 0, "changed": 0, "removed": 0}
+        seen_dirs = {}
+        pending = [self.data_folder]
+        visited = set()
+        while pending:
+            dir_path = pending.pop()
+            try:
+                st = os.stat(dir_path)
+            except OSError:
+                continue
+            # Symlinked directories are followed like glob does, but only once.
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            cached = self.dirs.get(dir_path)
+            if cached is not None and cached["mtime_ns"] == st.st_mtime_ns:
+                stats["dirs_reused"] += 1
+                listed = False
+            else:
+                cached = self._list_dir(dir_path, st.st_mtime_ns)
+                stats["dirs_listed"] += 1
+                listed = True
+            seen_dirs[dir_path] = cached
+            pending.extend(os.path.join(dir_path, name) for name in cached["subdirs"])
+            for name in cached["recordings"]:
+                self._update_recording(os.path.join(dir_path, name), listed, stats)
+
+        # Forget directories and recordings that no longer exist.
+        self.dirs = seen_dirs
+        for rec_path in list(self.recordings):
+            dir_path, name = os.path.split(rec_path)
+            if dir_path not in seen_dirs or name not in seen_dirs[dir_path]["recordings"]:
+                del self.recordings[rec_path]
+                stats["removed"] += 1
+        stats["seconds"] = round(time.perf_counter() - start, 3)
+        return stats
+
+    def _list_dir(self, dir_path, mtime_ns):
+        subdirs, recordings = [], []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.name.endswith(self.suffix):
+                            recordings.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return {"mtime_ns": mtime_ns, "subdirs": sorted(subdirs), "recordings": sorted(recordings)}
+
+    def _update_recording(self, rec_path, listed, stats):
+        entry = self.recordings.get(rec_path)
+        # Finished recordings are only stat'ed again when their directory changed.
+        if entry is not None and entry["status"] in FINAL_STATUSES and not listed:
+            return
+        try:
+            st = os.stat(rec_path)
+        except OSError:
+            return
+        if entry is None:
+            self.recordings[rec_path] = {"size": st.st_size, "mtime": st.st_mtime, "status": "new",
+                                         "first_seen": time.time(), "growing": False}
+            stats["new"] += 1
+        elif entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+            # Changed since the previous refresh: possibly still being written.
+            entry.update(size=st.st_size, mtime=st.st_mtime, status="new", growing=True, updated=time.time())
+            entry.pop("fingerprint", None)
+            entry.pop("phy_key", None)
+            stats["changed"] += 1
+        else:
+            entry["growing"] = False
+
+    def settled_recordings(self, exclude=()):
+        """
+        Recordings that are no longer being written: not modified for settle_seconds and
+        unchanged since the previous refresh. Recordings with a status in exclude are left out.
+        """
+        now = time.time()
+        return [rec_path for rec_path, entry in sorted(self.recordings.items())
+                if entry["status"] not in exclude
+                and not entry.get("growing") and now - entry["mtime"] >= self.settle_seconds]
+
+    def still_writing(self):
+        """
+        Recordings held back because they are (possibly) still being written.
+        """
+        now = time.time()
+        return [rec_path for rec_path, entry in sorted(self.recordings.items())
+                if entry["status"] not in FINAL_STATUSES
+                and (entry.get("growing") or now - entry["mtime"] < self.settle_seconds)]
+
+    def fingerprint(self, rec_path):
+        """
+        Content fingerprint of a recording, cached until its size or mtime changes.
+        """
+        entry = self.recordings.setdefault(rec_path, {})
+        if "fingerprint" not in entry:
+            entry["fingerprint"] = fingerprint_file(rec_path)
+        return entry["fingerprint"]
+
+    def is_done(self, rec_path, phy_key):
+        """
+        True if the recording was completed (or skipped for having no units) with the
+        parameters that produce phy_key.
+        """
+        entry = self.recordings.get(rec_path)
+        return entry is not None and entry["status"] in FINAL_STATUSES and entry.get("phy_key") == phy_key
+
+    def set_status(self, rec_path, status, phy_key=None):
+        entry = self.recordings.get(rec_path)
+        if entry is None:
+            return
+        entry["status"] = status
+        entry["updated"] = time.time()
+        if phy_key is not None:
+            entry["phy_key"] = phy_key
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Per-stage performance instrumentation for app.py.
+
+stage_timer() records, for one stage of one recording: wall time, CPU time, peak RSS,
+bytes read and written, and the device used. The records are written to metrics.json
+in the recording's output folder and rolled up into a batch summary by main().
+Stages can optionally be profiled with cProfile or py-spy.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import resource
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+
+def _read_proc_io():
+    """
+    Bytes read/written by this process: 'rchar'/'wchar' count all read()/write() calls,
+    'read_bytes'/'write_bytes' only what actually hit storage (including memmap page faults).
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except (OSError, ValueError):
+        return {}
+
+def _reset_peak_rss():
+    # Linux lets a process reset its own RSS high-water mark (VmHWM).
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_bytes():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def _cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+@contextmanager
+def stage_timer(records, stage, device="cpu", profile=None, profile_dir=None):
+    """
+    Measure the enclosed block and append a metrics dict for it to records.
+
+    CPU time includes child processes (e.g. spikeinterface n_jobs workers) once they
+    have exited. Peak RSS is this process's high-water mark during the stage where the
+    kernel allows resetting it, otherwise the process-lifetime peak; the largest peak
+    among exited child processes is reported separately.
+
+    profile can be 'cprofile' (writes <stage>.prof) or 'py-spy' (writes <stage>.speedscope.json,
+    if py-spy is installed), stored in profile_dir.
+    """
+    profiler = _start_profiler(stage, profile, profile_dir)
+    peak_reset = _reset_peak_rss()
+    io_start = _read_proc_io()
+    cpu_start = _cpu_seconds()
+    wall_start = time.perf_counter()
+    record = {"stage": stage, "device": device, "status": "failed"}
+    try:
+        yield record
+        record["status"] = "ok"
+    finally:
+        record["wall_s"] = round(time.perf_counter() - wall_start, 3)
+        record["cpu_s"] = round(_cpu_seconds() - cpu_start, 3)
+        record["peak_rss_mb"] = round(_peak_rss_bytes() / 1024 ** 2, 1)
+        record["peak_rss_is_stage_peak"] = peak_reset
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        record["children_peak_rss_mb"] = round(children_rss * (1 if sys.platform == "darwin" else 1024) / 1024 ** 2, 1)
+        io_end = _read_proc_io()
+        for key in ("read_bytes", "write_bytes", "rchar", "wchar"):
+            if key in io_start and key in io_end:
+                record[key] = io_end[key] - io_start[key]
+        _stop_profiler(profiler)
+        records.append(record)
+
+def _start_profiler(stage, profile, profile_dir):
+    if not profile:
+        return None
+    os.makedirs(profile_dir, exist_ok=True)
+    if profile == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return ("cprofile", profiler, Path(profile_dir) / f"{stage}.prof")
+    if profile == "py-spy":
+        if shutil.which("py-spy") is None:
+            print("py-spy is not installed; stage profiling skipped.")
+            return None
+        output = Path(profile_dir) / f"{stage}.speedscope.json"
+        proc = subprocess.Popen(["py-spy", "record", "--pid", str(os.getpid()), "--subprocesses",
+                                 "--format", "speedscope", "--output", str(output)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return ("py-spy", proc, output)
+    print(f"Unknown profiler '{profile}'; stage profiling skipped.")
+    return None
+
+def _stop_profiler(profiler):
+    if profiler is None:
+        return
+    kind, handle, output = profiler
+    if kind == "cprofile":
+        handle.disable()
+        handle.dump_stats(str(output))
+    else:
+        # py-spy writes its report when interrupted.
+        handle.send_signal(signal.SIGINT)
+        try:
+            handle.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            handle.kill()
+    print(f"Stage profile saved to: {output}")
+
+def write_metrics(path, recording, records, status):
+    """
+    Write the stage records of one recording to a metrics.json file.
+    """
+    data = {
+        "recording": recording,
+        "status": status,
+        "written": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "total_wall_s": round(sum(r.get("wall_s", 0) for r in records), 3),
+        "stages": records,
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+    return data
+
+def _format_bytes(n_bytes):
+    if n_bytes is None:
+        return "-"
+    for unit in ("TB", "GB", "MB", "KB"):
+        scale = {"TB": 1e12, "GB": 1e9, "MB": 1e6, "KB": 1e3}[unit]
+        if n_bytes >= scale:
+            return f"{n_bytes / scale:.1f}{unit}"
+    return f"{n_bytes}B"
+
+def summarize_batch(metrics_files, summary_path=None):
+    """
+    Print a per-recording, per-stage table from metrics.json files and optionally
+    write it as a tab-separated file.
+    """
+    header = ["recording", "stage", "status", "device", "wall_s", "cpu_s", "peak_rss_mb", "read", "written"]
+    rows = []
+    for metrics_file in metrics_files:
+        try:
+            with open(metrics_file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for record in data.get("stages", []):
+            rows.append([data["recording"], record["stage"], record.get("status", ""), record.get("device", ""),
+                         f"{record.get('wall_s', 0):.1f}", f"{record.get('cpu_s', 0):.1f}",
+                         f"{record.get('peak_rss_mb', 0):.0f}",
+                         _format_bytes(record.get("rchar")), _format_bytes(record.get("wchar"))])
+    if not rows:
+        return rows
+
+    widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header))]
+    print("\nBatch performance summary:")
+    print("  ".join(name.ljust(width) for name, width in zip(header, widths)))
+    for row in rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+    totals = {}
+    for row in rows:
+        totals[row[1]] = totals.get(row[1], 0.0) + float(row[4])
+    print("Total wall time per stage: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in totals.items()))
+
+    if summary_path is not None:
+        with open(summary_path, "w") as f:
+            f.write("\t".join(header) + "\n")
+            for row in rows:
+                f.write("\t".join(str(value) for value in row) + "\n")
+        print(f"Batch summary saved to: {summary_path}")
+    return rows
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Stage-overlapped (pipelined) execution for app.py.
+
+Every stage of the per-recording pipeline runs in its own worker lane, with bounded
+queues between consecutive lanes. While the sorter lane works on recording N, the
+preprocessing lane can prepare recording N+1 and the post-processing lane can finish
+recording N-1, so the batch wall-clock time approaches the sum of sorter times.
+"""
+import os
+import queue
+import multiprocessing as mp
+
+def _lane_worker(lane_name, stage_fn, error_handler, in_queue, out_queue, events):
+    """
+    Lane process: take jobs from in_queue, run stage_fn on them and forward the result.
+    A None item is the shutdown sentinel. Errors are reported through the events queue
+    and the failed job is not forwarded, so it never reaches the downstream lanes.
+    """
+    pid = os.getpid()
+    while True:
+        job = in_queue.get()
+        if job is None:
+            break
+        name = job["recording_basename"]
+        events.put(("started", lane_name, name, pid))
+        try:
+            job = stage_fn(job)
+        except Exception as e:
+            events.put((error_handler(job, lane_name, e), lane_name, name, pid))
+            continue
+        if out_queue is None:
+            events.put(("complete", lane_name, name, pid))
+        else:
+            events.put(("forwarded", lane_name, name, pid))
+            out_queue.put(job)
+
+def run_pipeline(jobs, lanes, error_handler, queue_depth=1, poll_interval=1.0, release=None):
+    """
+    Push jobs through a chain of lanes.
+
+    lanes is an ordered list of (lane_name, stage_fn, n_workers). stage_fn takes a job
+    dict (which must contain 'recording_basename') and returns the job dict handed to the
+    next lane; it must be picklable, since each lane runs in separate processes.
+    error_handler(job, lane_name, exception) prints the error and returns the status to
+    record ('failed' or 'skipped').
+
+    The queue between two lanes holds at most queue_depth jobs, which bounds how many
+    intermediate results (and how much scratch disk) can pile up in front of a slow lane.
+    A lane worker that dies (e.g. an OOM kill) fails the job it was running and is
+    replaced. release(job) is called for such jobs, and for every started job that has
+    not finished when the pipeline exits (e.g. on an interrupt), since their own lane can
+    no longer clean up after them. Returns a dict mapping recording name to its final status.
+    """
+    queues = [mp.Queue(maxsize=max(1, queue_depth)) for _ in lanes]
+    events = mp.Queue()
+    workers = [[] for _ in lanes]
+    closed = [False] * len(lanes)
+    sentinels_owed = [0] * len(lanes)
+    current = {}
+    results = {}
+    started = set()
+    jobs_by_name = {job["recording_basename"]: job for job in jobs}
+
+    def release_job(name):
+        if release is None or name not in jobs_by_name:
+            return
+        try:
+            release(jobs_by_name[name])
+        except OSError as e:
+            print(f"[pipeline] Could not release {name}: {e}")
+
+    def start_worker(index):
+        lane_name, stage_fn, _ = lanes[index]
+        out_queue = queues[index + 1] if index + 1 < len(lanes) else None
+        proc = mp.Process(target=_lane_worker, name=f"{lane_name}-lane",
+                          args=(lane_name, stage_fn, error_handler, queues[index], out_queue, events))
+        proc.start()
+        workers[index].append(proc)
+
+    def handle_events(timeout):
+        try:
+            event, lane_name, name, pid = events.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        if event == "started":
+            current[pid] = name
+            started.add(name)
+            print(f"[pipeline] {lane_name}: started {name}")
+        else:
+            current.pop(pid, None)
+            if event != "forwarded":
+                results[name] = event
+                print(f"[pipeline] {lane_name}: {name} {event}")
+        return True
+
+    for index, (_, _, n_workers) in enumerate(lanes):
+        for _ in range(max(1, n_workers)):
+            start_worker(index)
+
+    try:
+        pending = list(jobs)
+        while True:
+            # Feed the first lane without blocking, so events keep being handled.
+            while pending:
+                try:
+                    queues[0].put(pending[0], timeout=0.1)
+                    pending.pop(0)
+                except queue.Full:
+                    break
+            handle_events(poll_interval)
+
+            for index, lane_workers in enumerate(workers):
+                for proc in [p for p in lane_workers if not p.is_alive()]:
+                    lane_workers.remove(proc)
+                    name = current.pop(proc.pid, None)
+                    if proc.exitcode != 0:
+                        print(f"[pipeline] {lanes[index][0]} lane worker exited with code {proc.exitcode}.")
+                        if name is not None:
+                            results[name] = "failed"
+                            release_job(name)
+                        start_worker(index)
+                        if closed[index]:
+                            sentinels_owed[index] += 1
+
+                # Close a lane once everything upstream is finished and its input is fed.
+                if index > 0:
+                    upstream_done = closed[index - 1] and not workers[index - 1] and not sentinels_owed[index - 1]
+                else:
+                    upstream_done = not pending
+                if upstream_done and not closed[index]:
+                    sentinels_owed[index] = len(lane_workers)
+                    closed[index] = True
+                # Never block on a full queue here: a worker might die while we wait.
+                while sentinels_owed[index]:
+                    try:
+                        queues[index].put_nowait(None)
+                        sentinels_owed[index] -= 1
+                    except queue.Full:
+                        break
+
+            if all(closed) and not any(workers):
+                break
+    finally:
+        for lane_workers in workers:
+            for proc in lane_workers:
+                if proc.is_alive():
+                    proc.terminate()
+                    proc.join()
+        while handle_events(0.1):
+            pass
+        for name in started - set(results):
+            release_job(name)
+    return results
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Resource planner for app.py.
+
+Reads the limits of the container the batch runs in (cgroup v2/v1 CPU quota and memory
+limit, CPU affinity, free scratch space) and the length and channel count of every
+recording from its header, estimates the peak memory and scratch disk of every stage,
+and picks n_jobs and the chunk size (passed to spikeinterface as total_memory) per
+recording. Recordings that cannot fit even with a single job and small chunks are
+refused; in concurrent mode the estimates are used to defer recordings until enough
+memory and scratch space is free.
+
+The per-stage models are deliberately simple and conservative; the constants below
+are the knobs to adjust if metrics.json shows consistently different peaks.
+"""
+import os
+
+from waveform_cache import COUNT_AWARE_MAX_FACTOR
+
+MiB = 1024 ** 2
+GiB = 1024 ** 3
+
+# Resident memory of one Python process with numpy/spikeinterface loaded.
+PROCESS_BASELINE = 400 * MiB
+# Float working copies of a chunk while filtering and whitening (int16 read, float
+# conversion, filter state and padding, whitened output).
+PREPROCESSING_CHUNK_COPIES = 6
+# Kilosort4: fixed overhead (torch, templates), float copies of one batch, and memory per
+# detected spike (features on the nearest channels, cluster assignments).
+SORTER_BASELINE = 2 * GiB
+SORTER_BATCH_COPIES = 10
+SORTER_BYTES_PER_SPIKE = 600
+# Expected detected spikes per channel per second, used for spike-proportional outputs.
+SPIKES_PER_CHANNEL_PER_S = 20
+# Expected units per channel and channels per sparse unit, for waveform outputs.
+UNITS_PER_CHANNEL = 1.0
+SPARSE_CHANNELS = 32
+# Fraction of the available memory the plan may use; the rest absorbs estimation error.
+MEMORY_HEADROOM = 0.85
+# Chunk durations tried for the chunked stages, longest (fastest) first.
+CHUNK_DURATIONS = (1.0, 0.5, 0.25, 0.1)
+
+def _read_text(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _cgroup_v2_dir():
+    """
+    This process's cgroup v2 directory, or None on cgroup v1 / without cgroups.
+    """
+    if not os.path.exists("/sys/fs/cgroup/cgroup.controllers"):
+        return None
+    for line in (_read_text("/proc/self/cgroup") or "").splitlines():
+        if line.startswith("0::"):
+            path = os.path.join("/sys/fs/cgroup", line[3:].lstrip("/"))
+            if os.path.exists(os.path.join(path, "memory.max")) or os.path.exists(os.path.join(path, "cpu.max")):
+                return path
+    return "/sys/fs/cgroup"
+
+def detect_cpu_limit():
+    """
+    Number of cores this process may use: the CPU affinity mask, capped by the cgroup
+    CPU quota (docker --cpus). May be fractional.
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    quota = None
+    cgroup_dir = _cgroup_v2_dir()
+    if cgroup_dir is not None:
+        fields = (_read_text(os.path.join(cgroup_dir, "cpu.max")) or "max").split()
+        if fields[0] != "max" and len(fields) == 2:
+            quota = int(fields[0]) / int(fields[1])
+    else:
+        for base in ("/sys/fs/cgroup/cpu", "/sys/fs/cgroup/cpu,cpuacct"):
+            quota_us = _read_text(os.path.join(base, "cpu.cfs_quota_us"))
+            period_us = _read_text(os.path.join(base, "cpu.cfs_period_us"))
+            if quota_us and period_us and int(quota_us) > 0:
+                quota = int(quota_us) / int(period_us)
+                break
+    return min(cores, quota) if quota else float(cores)
+
+def _meminfo():
+    info = {}
+    for line in (_read_text("/proc/meminfo") or "").splitlines():
+        key, _, value = line.partition(":")
+        fields = value.split()
+        if fields:
+            info[key] = int(fields[0]) * 1024
+    return info
+
+def detect_memory():
+    """
+    Return (limit, available) in bytes. limit is the cgroup memory limit (docker
+    --memory) or the physical memory; available also subtracts what is in use now,
+    not counting reclaimable page cache.
+    """
+    meminfo = _meminfo()
+    limit = meminfo.get("MemTotal")
+    available = meminfo.get("MemAvailable", limit)
+    cgroup_limit = cgroup_usage = None
+    cgroup_dir = _cgroup_v2_dir()
+    if cgroup_dir is not None:
+        max_text = _read_text(os.path.join(cgroup_dir, "memory.max"))
+        if max_text and max_text != "max":
+            cgroup_limit = int(max_text)
+            cgroup_usage = int(_read_text(os.path.join(cgroup_dir, "memory.current")) or 0)
+            stat = dict(line.split() for line in (_read_text(os.path.join(cgroup_dir, "memory.stat")) or "").splitlines()
+                        if len(line.split()) == 2)
+            cgroup_usage -= int(stat.get("inactive_file", 0))
+    else:
+        limit_text = _read_text("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+        # cgroup v1 reports "no limit" as a huge number.
+        if limit_text and int(limit_text) < 1 << 60:
+            cgroup_limit = int(limit_text)
+            cgroup_usage = int(_read_text("/sys/fs/cgroup/memory/memory.usage_in_bytes") or 0)
+    if cgroup_limit is not None:
+        limit = min(limit, cgroup_limit) if limit else cgroup_limit
+        available = min(available, cgroup_limit - max(cgroup_usage, 0)) if available else cgroup_limit - cgroup_usage
+    return int(limit or 0), int(max(available or 0, 0))
+
+def detect_resources(scratch_folder):
+    """
+    Cores, memory limit, available memory and free scratch space seen by this process.
+    """
+    import shutil
+    memory_limit, memory_available = detect_memory()
+    os.makedirs(scratch_folder, exist_ok=True)
+    return {
+        "cores": detect_cpu_limit(),
+        "memory_limit": memory_limit,
+        "memory_available": memory_available,
+        "scratch_free": shutil.disk_usage(scratch_folder).free,
+    }
+
+def recording_shape(recording_file, stream_id="trodes", num_channels=None, sampling_frequency=30000.0):
+    """
+    Return (num_channels, num_samples, sampling_frequency) of a recording from its header.
+    Streams the native reader cannot parse are estimated from the file size, with
+    num_channels from the probe and int16 samples.
+    """
+    if stream_id == "trodes":
+        try:
+            from rec_reader import parse_rec_header
+            layout = parse_rec_header(recording_file)
+            return layout["num_channels"], layout["num_packets"], layout["sampling_frequency"]
+        except (ValueError, KeyError, OSError):
+            pass
+    num_channels = max(1, int(num_channels or 1))
+    return num_channels, os.path.getsize(recording_file) // (2 * num_channels), sampling_frequency
+
+def _itemsize(dtype):
+    return {"float64": 8, "float32": 4, "float16": 2, "int16": 2}.get(str(dtype), 4)
+
+def _chunked_stage_memory(n_jobs, chunk_samples, num_channels, itemsize):
+    # The parent process plus n_jobs workers, each holding float copies of one chunk.
+    per_worker = PROCESS_BASELINE + chunk_samples * num_channels * max(itemsize, 4) * PREPROCESSING_CHUNK_COPIES
+    return PROCESS_BASELINE + n_jobs * per_worker
+
+def estimate_stages(num_channels, num_samples, sampling_frequency, params, n_jobs, chunk_duration):
+    """
+    Peak memory and scratch disk (bytes) of every stage of one recording.
+    """
+    itemsize = 2 if params.get("quantize") else _itemsize(params.get("whiten_dtype", "float32"))
+    duration = num_samples / sampling_frequency
+    chunk_samples = int(chunk_duration * sampling_frequency)
+    data_bytes = num_samples * num_channels * itemsize
+    num_spikes = int(duration * num_channels * SPIKES_PER_CHANNEL_PER_S)
+    num_units = max(1, int(num_channels * UNITS_PER_CHANNEL))
+    sparse_channels = min(num_channels, SPARSE_CHANNELS)
+    waveform_samples = int((params.get("ms_before", 1) + params.get("ms_after", 1)) * sampling_frequency / 1000)
+    zarr = params.get("preproc_format", "binary") == "zarr"
+
+    stages = {}
+    stages["preprocessing"] = {
+        "memory": _chunked_stage_memory(n_jobs, chunk_samples, num_channels, itemsize),
+        "scratch": int(data_bytes * (0.9 if zarr else 1.0)),
+    }
+    batch_size = int((params.get("sort_params") or {}).get("batch_size", 60000))
+    sorted_spikes = num_spikes
+    if params.get("window_duration") and not params.get("split_by_group"):
+        # Windowed sorting only holds the spikes of one window (plus its overlap).
+        window = params["window_duration"] + params.get("window_overlap", 60)
+        sorted_spikes = int(num_spikes * min(1.0, window / max(duration, 1e-9)))
+    sorter_memory = SORTER_BASELINE + batch_size * num_channels * 4 * SORTER_BATCH_COPIES \
+        + sorted_spikes * SORTER_BYTES_PER_SPIKE
+    if params.get("split_by_group"):
+        # Groups are sorted in parallel; each sorter sees a share of the channels and spikes.
+        group_workers = max(1, int(params.get("group_workers") or n_jobs))
+        sorter_memory = group_workers * SORTER_BASELINE + (sorter_memory - SORTER_BASELINE)
+    stages["sorting"] = {
+        "memory": sorter_memory,
+        # Kilosort4 writes a temporary binary copy when it cannot read the recording in place.
+        "scratch": num_spikes * 32 + (num_samples * num_channels * 4 if zarr else 0),
+    }
+    spikes_per_unit = params.get("random_spikes_max", 200)
+    if params.get("random_spikes_policy") == "count_aware":
+        spikes_per_unit *= COUNT_AWARE_MAX_FACTOR
+    waveform_bytes = num_units * spikes_per_unit * waveform_samples * sparse_channels * 4
+    # The waveform cache holds the same waveforms, cut with the cache margin on both sides.
+    cache_samples = waveform_samples + int(2 * params.get("waveform_cache_margin", 0.5) * sampling_frequency / 1000)
+    cache_bytes = num_units * spikes_per_unit * cache_samples * sparse_channels * 4
+    pc_bytes = num_spikes * params.get("pc_n_components", 3) * sparse_channels * 4 \
+        if params.get("compute_pc_features", True) else 0
+    stages["analyzer"] = {
+        "memory": _chunked_stage_memory(n_jobs, chunk_samples, num_channels, itemsize) + waveform_bytes,
+        "scratch": waveform_bytes + cache_bytes + pc_bytes + num_spikes * 8,
+    }
+    phy_copy = params.get("phy_binary") == "copy" or zarr
+    stages["phy"] = {
+        "memory": PROCESS_BASELINE + pc_bytes,
+        "scratch": pc_bytes + num_spikes * 32 + (num_samples * num_channels * itemsize if phy_copy else 0),
+    }
+    return stages
+
+def plan_recording(recording_file, params, memory_budget, cores, scratch_free, memory_total=None,
+                   num_probe_channels=None):
+    """
+    Pick n_jobs and the chunk duration for one recording so that every stage fits in
+    memory_budget, preferring more jobs over longer chunks. Returns a plan dict; its
+    'action' is 'run', 'defer' (fits in memory_total but not in this worker's share)
+    or 'refuse' (does not fit at all).
+    """
+    num_channels, num_samples, fs = recording_shape(recording_file, params.get("stream_id", "trodes"),
+                                                    num_probe_channels)
+    memory_total = memory_total or memory_budget
+    max_jobs = max(1, int(cores))
+    plan = None
+    for chunk_duration in CHUNK_DURATIONS:
+        for n_jobs in range(max_jobs, 0, -1):
+            stages = estimate_stages(num_channels, num_samples, fs, params, n_jobs, chunk_duration)
+            if max(stage["memory"] for stage in stages.values()) <= memory_budget:
+                plan = (n_jobs, chunk_duration, stages)
+                break
+        if plan is not None:
+            break
+    action, reason = "run", ""
+    if plan is None:
+        # Smallest configuration; it does not fit in this worker's share of the memory.
+        plan = (1, CHUNK_DURATIONS[-1], estimate_stages(num_channels, num_samples, fs, params, 1, CHUNK_DURATIONS[-1]))
+        peak = max(stage["memory"] for stage in plan[2].values())
+        action = "defer" if peak <= memory_total else "refuse"
+        reason = f"needs ~{peak / GiB:.1f} GiB of memory, {memory_budget / GiB:.1f} GiB available" + \
+                 (" per worker" if action == "defer" else "")
+    n_jobs, chunk_duration, stages = plan
+    scratch = sum(stage["scratch"] for stage in stages.values())
+    if scratch > scratch_free:
+        action = "refuse"
+        reason = f"needs ~{scratch / GiB:.1f} GiB of scratch, {max(scratch_free, 0) / GiB:.1f} GiB free"
+
+    itemsize = 2 if params.get("quantize") else _itemsize(params.get("whiten_dtype", "float32"))
+    # spikeinterface derives the chunk size from total_memory / (n_jobs * channels * itemsize)
+    # and reads 'k' as 1000 bytes.
+    total_memory = f"{n_jobs * int(chunk_duration * fs) * num_channels * itemsize // 1000}k"
+    peak_stage = max(stages, key=lambda stage: stages[stage]["memory"])
+    return {
+        "recording": recording_file,
+        "num_channels": num_channels,
+        "duration_s": num_samples / fs,
+        "n_jobs": n_jobs,
+        "chunk_duration_s": chunk_duration,
+        "total_memory": total_memory,
+        "stages": stages,
+        "peak_memory": stages[peak_stage]["memory"],
+        "peak_stage": peak_stage,
+        "scratch": scratch,
+        "action": action,
+        "reason": reason,
+    }
+
+def plan_batch(recording_files, params, resources, max_workers=1, num_probe_channels=None):
+    """
+    Plan every recording for max_workers concurrent workers sharing the detected resources.
+    The outputs of every recording stay on disk, so each one is planned against the
+    scratch left after the recordings planned to run before it.
+    """
+    max_workers = max(1, int(max_workers))
+    memory_total = int(resources["memory_available"] * MEMORY_HEADROOM)
+    plans = []
+    planned_scratch = 0
+    for rec_file in recording_files:
+        plan = plan_recording(rec_file, params, memory_budget=memory_total // max_workers,
+                              cores=max(1, resources["cores"] // max_workers),
+                              scratch_free=resources["scratch_free"] - planned_scratch,
+                              memory_total=memory_total, num_probe_channels=num_probe_channels)
+        if plan["action"] != "refuse":
+            planned_scratch += plan["scratch"]
+        plan["cumulative_scratch"] = planned_scratch
+        plans.append(plan)
+    return plans
+
+def print_plan(plans, resources, max_workers=1):
+    """
+    Print the detected resources and one line per planned recording.
+    """
+    print(f"Resources: {resources['cores']:g} core(s), {resources['memory_available'] / GiB:.1f} GiB memory "
+          f"available (limit {resources['memory_limit'] / GiB:.1f} GiB), {resources['scratch_free'] / GiB:.1f} GiB "
+          f"scratch free; {max_workers} worker(s).")
+    header = ["recording", "channels", "duration", "n_jobs", "chunk", "peak_memory", "scratch", "total_scratch",
+              "action"]
+    rows = [[os.path.basename(plan["recording"]), str(plan["num_channels"]), f"{plan['duration_s'] / 60:.1f}min",
+             str(plan["n_jobs"]), f"{plan['chunk_duration_s']:g}s",
+             f"{plan['peak_memory'] / GiB:.1f}G ({plan['peak_stage']})", f"{plan['scratch'] / GiB:.1f}G",
+             f"{plan['cumulative_scratch'] / GiB:.1f}G", plan["action"] + (f": {plan['reason']}" if plan["reason"] else "")] for plan in plans]
+    widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+int16 quantization of the preprocessed recording for app.py.
+
+The whitened float traces are mapped to int16 with one gain for all channels,
+estimated from random chunks of the recording, and no offset. The gain is stored as the
+recording's gain_to_uV property (combined with any scaling the whitened recording
+already had), so reads with return_scaled=True, and therefore the sorting analyzer, see
+the same values as the float32 output, while the binary on disk is half the size.
+
+Phy reads the int16 binary without any scaling (it ignores unknown params.py keys), so
+the exported templates and amplitudes are divided by the same gain (rescale_phy_export);
+a single gain keeps the traces, waveforms and templates in Phy on one common scale.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from spikeinterface.core import get_random_data_chunks
+from spikeinterface.preprocessing.basepreprocessor import BasePreprocessor, BasePreprocessorSegment
+
+__version__ = "1.0.0"
+
+INT16_MAX = np.iinfo("int16").max
+INT16_MIN = np.iinfo("int16").min
+
+class QuantizedRecording(BasePreprocessor):
+    """
+    int16 view of a float recording: round((traces - offsets) / gains), clipped to the int16 range.
+    """
+    def __init__(self, recording, gains, offsets):
+        gains = np.asarray(gains, dtype="float64")
+        offsets = np.asarray(offsets, dtype="float64")
+        BasePreprocessor.__init__(self, recording, dtype="int16")
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(QuantizedRecordingSegment(parent_segment, gains, offsets))
+
+        # Reading with return_scaled=True gives the parent's scaled values back.
+        parent_gains = recording.get_channel_gains() if recording.has_scaleable_traces() else np.ones(len(gains))
+        parent_offsets = recording.get_channel_offsets() if recording.has_scaleable_traces() else np.zeros(len(gains))
+        self.set_channel_gains(gains * parent_gains)
+        self.set_channel_offsets(offsets * parent_gains + parent_offsets)
+        self._kwargs = dict(recording=recording, gains=gains.tolist(), offsets=offsets.tolist())
+
+class QuantizedRecordingSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, gains, offsets):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.gains = gains.astype("float32")
+        self.offsets = offsets.astype("float32")
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        traces = self.parent_recording_segment.get_traces(start_frame, end_frame, channel_indices)
+        channel_indices = slice(None) if channel_indices is None else channel_indices
+        scaled = (traces.astype("float32") - self.offsets[channel_indices]) / self.gains[channel_indices]
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, INT16_MIN, INT16_MAX, out=scaled)
+        return scaled.astype("int16")
+
+def estimate_quantization(recording, headroom=4.0, num_chunks_per_segment=20, chunk_size=10000, seed=0):
+    """
+    Gains and offsets (per channel, in the recording's own units) for int16 quantization
+    such that the quantized recording has the same scaled gain on every channel and a
+    scaled offset of zero. The gain maps headroom times the largest sampled value of any
+    channel to the int16 range, leaving room for spikes larger than any in the sampled chunks.
+    """
+    num_channels = recording.get_num_channels()
+    parent_gains = recording.get_channel_gains() if recording.has_scaleable_traces() else np.ones(num_channels)
+    parent_offsets = recording.get_channel_offsets() if recording.has_scaleable_traces() else np.zeros(num_channels)
+    parent_gains = np.asarray(parent_gains, dtype="float64")
+    parent_offsets = np.asarray(parent_offsets, dtype="float64")
+    chunks = get_random_data_chunks(recording, num_chunks_per_segment=num_chunks_per_segment,
+                                    chunk_size=chunk_size, seed=seed, return_scaled=True)
+    gain = max(float(np.max(np.abs(chunks))) * headroom / INT16_MAX, np.finfo("float32").tiny)
+    return gain / parent_gains, -parent_offsets / parent_gains
+
+def quantize_recording(recording, headroom=4.0, seed=0):
+    """
+    Wrap a float recording in a QuantizedRecording with estimated gains and offsets.
+    """
+    gains, offsets = estimate_quantization(recording, headroom=headroom, seed=seed)
+    return QuantizedRecording(recording, gains, offsets)
+
+def rescale_phy_export(phy_folder, gain):
+    """
+    Divide the templates and amplitudes of a Phy export by the quantization gain, so they
+    are in the int16 units of the traces Phy reads.
+    """
+    for name in ("templates.npy", "amplitudes.npy"):
+        path = Path(phy_folder) / name
+        if path.exists():
+            values = np.load(path)
+            np.save(path, (values / gain).astype(values.dtype))
+
+def quantization_error(recording, quantized, num_chunks_per_segment=20, chunk_size=10000, seed=1):
+    """
+    Compare a float recording with its int16 version on random chunks (other than the
+    ones used to fit the gains). Errors are relative to each channel's standard deviation.
+    """
+    gains = np.asarray(quantized._kwargs["gains"])
+    offsets = np.asarray(quantized._kwargs["offsets"])
+    original = get_random_data_chunks(recording, num_chunks_per_segment=num_chunks_per_segment,
+                                      chunk_size=chunk_size, seed=seed, return_scaled=False).astype("float64")
+    recovered = get_random_data_chunks(quantized, num_chunks_per_segment=num_chunks_per_segment,
+                                       chunk_size=chunk_size, seed=seed, return_scaled=False)
+    clipped = np.mean((recovered == INT16_MAX) | (recovered == INT16_MIN))
+    error = recovered * gains + offsets - original
+    std = np.maximum(original.std(axis=0), np.finfo("float64").tiny)
+    rms_rel = np.sqrt(np.mean(error ** 2, axis=0)) / std
+    return {
+        "rms_error_rel_std_mean": float(rms_rel.mean()),
+        "rms_error_rel_std_max": float(rms_rel.max()),
+        "max_abs_error_rel_std": float(np.max(np.abs(error) / std)),
+        "snr_db": float(20 * np.log10(1 / max(rms_rel.mean(), 1e-12))),
+        "clipped_fraction": float(clipped),
+    }
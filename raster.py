@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Fixed-resolution raster plots for app.py.
+
+Instead of drawing every spike as a matplotlib artist, spike times are binned per unit
+into an image of (units x time bins) with np.bincount and drawn with a single imshow.
+The spike vector is binned in chunks, so apart from the sorting itself memory only
+depends on the image size, not on the number of spikes.
+"""
+import numpy as np
+
+def bin_spikes(sorting, num_bins, num_samples, chunk_size=5_000_000):
+    """
+    Count the spikes of every unit in num_bins equal time bins.
+    num_samples is a list with the number of samples of every segment; segments are
+    placed one after another on the time axis. Returns an int64 (num_units, num_bins) array.
+    """
+    num_units = len(sorting.unit_ids)
+    segment_offsets = np.concatenate([[0], np.cumsum(num_samples)[:-1]]).astype("int64")
+    total_samples = int(np.sum(num_samples))
+    counts = np.zeros(num_units * num_bins, dtype="int64")
+    spikes = sorting.to_spike_vector()
+    for start in range(0, spikes.size, chunk_size):
+        chunk = spikes[start:start + chunk_size]
+        samples = chunk["sample_index"].astype("int64") + segment_offsets[chunk["segment_index"]]
+        time_bins = np.minimum(samples * num_bins // max(total_samples, 1), num_bins - 1)
+        counts += np.bincount(chunk["unit_index"].astype("int64") * num_bins + time_bins,
+                              minlength=counts.size)
+    return counts.reshape(num_units, num_bins)
+
+def plot_raster(sorting, output_path, num_samples, title=None, width=2000, rate_strips=False,
+                rate_bin_s=1.0, dpi=100):
+    """
+    Render a raster of sorting into output_path.
+
+    The raster has width time bins; a bin is drawn darker the more spikes the unit fired
+    in it. With rate_strips, a second panel shows every unit's firing rate (Hz) in
+    rate_bin_s bins as a heat map, one strip per unit.
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    fs = sorting.get_sampling_frequency()
+    duration = float(np.sum(num_samples)) / fs
+    num_units = len(sorting.unit_ids)
+    width = max(1, min(int(width), int(np.sum(num_samples))))
+    counts = bin_spikes(sorting, width, num_samples)
+
+    num_panels = 2 if rate_strips else 1
+    fig_height = min(4 + 0.08 * num_units, 16) * (1.6 if rate_strips else 1)
+    fig, axes = plt.subplots(num_panels, 1, figsize=(width / dpi + 1.5, fig_height), dpi=dpi,
+                             sharex=True, squeeze=False)
+    extent = (0, duration, num_units - 0.5, -0.5)
+
+    ax = axes[0, 0]
+    # Log-scaled counts keep single spikes visible next to bursting units.
+    ax.imshow(np.log1p(counts), aspect="auto", interpolation="nearest", cmap="Greys", extent=extent)
+    ax.set_ylabel("Unit IDs")
+    _set_unit_ticks(ax, sorting.unit_ids)
+    if title:
+        ax.set_title(title)
+
+    if rate_strips:
+        num_rate_bins = max(1, int(round(duration / rate_bin_s)))
+        rates = bin_spikes(sorting, num_rate_bins, num_samples) / (duration / num_rate_bins)
+        ax = axes[1, 0]
+        image = ax.imshow(rates, aspect="auto", interpolation="nearest", cmap="viridis", extent=extent,
+                          norm=matplotlib.colors.PowerNorm(0.5))
+        ax.set_ylabel("Unit IDs")
+        _set_unit_ticks(ax, sorting.unit_ids)
+        fig.colorbar(image, ax=axes[:, 0].tolist(), label="Firing rate (Hz)", fraction=0.02, pad=0.01)
+    axes[-1, 0].set_xlabel("Time (s)")
+
+    fig.savefig(str(output_path))
+    plt.close(fig)
+    return counts
+
+def _set_unit_ticks(ax, unit_ids, max_ticks=40):
+    step = max(1, int(np.ceil(len(unit_ids) / max_ticks)))
+    positions = np.arange(0, len(unit_ids), step)
+    ax.set_yticks(positions)
+    ax.set_yticklabels([str(unit_ids[i]) for i in positions])
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Native reader for SpikeGadgets/Trodes .rec files.
+
+A .rec file is an XML configuration header followed by fixed-size packets, one per
+sample: a 0x55 sync byte, the auxiliary device bytes, a uint32 timestamp and one int16
+sample per ephys channel. The header is parsed once per file and the packet layout is
+cached. Traces are exposed as a strided int16 view on a memory map of the packets, so
+reading a chunk is a single vectorized gather instead of per-packet byte masking.
+
+Run this file with --benchmark to compare read throughput against
+spikeinterface.extractors.read_spikegadgets on a synthetic .rec file.
+"""
+import os
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from xml.etree import ElementTree
+
+import numpy as np
+
+from spikeinterface.core import BaseRecording, BaseRecordingSegment
+
+# spikeinterface records the module version when it serializes an extractor.
+__version__ = "1.0.0"
+
+_LAYOUT_CACHE = {}
+
+def _hwchans_in_binary_order(sconf, num_channels):
+    """
+    Order in which the hwChans are stored in each packet.
+    Intan headstages multiplex their chips channel by channel, so the samples are
+    interleaved across chips (chip 0 ch 0, chip 1 ch 0, ..., chip 0 ch 1, ...).
+    Neuropixels data, and layouts that do not fit whole chips, are stored in
+    ascending hwChan order. This mirrors neo's SpikeGadgetsRawIO.
+    """
+    hw_chans = [int(schan.attrib["hwChan"]) for trode in sconf for schan in trode]
+    device = sconf.attrib.get("device")
+    if device in ("neuropixels1", "neuropixels2"):
+        return sorted(hw_chans)
+    if device not in (None, "intan"):
+        raise ValueError(f"Unsupported SpikeConfiguration device: {device!r}")
+    chans_per_chip = int(sconf.attrib.get("chanPerChip", 32))
+    if chans_per_chip <= 0 or chans_per_chip > num_channels or num_channels % chans_per_chip:
+        return sorted(hw_chans)
+    present = set(hw_chans)
+    n_chips = num_channels // chans_per_chip
+    return [local + chip * chans_per_chip
+            for local in range(chans_per_chip)
+            for chip in range(n_chips)
+            if local + chip * chans_per_chip in present]
+
+def parse_rec_header(file_path):
+    """
+    Parse the XML header of a .rec file and return its packet layout as a dict.
+    The result is cached per (path, size, mtime), so repeated opens are free.
+    """
+    file_path = str(file_path)
+    stat = os.stat(file_path)
+    cache_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if cache_key in _LAYOUT_CACHE:
+        return _LAYOUT_CACHE[cache_key]
+
+    with open(file_path, "rb") as f:
+        for line in f:
+            if b"</Configuration>" in line:
+                header_size = f.tell()
+                break
+        else:
+            raise ValueError(f"{file_path}: the XML header does not contain '</Configuration>'")
+        f.seek(0)
+        header_txt = f.read(header_size).decode("utf8")
+
+    root = ElementTree.fromstring(header_txt)
+    hconf = root.find("HardwareConfiguration")
+    sconf = root.find("SpikeConfiguration")
+    num_channels = int(hconf.attrib["numChannels"])
+    num_channels = min(num_channels, sum(len(trode) for trode in sconf))
+
+    # Sync byte, then the auxiliary devices, then the timestamp, then (with
+    # sysTimeIncluded) the 8-byte system clock, then the ephys samples.
+    packet_size = 1 + sum(int(device.attrib["numBytes"]) for device in hconf if "numBytes" in device.attrib)
+    timestamp_offset = packet_size
+    sys_time_included = hconf.attrib.get("sysTimeIncluded", "0") == "1"
+    ephys_offset = packet_size + 4 + (8 if sys_time_included else 0)
+    packet_size = ephys_offset + 2 * num_channels
+
+    hw_chans = _hwchans_in_binary_order(sconf, num_channels)
+    trode_by_hwchan = {int(schan.attrib["hwChan"]): trode for trode in sconf for schan in trode}
+    gains = [float(trode_by_hwchan[hw].attrib.get("spikeScalingToUv", 1.0)) for hw in hw_chans]
+
+    layout = {
+        "file_path": file_path,
+        "header_size": header_size,
+        "packet_size": packet_size,
+        "timestamp_offset": timestamp_offset,
+        "ephys_offset": ephys_offset,
+        "sys_time_included": sys_time_included,
+        "num_packets": (stat.st_size - header_size) // packet_size,
+        "sampling_frequency": float(hconf.attrib["samplingRate"]),
+        "num_channels": len(hw_chans),
+        "channel_ids": [str(hw) for hw in hw_chans],
+        "gains_to_uV": gains,
+    }
+    _LAYOUT_CACHE[cache_key] = layout
+    return layout
+
+def ephys_view(layout):
+    """
+    Zero-copy (num_packets, num_channels) int16 view of the ephys samples.
+    Each row is one packet; the stride skips over the sync, device and timestamp bytes.
+    """
+    raw = np.memmap(layout["file_path"], dtype="u1", mode="r", offset=layout["header_size"],
+                    shape=(layout["num_packets"] * layout["packet_size"],))
+    return np.ndarray(shape=(layout["num_packets"], layout["num_channels"]), dtype="<i2", buffer=raw,
+                      offset=layout["ephys_offset"], strides=(layout["packet_size"], 2))
+
+def timestamps_view(layout):
+    """
+    Zero-copy view of the uint32 hardware timestamp of every packet.
+    """
+    raw = np.memmap(layout["file_path"], dtype="u1", mode="r", offset=layout["header_size"],
+                    shape=(layout["num_packets"] * layout["packet_size"],))
+    return np.ndarray(shape=(layout["num_packets"],), dtype="<u4", buffer=raw,
+                      offset=layout["timestamp_offset"], strides=(layout["packet_size"],))
+
+class TrodesRecRecordingSegment(BaseRecordingSegment):
+    def __init__(self, layout):
+        BaseRecordingSegment.__init__(self, sampling_frequency=layout["sampling_frequency"])
+        self._layout = layout
+        self._traces = None
+
+    def get_num_samples(self):
+        return self._layout["num_packets"]
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        # The memmap is opened lazily so the segment stays cheap to pickle to workers.
+        if self._traces is None:
+            self._traces = ephys_view(self._layout)
+        if channel_indices is None:
+            channel_indices = slice(None)
+        return np.ascontiguousarray(self._traces[start_frame:end_frame, channel_indices])
+
+class TrodesRecRecordingExtractor(BaseRecording):
+    """
+    spikeinterface recording for the 'trodes' (ephys) stream of a .rec file,
+    backed by the native memory-mapped reader.
+    """
+    def __init__(self, file_path):
+        layout = parse_rec_header(file_path)
+        BaseRecording.__init__(self, sampling_frequency=layout["sampling_frequency"],
+                               channel_ids=layout["channel_ids"], dtype="int16")
+        self.add_recording_segment(TrodesRecRecordingSegment(layout))
+        self.set_channel_gains(layout["gains_to_uV"])
+        self.set_channel_offsets(0.0)
+        self._kwargs = {"file_path": str(Path(file_path).absolute())}
+
+def read_rec(file_path, stream_id="trodes", reader="native"):
+    """
+    Open a .rec recording. The native reader handles the 'trodes' ephys stream; other
+    streams, reader='neo', or headers the native reader does not support go through
+    spikeinterface's read_spikegadgets.
+    """
+    if reader == "native" and stream_id == "trodes":
+        try:
+            return TrodesRecRecordingExtractor(file_path)
+        except (ValueError, KeyError) as e:
+            print(f"Native .rec reader cannot open {file_path} ({e}); falling back to read_spikegadgets.")
+    import spikeinterface.extractors as se
+    return se.read_spikegadgets(file_path, stream_id=stream_id)
+
+def write_synthetic_rec(file_path, num_channels=32, duration=10.0, sampling_frequency=30000.0,
+                        channels_per_trode=4, traces=None, seed=0, chunk_size=300000, sys_time=False):
+    """
+    Write a Trodes-style .rec file with num_channels int16 ephys channels.
+    If traces (num_samples, num_channels) is not given, Gaussian noise is written.
+    With sys_time, every packet carries an 8-byte system clock after the timestamp
+    (sysTimeIncluded="1"). Returns the path of the written file.
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = int(duration * sampling_frequency) if traces is None else traces.shape[0]
+    trodes = []
+    for trode_index in range(0, num_channels, channels_per_trode):
+        chans = "".join(f'<SpikeChannel hwChan="{hw}" thresh="60" maxDisp="400" triggerOn="1"/>'
+                        for hw in range(trode_index, min(trode_index + channels_per_trode, num_channels)))
+        trodes.append(f'  <SpikeNTrode id="{trode_index // channels_per_trode + 1}" '
+                      f'spikeScalingToUv="0.195">{chans}</SpikeNTrode>\n')
+    header = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Configuration>\n'
+        ' <GlobalConfiguration headerSize="10" timestampAtCreation="0" systemTimeAtCreation="0"/>\n'
+        f' <HardwareConfiguration samplingRate="{int(sampling_frequency)}" numChannels="{num_channels}"'
+        + (' sysTimeIncluded="1"' if sys_time else '') + '>\n'
+        '  <Device name="Controller_DIO" numBytes="1" available="1" packetOrderPreference="10">\n'
+        '   <Channel id="Controller_Din1" dataType="digital" startByte="0" bit="0" input="1"/>\n'
+        '  </Device>\n'
+        ' </HardwareConfiguration>\n'
+        f' <SpikeConfiguration chanPerChip="{num_channels}">\n'
+        + "".join(trodes) +
+        ' </SpikeConfiguration>\n'
+        '</Configuration>\n'
+    )
+    ephys_offset = 1 + 1 + 4 + (8 if sys_time else 0)
+    packet_size = ephys_offset + 2 * num_channels
+    with open(file_path, "wb") as f:
+        f.write(header.encode("utf8"))
+        for start in range(0, num_samples, chunk_size):
+            stop = min(start + chunk_size, num_samples)
+            packets = np.zeros((stop - start, packet_size), dtype="u1")
+            packets[:, 0] = 0x55
+            packets[:, 2:6] = np.arange(start, stop, dtype="<u4").view("u1").reshape(-1, 4)
+            if sys_time:
+                # System clock in ns, one tick per sample.
+                sys_ns = (np.arange(start, stop) * (1e9 / sampling_frequency)).astype("<i8")
+                packets[:, 6:14] = sys_ns.view("u1").reshape(-1, 8)
+            if traces is None:
+                chunk = rng.normal(0, 200, size=(stop - start, num_channels)).astype("<i2")
+            else:
+                chunk = np.asarray(traces[start:stop], dtype="<i2")
+            packets[:, ephys_offset:] = chunk.view("u1").reshape(stop - start, -1)
+            f.write(packets.tobytes())
+    return file_path
+
+def _time_full_read(recording, chunk_size):
+    num_samples = recording.get_num_samples()
+    start_time = time.perf_counter()
+    for start in range(0, num_samples, chunk_size):
+        recording.get_traces(start_frame=start, end_frame=min(start + chunk_size, num_samples))
+    return time.perf_counter() - start_time
+
+def compare_read_throughput(file_path, chunk_duration=1.0, stream_id="trodes"):
+    """
+    Read the whole file chunk by chunk with the native reader and with
+    read_spikegadgets, check that both return the same samples and report the throughput.
+    """
+    import spikeinterface.extractors as se
+
+    native = TrodesRecRecordingExtractor(file_path)
+    neo = se.read_spikegadgets(str(file_path), stream_id=stream_id)
+    chunk_size = int(chunk_duration * native.get_sampling_frequency())
+
+    check_stop = min(chunk_size, native.get_num_samples())
+    if not np.array_equal(native.get_traces(end_frame=check_stop), neo.get_traces(end_frame=check_stop)):
+        raise AssertionError("Native reader and read_spikegadgets returned different samples.")
+
+    n_bytes = native.get_num_samples() * native.get_num_channels() * 2
+    results = {}
+    for name, recording in (("read_spikegadgets", neo), ("native", native)):
+        elapsed = _time_full_read(recording, chunk_size)
+        results[name] = {"seconds": elapsed, "MB_per_s": n_bytes / elapsed / 1e6}
+        print(f"{name:>18}: {elapsed:8.3f} s  ({results[name]['MB_per_s']:8.1f} MB/s of ephys samples)")
+    print(f"Speed-up: {results['read_spikegadgets']['seconds'] / results['native']['seconds']:.1f}x")
+    return results
+
+def check_against_neo(folder, num_channels=8, duration=2.0):
+    """
+    Write synthetic .rec files with and without sysTimeIncluded, check that the native
+    reader returns exactly the written traces and compare it with read_spikegadgets.
+    Returns {layout: neo agrees}; raises AssertionError if the native reader is wrong.
+    """
+    import spikeinterface.extractors as se
+
+    rng = np.random.default_rng(0)
+    traces = rng.normal(0, 200, size=(int(duration * 30000), num_channels)).astype("<i2")
+    results = {}
+    for sys_time in (False, True):
+        name = "sysTimeIncluded" if sys_time else "no sysTime"
+        rec_file = Path(folder) / f"check_{'systime' if sys_time else 'plain'}.rec"
+        write_synthetic_rec(rec_file, num_channels=num_channels, traces=traces, sys_time=sys_time)
+        native = TrodesRecRecordingExtractor(rec_file).get_traces()
+        if not np.array_equal(native, traces):
+            raise AssertionError(f"Native reader returned the wrong samples ({name}).")
+        neo = se.read_spikegadgets(str(rec_file), stream_id="trodes").get_traces()
+        results[name] = neo.shape == native.shape and np.array_equal(neo, native)
+        print(f"{name:>16}: native reader matches the written samples; read_spikegadgets "
+              + ("agrees." if results[name] else "differs (this neo version ignores sysTimeIncluded)."))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Native SpikeGadgets .rec reader utilities.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare read throughput against read_spikegadgets.")
+    parser.add_argument("--check", action="store_true",
+                        help="Check the native reader against the written samples and read_spikegadgets on "
+                             "synthetic files with and without sysTimeIncluded.")
+    parser.add_argument("--rec-file", type=str, default=None,
+                        help="Existing .rec file to benchmark (default: write a synthetic one).")
+    parser.add_argument("--num-channels", type=int, default=32,
+                        help="Channels in the synthetic file (default: 32).")
+    parser.add_argument("--duration", type=float, default=60.0,
+                        help="Duration of the synthetic file in seconds (default: 60).")
+    parser.add_argument("--chunk-duration", type=float, default=1.0,
+                        help="Chunk duration used for reading, in seconds (default: 1).")
+    args = parser.parse_args()
+
+    if args.check:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            check_against_neo(tmp_dir)
+        return
+    if not args.benchmark:
+        parser.print_help()
+        return
+    if args.rec_file:
+        compare_read_throughput(args.rec_file, chunk_duration=args.chunk_duration)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rec_file = Path(tmp_dir) / "synthetic.merged.rec"
+        print(f"Writing synthetic .rec file ({args.num_channels} channels, {args.duration} s)...")
+        write_synthetic_rec(rec_file, num_channels=args.num_channels, duration=args.duration)
+        compare_read_throughput(rec_file, chunk_duration=args.chunk_duration)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Concurrent batch scheduling for app.py.
+
+Recordings are run in separate worker processes so that several sessions can be
+sorted at the same time. The cores, memory and scratch disk given on the command
+line are treated as one global budget shared by all workers.
+"""
+import os
+import sys
+import time
+import shutil
+import multiprocessing as mp
+
+_MEMORY_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parse_memory_size(size):
+    """
+    Convert a memory string such as '16G' or '512M' (or a plain number of bytes) to bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    text = str(size).strip().upper()
+    if text.endswith("B") and len(text) > 1 and text[-2] in _MEMORY_UNITS:
+        text = text[:-1]
+    unit = text[-1] if text and text[-1] in _MEMORY_UNITS else ""
+    number = text[:-1] if unit else text
+    try:
+        return int(float(number) * _MEMORY_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid memory size: '{size}' (expected e.g. '16G', '512M').")
+
+def format_memory_size(n_bytes):
+    """
+    Convert a number of bytes to the compact string format used by spikeinterface ('8G', '512M').
+    """
+    for unit in ("T", "G", "M", "K"):
+        if n_bytes >= _MEMORY_UNITS[unit]:
+            return f"{int(n_bytes // _MEMORY_UNITS[unit])}{unit}"
+    return f"{int(n_bytes)}"
+
+def split_budget(n_jobs, total_memory, max_workers):
+    """
+    Share a global core and memory budget evenly across concurrent workers.
+    Returns the per-worker (n_jobs, total_memory) pair.
+    """
+    max_workers = max(1, int(max_workers))
+    worker_jobs = max(1, int(n_jobs) // max_workers)
+    worker_memory = max(1, parse_memory_size(total_memory) // max_workers)
+    return worker_jobs, format_memory_size(worker_memory)
+
+def estimate_scratch_bytes(recording_file, whiten_dtype="float32", phy_copy=False):
+    """
+    Estimate the scratch disk needed to process one recording.
+    The raw .rec stores int16 samples; the preprocessed binary (and the Phy copy of it,
+    when Phy does not link to it) is written with the whitening dtype, so it scales with
+    the file size by itemsize / 2.
+    """
+    raw_bytes = os.path.getsize(recording_file)
+    itemsize = {"float64": 8, "float32": 4, "float16": 2, "int16": 2}.get(str(whiten_dtype), 4)
+    copies = 2 if phy_copy else 1
+    return int(raw_bytes * itemsize / 2 * copies)
+
+# Worker exit codes for the statuses a target can return besides success; other codes are failures.
+_EXIT_CODES = {"failed": 1, "skipped": 3, "claimed": 4}
+_EXIT_STATUSES = {code: status for status, code in _EXIT_CODES.items() if status != "failed"}
+
+def _run_worker(target, kwargs, n_jobs):
+    """
+    Worker process entry point: limit the native thread pools to this worker's share of
+    cores, run the target and report its status through the exit code.
+    The environment variables only reach libraries loaded after the fork; BLAS and
+    OpenMP pools that the parent already loaded (numpy is preloaded before forking) are
+    limited at run time with threadpoolctl.
+    """
+    from threadpoolctl import threadpool_limits
+
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"):
+        os.environ[var] = str(n_jobs)
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(n_jobs)
+    with threadpool_limits(limits=n_jobs):
+        status = target(**kwargs)
+    sys.exit(_EXIT_CODES.get(status, 0))
+
+def run_concurrent_batch(target, jobs, max_workers, n_jobs, scratch_budget=None,
+                         scratch_folder=".", poll_interval=2.0, memory_budget=None):
+    """
+    Run target(**kwargs) for every job in its own process, at most max_workers at a time.
+
+    jobs is a list of (name, kwargs, scratch_bytes) or (name, kwargs, scratch_bytes,
+    memory_bytes) tuples. The kwargs must already contain the per-worker share of cores
+    and memory (see split_budget); a per-job 'n_jobs' in kwargs overrides n_jobs. A job is
+    only started while the scratch bytes reserved by running jobs plus its own estimate
+    fit in the scratch still available, and likewise for memory_bytes and memory_budget
+    (default: no memory limit). Finished jobs leave their outputs on disk, so the scratch
+    available is the free space on scratch_folder, measured again before every admission
+    (it already includes what the running jobs wrote so far, so their full estimate is a
+    conservative reservation), capped at scratch_budget minus the estimates of the jobs
+    that already ran. A job that does not fit even with nothing
+    else running is skipped.
+
+    Each job runs in an isolated process, so an exception or a crash (e.g. an OOM kill)
+    only fails that recording. Returns a dict mapping job name to 'ok', 'skipped',
+    'claimed' or 'failed'.
+    """
+    budget_text = (format_memory_size(scratch_budget) if scratch_budget is not None
+                   else f"free space, now {format_memory_size(shutil.disk_usage(scratch_folder).free)}")
+    print(f"Scheduling {len(jobs)} recording(s) on up to {max_workers} worker(s) "
+          f"({n_jobs} core(s) each, scratch budget {budget_text}).")
+
+    pending = list(jobs)
+    running = {}
+    results = {}
+    used = 0
+    try:
+        while pending or running:
+            # Start as many pending jobs as the worker, scratch and memory budgets allow.
+            available = shutil.disk_usage(scratch_folder).free
+            if scratch_budget is not None:
+                available = min(available, scratch_budget - used)
+            reserved = sum(scratch for _, scratch, _ in running.values())
+            reserved_memory = sum(memory for _, _, memory in running.values())
+            for job in list(pending):
+                if len(running) >= max_workers:
+                    break
+                name, kwargs, scratch = job[:3]
+                memory = job[3] if len(job) > 3 else 0
+                if reserved + scratch > available:
+                    if not running:
+                        print(f"Skipping {name}: needs ~{format_memory_size(scratch)} scratch, "
+                              f"{format_memory_size(max(available, 0))} left.")
+                        results[name] = "failed"
+                        pending.remove(job)
+                    continue
+                if memory_budget is not None and reserved_memory + memory > memory_budget:
+                    if not running:
+                        print(f"Skipping {name}: needs ~{format_memory_size(memory)} memory, "
+                              f"budget is {format_memory_size(memory_budget)}.")
+                        results[name] = "failed"
+                        pending.remove(job)
+                    continue
+                proc = mp.Process(target=_run_worker, args=(target, kwargs, kwargs.get("n_jobs", n_jobs)), name=name)
+                proc.start()
+                running[proc] = (name, scratch, memory)
+                reserved += scratch
+                reserved_memory += memory
+                pending.remove(job)
+                print(f"[scheduler] Started {name} (pid {proc.pid}); {len(running)} running, {len(pending)} queued.")
+
+            time.sleep(poll_interval)
+            for proc in [p for p in running if not p.is_alive()]:
+                proc.join()
+                name, scratch, _ = running.pop(proc)
+                if proc.exitcode not in _EXIT_STATUSES:
+                    # Its outputs (or what a failed run left behind) stay on disk.
+                    used += scratch
+                if proc.exitcode == 0:
+                    results[name] = "ok"
+                elif proc.exitcode in _EXIT_STATUSES:
+                    results[name] = _EXIT_STATUSES[proc.exitcode]
+                else:
+                    results[name] = "failed"
+                    print(f"[scheduler] Worker for {name} exited with code {proc.exitcode}.")
+    finally:
+        for proc in running:
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+    return results
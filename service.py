@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Long-lived worker service for app.py (app.py --serve) and its command line client.
+
+Starting app.py costs interpreter start-up, the spikeinterface/matplotlib/torch
+imports, parsing the probe file and initializing the compute device, which for short
+recordings can take longer than the recording itself. The service pays this once and
+then processes jobs submitted over a local HTTP endpoint (127.0.0.1 or a Unix socket),
+one at a time, in the same warm process.
+
+A job is a recording path plus overrides of app.py's command line options, given by
+option name ({"freq_min": 250, "sort_params": {"Th_universal": 8}, "force_cpu": true});
+options that only make sense for a whole batch cannot be overridden.
+
+    POST   /jobs        {"recording_file": ..., "overrides": {...}}  -> job
+    GET    /jobs        all jobs
+    GET    /jobs/<id>   status, current stage and per-stage metrics of one job
+    DELETE /jobs/<id>   cancel a queued job
+    GET    /health      service state
+
+Client: python service.py submit <recording> [--set freq_min=250 ...] [--wait]
+        python service.py status [<job id>]
+"""
+import os
+import copy
+import json
+import time
+import uuid
+import queue
+import socket
+import argparse
+import threading
+import http.client
+import socketserver
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Options of app.py that configure the batch or the service itself, not a recording.
+BATCH_ONLY_OPTIONS = {
+    "serve", "serve_port", "serve_socket", "data_folder", "recording_file", "disable_batch", "manifest",
+    "settle_seconds", "watch", "watch_interval", "shared_queue", "lease_seconds", "auto_resources", "dry_run",
+    "max_workers", "max_scratch", "pipeline", "pipeline_depth",
+}
+MAX_FINISHED_JOBS = 1000
+
+def overrides_to_args(parser, base_args, overrides):
+    """
+    Apply {option name: value} overrides to a copy of the service's parsed options,
+    converting and validating them with app.py's own parser.
+    Switches take only JSON booleans (true/false).
+    Raises ValueError for unknown, batch-only or invalid options.
+    """
+    actions = {action.dest: action for action in parser._actions if action.option_strings}
+    argv = []
+    switches = {}
+    for name, value in overrides.items():
+        dest = name.lstrip("-").replace("-", "_")
+        action = actions.get(dest)
+        if action is None or dest in BATCH_ONLY_OPTIONS:
+            raise ValueError(f"Option '{name}' cannot be set per job.")
+        flag = max(action.option_strings, key=len)
+        if isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction)):
+            # Only JSON booleans: bool("false") would turn the switch on.
+            if not isinstance(value, bool):
+                raise ValueError(f"Option '{name}' is a switch and takes true or false, not {value!r}.")
+            switches[dest] = value if isinstance(action, argparse._StoreTrueAction) else not value
+        elif isinstance(value, (dict, list)):
+            argv += [flag, json.dumps(value)]
+        else:
+            argv += [flag, str(value)]
+    try:
+        args = parser.parse_args(argv, namespace=copy.copy(base_args))
+    except SystemExit:
+        raise ValueError(f"Invalid option values: {' '.join(argv)}")
+    for dest, value in switches.items():
+        setattr(args, dest, value)
+    return args
+
+class WorkerService:
+    """
+    Job registry and the worker thread that runs the jobs in this process.
+    """
+    def __init__(self, parser, base_args):
+        self.parser = parser
+        self.base_args = base_args
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.probes = {}
+        self.device = None
+        self.started = time.time()
+
+    def warm_up(self):
+        """
+        Import the processing modules, initialize the compute device and parse the default probe.
+        """
+        from app import preload_stage_modules, is_gpu_available
+        start = time.perf_counter()
+        import_s = preload_stage_modules()
+        try:
+            import kilosort
+        except ImportError:
+            pass
+        self.device = "cpu" if self.base_args.force_cpu or not is_gpu_available() else "cuda"
+        if self.device == "cuda":
+            import torch
+            # Creating a tensor initializes the CUDA context once, not on the first sort.
+            torch.zeros(1, device="cuda")
+        self.probe(self.base_args.prb_file)
+        print(f"Worker warmed up in {time.perf_counter() - start:.2f} s ({import_s:.2f} s of imports, "
+              f"device {self.device}).")
+
+    def probe(self, prb_file):
+        """
+        Parsed probe for prb_file (None for the default probe), cached per file and mtime.
+        """
+        from app import load_probe
+        path = os.path.abspath(prb_file) if prb_file else None
+        cache_key = (path, os.path.getmtime(path) if path and os.path.exists(path) else None)
+        if cache_key not in self.probes:
+            self.probes[cache_key] = load_probe(prb_file)
+        return self.probes[cache_key]
+
+    def submit(self, recording_file, overrides):
+        from curation import parse_thresholds
+        args = overrides_to_args(self.parser, self.base_args, overrides or {})
+        json.loads(args.sort_params)
+        parse_thresholds(args.curation_thresholds)
+        if args.window_duration is not None and args.window_duration <= args.window_overlap:
+            raise ValueError("window_duration must be longer than window_overlap.")
+        if not os.path.isfile(recording_file):
+            raise ValueError(f"Recording file '{recording_file}' does not exist.")
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "recording_file": os.path.abspath(recording_file),
+            "overrides": overrides or {},
+            "status": "queued",
+            "stage": None,
+            "stages": [],
+            "submitted": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+            self._forget_old_jobs()
+        self.queue.put((job["id"], args))
+        return self.get(job["id"])
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] != "queued":
+                return False
+            job["status"] = "cancelled"
+            return True
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def list(self):
+        with self.lock:
+            return [copy.deepcopy(job) for job in self.jobs.values()]
+
+    def health(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"status": "ok", "device": self.device, "uptime_s": round(time.time() - self.started, 1),
+                "jobs": counts}
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job["status"] not in ("queued", "running")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def run_forever(self):
+        """
+        Worker loop: run queued jobs one at a time with process_recording.
+        """
+        from app import process_recording, recording_kwargs_from_args, make_recording_job
+        while True:
+            job_id, args = self.queue.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None or job["status"] != "queued":
+                    continue
+                job.update(status="running", started=datetime.now().isoformat(timespec="seconds"))
+
+            def on_stage(stage, record):
+                with self.lock:
+                    if record is None:
+                        job["stage"] = stage
+                        job["stages"].append({"stage": stage, "status": "running"})
+                    else:
+                        job["stages"][-1] = dict(record)
+                        job["stage"] = None
+
+            try:
+                probe_object = self.probe(args.prb_file)
+                if probe_object is None:
+                    raise ValueError(f"Probe file '{args.prb_file}' not found.")
+                kwargs = recording_kwargs_from_args(args, probe_object, json.loads(args.sort_params))
+                status = process_recording(recording_file=job["recording_file"], n_jobs=args.n_jobs,
+                                           total_memory=args.total_memory, on_stage=on_stage, **kwargs)
+                error = None
+            except Exception as e:
+                status, error = "failed", str(e)
+            output_base = make_recording_job(job["recording_file"], args.output_folder)["output_base"]
+            with self.lock:
+                job.update(status=status, stage=None, output=str(output_base),
+                           finished=datetime.now().isoformat(timespec="seconds"))
+                if error:
+                    job["error"] = error
+            print(f"[service] Job {job_id} ({os.path.basename(job['recording_file'])}): {status}.")
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body):
+        data = json.dumps(body, indent=2).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["health"]:
+            self._send(200, self.service.health())
+        elif parts == ["jobs"]:
+            self._send(200, self.service.list())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.service.get(parts[1])
+            if job is None:
+                self._send(404, {"error": "unknown job"})
+            else:
+                self._send(200, job)
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.strip("/") != "jobs":
+            return self._send(404, {"error": "not found"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.service.submit(body["recording_file"], body.get("overrides"))
+        except KeyError:
+            return self._send(400, {"error": "recording_file is required"})
+        except ValueError as e:
+            return self._send(400, {"error": str(e)})
+        self._send(202, job)
+
+    def do_DELETE(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs" and self.service.cancel(parts[1]):
+            self._send(200, self.service.get(parts[1]))
+        else:
+            self._send(409, {"error": "only queued jobs can be cancelled"})
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(parser, args):
+    """
+    Warm up, start the worker thread and answer requests until interrupted.
+    """
+    service = WorkerService(parser, args)
+    service.warm_up()
+    threading.Thread(target=service.run_forever, name="service-worker", daemon=True).start()
+    handler = type("Handler", (_Handler,), {"service": service})
+    if args.serve_socket:
+        if os.path.exists(args.serve_socket):
+            os.remove(args.serve_socket)
+        server = _UnixHTTPServer(args.serve_socket, handler)
+        where = f"unix socket {args.serve_socket}"
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", args.serve_port), handler)
+        where = f"http://127.0.0.1:{args.serve_port}"
+    print(f"Worker service listening on {where}.")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if args.serve_socket and os.path.exists(args.serve_socket):
+            os.remove(args.serve_socket)
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=30):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def request(method, path, body=None, port=8765, socket_path=None):
+    """
+    Send one request to the service and return (status code, decoded JSON body).
+    """
+    connection = _UnixHTTPConnection(socket_path) if socket_path else http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b"null")
+    finally:
+        connection.close()
+
+def _parse_override(text):
+    name, _, value = text.partition("=")
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+def _print_job(job):
+    stages = ", ".join(f"{stage['stage']} {stage.get('status')}" +
+                       (f" {stage['wall_s']:.1f}s" if "wall_s" in stage else "") for stage in job["stages"])
+    print(f"{job['id']}  {job['status']:<9}  {os.path.basename(job['recording_file'])}" +
+          (f"  [{stages}]" if stages else "") + (f"  error: {job['error']}" if job.get("error") else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Client for the app.py worker service (app.py --serve).")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port of the service on 127.0.0.1 (default: 8765).")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="Unix socket of the service (instead of --port).")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="Submit a recording.")
+    submit.add_argument("recording_file", help="Recording (.rec) to process.")
+    submit.add_argument("--set", action="append", default=[], metavar="OPTION=VALUE",
+                        help="Override an app.py option for this job, e.g. --set freq_min=250 (repeatable).")
+    submit.add_argument("--wait", action="store_true",
+                        help="Wait for the job to finish and print its progress.")
+    status = commands.add_parser("status", help="Show all jobs or one job.")
+    status.add_argument("job_id", nargs="?", default=None, help="Job to show (default: all).")
+    commands.add_parser("health", help="Show the service state.")
+    args = parser.parse_args()
+    connect = dict(port=args.port, socket_path=args.socket)
+
+    if args.command == "health":
+        print(json.dumps(request("GET", "/health", **connect)[1], indent=2))
+    elif args.command == "status":
+        code, body = request("GET", f"/jobs/{args.job_id}" if args.job_id else "/jobs", **connect)
+        if code != 200:
+            print(body["error"])
+            return
+        for job in (body if isinstance(body, list) else [body]):
+            _print_job(job)
+    else:
+        overrides = dict(_parse_override(text) for text in args.set)
+        code, job = request("POST", "/jobs", {"recording_file": os.path.abspath(args.recording_file),
+                                              "overrides": overrides}, **connect)
+        if code != 202:
+            print(f"Rejected: {job['error']}")
+            return
+        print(f"Submitted job {job['id']}.")
+        last = None
+        while args.wait and job["status"] in ("queued", "running"):
+            time.sleep(2)
+            job = request("GET", f"/jobs/{job['id']}", **connect)[1]
+            progress = (job["status"], len(job["stages"]), job["stage"])
+            if progress != last:
+                _print_job(job)
+                last = progress
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Consolidated spike store of all sorted sessions, for cross-session analysis.
+
+Every session's sorting lives in its own ss_output/phy folders; loading a few units over
+a few minutes of many sessions would mean opening every sorting in full. The store keeps
+one folder per session (named like its proc/ folder) with memory-mapped column files:
+
+    spike_store/<session>/samples.npy     int64    spike sample index (segments concatenated)
+    spike_store/<session>/amplitudes.npy  float32  spike amplitude (NaN without --compute-amplitudes)
+    spike_store/<session>/units.json      unit table: unit id, spike offset and count, extremum
+                                          channel (id, index, group, position)
+    spike_store/<session>/session.json    recording, sampling frequency, duration, spike count, key
+
+Spikes are sorted by unit and then by time, so the spikes of a unit are one contiguous
+slice (offset, count) and a time window within it is found with a binary search; a
+query only pages in the spikes it returns. Sessions are written to a temporary folder
+and renamed into place, so concurrent workers and readers never see a partial session.
+catalog.json caches the session summaries and is reconciled with the folder listing
+when the store is opened.
+
+    python spike_store.py build --output-folder /output      add completed sessions not in the store yet
+    python spike_store.py summary --output-folder /output
+    python spike_store.py query --output-folder /output --session S --unit 3 --start 60 --end 120
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+STORE_FOLDER_NAME = "spike_store"
+COLUMNS = {"samples": np.int64, "amplitudes": np.float32}
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp{uuid.uuid4().hex}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def session_columns(analyzer, peak_sign="neg"):
+    """
+    Spike columns and unit table of a sorting analyzer, sorted by unit and time.
+    Amplitudes come from the spike_amplitudes extension and the channel of every unit
+    is the extremum channel of its template.
+    """
+    from spikeinterface.core import get_template_extremum_channel
+
+    sorting = analyzer.sorting
+    recording_lengths = [analyzer.get_num_samples(segment_index)
+                         for segment_index in range(analyzer.get_num_segments())]
+    segment_starts = np.concatenate([[0], np.cumsum(recording_lengths)[:-1]]).astype(np.int64)
+
+    spikes = sorting.to_spike_vector()
+    samples = spikes["sample_index"].astype(np.int64) + segment_starts[spikes["segment_index"]]
+    if analyzer.has_extension("spike_amplitudes"):
+        amplitudes = analyzer.get_extension("spike_amplitudes").get_data().astype(np.float32)
+    else:
+        amplitudes = np.full(len(spikes), np.nan, dtype=np.float32)
+    order = np.lexsort((samples, spikes["unit_index"]))
+    unit_indices = spikes["unit_index"][order]
+
+    unit_ids = sorting.unit_ids
+    counts = np.bincount(unit_indices, minlength=len(unit_ids))
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    channel_ids = analyzer.channel_ids
+    if analyzer.has_extension("templates"):
+        extremum = get_template_extremum_channel(analyzer, peak_sign=peak_sign, outputs="index")
+        channel_indices = np.array([extremum[unit_id] for unit_id in unit_ids], dtype=int)
+    else:
+        channel_indices = np.full(len(unit_ids), -1)
+    groups = analyzer.get_recording_property("group")
+    locations = analyzer.get_channel_locations()
+
+    def channel_value(values, index):
+        return values[index].tolist() if index >= 0 and values is not None else None
+
+    units = {
+        "unit_id": unit_ids.tolist(),
+        "offset": offsets.tolist(),
+        "count": counts.tolist(),
+        "channel_index": channel_indices.tolist(),
+        "channel_id": [channel_value(channel_ids, i) for i in channel_indices],
+        "group": [channel_value(groups, i) for i in channel_indices],
+        "position": [channel_value(locations, i) for i in channel_indices],
+    }
+    columns = {"samples": samples[order], "amplitudes": amplitudes[order]}
+    return columns, units, int(sum(recording_lengths))
+
+def ingest_session(store_folder, session, analyzer, key=None, recording_file=None, peak_sign="neg"):
+    """
+    Write (or replace) one session in the store from its sorting analyzer.
+    Returns a report dict with the number of spikes and units and the bytes written.
+    """
+    start = time.perf_counter()
+    store_folder = Path(store_folder)
+    columns, units, num_samples = session_columns(analyzer, peak_sign=peak_sign)
+    sampling_frequency = float(analyzer.sampling_frequency)
+
+    os.makedirs(store_folder, exist_ok=True)
+    tmp_folder = store_folder / f".{session}.tmp{uuid.uuid4().hex}"
+    os.makedirs(tmp_folder)
+    for name, dtype in COLUMNS.items():
+        np.save(tmp_folder / f"{name}.npy", np.ascontiguousarray(columns[name], dtype=dtype))
+    _write_json(tmp_folder / "units.json", units)
+    info = {
+        "session": session,
+        "recording_file": str(recording_file) if recording_file else None,
+        "key": key,
+        "sampling_frequency": sampling_frequency,
+        "num_samples": num_samples,
+        "duration_s": num_samples / sampling_frequency,
+        "num_spikes": int(len(columns["samples"])),
+        "num_units": len(units["unit_id"]),
+        "created": time.time(),
+    }
+    _write_json(tmp_folder / "session.json", info)
+
+    # Swap the new session in; the old one (if any) is moved aside first, since a
+    # non-empty folder cannot be replaced by a rename.
+    session_folder = store_folder / session
+    old_folder = None
+    if session_folder.exists():
+        old_folder = store_folder / f".{session}.old{uuid.uuid4().hex}"
+        os.rename(session_folder, old_folder)
+    os.rename(tmp_folder, session_folder)
+    if old_folder is not None:
+        shutil.rmtree(old_folder, ignore_errors=True)
+
+    num_bytes = sum(os.path.getsize(session_folder / name) for name in os.listdir(session_folder))
+    return {"num_spikes": info["num_spikes"], "num_units": info["num_units"], "bytes": num_bytes,
+            "seconds": round(time.perf_counter() - start, 3)}
+
+class SpikeStore:
+    """
+    Read access to a spike store folder. Column files are memory-mapped on first use.
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.catalog = {}
+        self._sessions = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reconcile catalog.json with the session folders; only sessions whose
+        session.json changed are read again. Returns the session summaries.
+        """
+        catalog_path = self.folder / "catalog.json"
+        cached = _read_json(catalog_path) or {}
+        catalog = {}
+        names = sorted(os.listdir(self.folder)) if self.folder.is_dir() else []
+        for name in names:
+            if name.startswith(".") or not (self.folder / name).is_dir():
+                continue
+            try:
+                mtime_ns = os.stat(self.folder / name / "session.json").st_mtime_ns
+            except OSError:
+                continue
+            entry = cached.get(name)
+            if entry is None or entry.get("mtime_ns") != mtime_ns:
+                info = _read_json(self.folder / name / "session.json")
+                if info is None:
+                    continue
+                entry = dict(info, mtime_ns=mtime_ns)
+            catalog[name] = entry
+        if catalog != cached and self.folder.is_dir():
+            _write_json(catalog_path, catalog)
+        self.catalog = catalog
+        self._sessions = {name: data for name, data in self._sessions.items()
+                          if name in catalog and data["mtime_ns"] == catalog[name]["mtime_ns"]}
+        return catalog
+
+    def sessions(self):
+        return list(self.catalog)
+
+    def _session(self, session):
+        if session not in self.catalog:
+            raise KeyError(f"Session '{session}' is not in the spike store.")
+        data = self._sessions.get(session)
+        if data is None:
+            session_folder = self.folder / session
+            units = _read_json(session_folder / "units.json")
+            data = {
+                "mtime_ns": self.catalog[session]["mtime_ns"],
+                "units": units,
+                "unit_rows": {str(unit_id): row for row, unit_id in enumerate(units["unit_id"])},
+                "columns": {name: np.load(session_folder / f"{name}.npy", mmap_mode="r") for name in COLUMNS},
+            }
+            self._sessions[session] = data
+        return data
+
+    def units(self, session):
+        """
+        Unit table of a session as a list of dicts.
+        """
+        units = self._session(session)["units"]
+        return [dict(zip(units, values)) for values in zip(*units.values())]
+
+    def get_spikes(self, session, unit_ids=None, start_s=None, end_s=None):
+        """
+        Spikes of the given units (default: all) of a session between start_s and end_s
+        (seconds from the start of the session). Returns a dict of arrays: unit_id,
+        time_s, sample_index and amplitude, ordered by unit and time.
+        """
+        data = self._session(session)
+        units = data["units"]
+        sampling_frequency = self.catalog[session]["sampling_frequency"]
+        rows = range(len(units["unit_id"])) if unit_ids is None else [
+            data["unit_rows"][str(unit_id)] for unit_id in unit_ids if str(unit_id) in data["unit_rows"]]
+        samples = data["columns"]["samples"]
+        start_sample = None if start_s is None else int(np.ceil(start_s * sampling_frequency))
+        end_sample = None if end_s is None else int(np.ceil(end_s * sampling_frequency))
+
+        slices = []
+        # Only the spikes of the requested units (and the search within them) are paged in.
+        for row in rows:
+            first = units["offset"][row]
+            last = first + units["count"][row]
+            unit_samples = samples[first:last]
+            lo = first if start_sample is None else first + int(np.searchsorted(unit_samples, start_sample, "left"))
+            hi = last if end_sample is None else first + int(np.searchsorted(unit_samples, end_sample, "left"))
+            if hi > lo:
+                slices.append((row, lo, hi))
+
+        amplitudes = data["columns"]["amplitudes"]
+        spike_samples = np.concatenate([samples[lo:hi] for _, lo, hi in slices] + [np.zeros(0, np.int64)])
+        spike_rows = np.repeat([row for row, _, _ in slices], [hi - lo for _, lo, hi in slices]).astype(int)
+        return {
+            "unit_id": np.asarray(units["unit_id"])[spike_rows],
+            "time_s": spike_samples / sampling_frequency,
+            "sample_index": spike_samples,
+            "amplitude": np.concatenate([amplitudes[lo:hi] for _, lo, hi in slices] + [np.zeros(0, np.float32)]),
+        }
+
+    def query(self, sessions=None, unit_ids=None, start_s=None, end_s=None):
+        """
+        Yield (session, spikes) for every session (default: all) with spikes in the
+        requested units and time window; see get_spikes.
+        """
+        for session in (sessions or self.sessions()):
+            spikes = self.get_spikes(session, unit_ids=unit_ids, start_s=start_s, end_s=end_s)
+            if len(spikes["sample_index"]):
+                yield session, spikes
+
+def store_folder_for(output_folder):
+    return Path(output_folder) / STORE_FOLDER_NAME
+
+def build_store(output_folder, peak_sign="neg", rebuild=False):
+    """
+    Add every completed session under <output_folder>/proc to the store, skipping
+    sessions that are already stored with the same Phy stage key.
+    """
+    import spikeinterface as si
+    from stage_cache import read_marker
+
+    store_folder = store_folder_for(output_folder)
+    store = SpikeStore(store_folder)
+    proc_folder = Path(output_folder) / "proc"
+    added = 0
+    for session_folder in sorted(proc_folder.iterdir()) if proc_folder.is_dir() else []:
+        session = session_folder.name
+        analyzer_dir = session_folder / "waveforms"
+        if not (session_folder / "complete.txt").exists() or not analyzer_dir.is_dir():
+            continue
+        marker = read_marker(session_folder / "phy", "phy")
+        key = marker.get("key") if marker else None
+        if not rebuild and session in store.catalog and store.catalog[session].get("key") == key:
+            continue
+        try:
+            analyzer = si.load_sorting_analyzer(analyzer_dir, load_extensions=True)
+            report = ingest_session(store_folder, session, analyzer, key=key, peak_sign=peak_sign)
+        except Exception as e:
+            print(f"Could not add {session} to the spike store: {e}")
+            continue
+        print(f"Added {session}: {report['num_units']} units, {report['num_spikes']} spikes "
+              f"({report['bytes'] / 1e6:.1f} MB) in {report['seconds']:.2f} s.")
+        added += 1
+    store.refresh()
+    print(f"Spike store {store_folder}: {added} session(s) added, {len(store.catalog)} in total.")
+    return store
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the consolidated spike store of app.py outputs.")
+    parser.add_argument("command", choices=["build", "summary", "query"],
+                        help="build: add completed sessions; summary: list sessions; query: extract spikes.")
+    parser.add_argument("--output-folder", type=str, default=".",
+                        help="Output folder of app.py (the store is <output-folder>/spike_store).")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="build: rewrite sessions that are already in the store.")
+    parser.add_argument("--spike-amp-peak-sign", type=str, default="neg",
+                        help="build: peak sign used to find every unit's extremum channel.")
+    parser.add_argument("--session", type=str, action="append", default=None,
+                        help="query: session(s) to read (repeatable; default: all).")
+    parser.add_argument("--unit", type=str, action="append", default=None,
+                        help="query: unit id(s) to read (repeatable; default: all).")
+    parser.add_argument("--start", type=float, default=None,
+                        help="query: start of the time window in seconds.")
+    parser.add_argument("--end", type=float, default=None,
+                        help="query: end of the time window in seconds.")
+    parser.add_argument("--save", type=str, default=None,
+                        help="query: save the spikes to this .npz file (arrays prefixed with the session name).")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_store(args.output_folder, peak_sign=args.spike_amp_peak_sign, rebuild=args.rebuild)
+        return
+    store = SpikeStore(store_folder_for(args.output_folder))
+    if args.command == "summary":
+        print(f"{'session':<40} {'units':>6} {'spikes':>10} {'duration':>10}")
+        for session, info in store.catalog.items():
+            print(f"{session:<40} {info['num_units']:>6} {info['num_spikes']:>10} {info['duration_s']:>9.1f}s")
+        return
+
+    start = time.perf_counter()
+    arrays = {}
+    total = 0
+    for session, spikes in store.query(args.session, args.unit, args.start, args.end):
+        units, counts = np.unique(spikes["unit_id"].astype(str), return_counts=True)
+        print(f"{session}: {len(spikes['sample_index'])} spikes in {len(units)} unit(s) "
+              f"({', '.join(f'{unit}: {count}' for unit, count in zip(units, counts))})")
+        total += len(spikes["sample_index"])
+        arrays.update({f"{session}/{name}": values for name, values in spikes.items()})
+    print(f"{total} spikes read in {time.perf_counter() - start:.3f} s.")
+    if args.save:
+        np.savez(args.save, **arrays)
+        print("Saved to", args.save)
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,6 @@ if %errorlevel% neq 0 (
 echo Pulling Latest Version of Image: spikesort...
 docker pull padillacoreanolab/spikesort:latest
 
-:: Stop and remove any existing container with the same name
-echo Shutting down any existing container named spikesort_c...
-docker stop spikesort_c >nul 2>&1
-docker rm spikesort_c >nul 2>&1
-
 :: Prompt for all command-line parameters
 echo.
 set /p HOST_DATA_FOLDER="Enter the full path to the data folder (the folder that contains recording files): "
@@ -39,6 +34,14 @@ set /p RANDOM_SPIKES_MAX="Enter --random-spikes-max (default 200): "
 set /p PC_N_COMPONENTS="Enter --pc-n-components (default 3): "
 set /p PC_MODE="Enter --pc-mode (default 'by_channel_local'): "
 set /p SPIKE_AMP_PEAK_SIGN="Enter --spike-amp-peak-sign (default 'neg'): "
+set /p EXTRA_ARGS="Enter any additional arguments (e.g. --max-workers 4) or leave blank: "
+set /p CONTAINER_NAME="Enter a container name (use a different one per worker with --shared-queue) (default 'spikesort_c'): "
+if "%CONTAINER_NAME%"=="" set "CONTAINER_NAME=spikesort_c"
+
+:: Stop and remove any existing container with the same name
+echo Shutting down any existing container named %CONTAINER_NAME%...
+docker stop %CONTAINER_NAME% >nul 2>&1
+docker rm %CONTAINER_NAME% >nul 2>&1
 
 :: Convert backslashes to forward slashes if variables are not empty
 if not "%HOST_DATA_FOLDER%"=="" set "HOST_DATA_FOLDER=%HOST_DATA_FOLDER:\=/%"
@@ -92,7 +95,7 @@ echo.
 echo Running Docker container with your parameters...
 
 :: Run Docker with both data and output folders mounted.
-docker run --rm -it --name spikesort_c --gpus all --log-driver=json-file -v "%HOST_DATA_FOLDER%:/spikesort" -v "%OUTPUT_FOLDER%:/output" padillacoreanolab/spikesort:latest bash -c "chmod -R 777 /output && source /root/miniconda3/etc/profile.d/conda.sh && conda activate spikesort && python app.py --data-folder /spikesort --output-folder \"/output\" %PRB_ARG% %DISABLE_ARG% %REC_ARG% --stream-id \"%STREAM_ID%\" --freq-min \"%FREQ_MIN%\" --freq-max \"%FREQ_MAX%\" --whiten-dtype \"%WHITEN_DTYPE%\" --sort-params \"%SORT_PARAMS%\" %FORCE_ARG% --ms-before \"%MS_BEFORE%\" --ms-after \"%MS_AFTER%\" --n-jobs \"%N_JOBS%\" --total-memory \"%TOTAL_MEMORY%\" --compute-pc-features \"%COMPUTE_PC_FEATURES%\" --compute-amplitudes \"%COMPUTE_AMPLITUDES%\" --random-spikes-max \"%RANDOM_SPIKES_MAX%\" --pc-n-components \"%PC_N_COMPONENTS%\" --pc-mode \"%PC_MODE%\" --spike-amp-peak-sign \"%SPIKE_AMP_PEAK_SIGN%\""
+docker run --rm -it --name %CONTAINER_NAME% --gpus all --log-driver=json-file -v "%HOST_DATA_FOLDER%:/spikesort" -v "%OUTPUT_FOLDER%:/output" padillacoreanolab/spikesort:latest bash -c "chmod -R 777 /output && source /root/miniconda3/etc/profile.d/conda.sh && conda activate spikesort && python app.py --data-folder /spikesort --output-folder \"/output\" %PRB_ARG% %DISABLE_ARG% %REC_ARG% --stream-id \"%STREAM_ID%\" --freq-min \"%FREQ_MIN%\" --freq-max \"%FREQ_MAX%\" --whiten-dtype \"%WHITEN_DTYPE%\" --sort-params \"%SORT_PARAMS%\" %FORCE_ARG% --ms-before \"%MS_BEFORE%\" --ms-after \"%MS_AFTER%\" --n-jobs \"%N_JOBS%\" --total-memory \"%TOTAL_MEMORY%\" --compute-pc-features \"%COMPUTE_PC_FEATURES%\" --compute-amplitudes \"%COMPUTE_AMPLITUDES%\" --random-spikes-max \"%RANDOM_SPIKES_MAX%\" --pc-n-components \"%PC_N_COMPONENTS%\" --pc-mode \"%PC_MODE%\" --spike-amp-peak-sign \"%SPIKE_AMP_PEAK_SIGN%\" %EXTRA_ARGS%"
 
 echo.
 echo Container finished. Press any key to exit...
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Per-stage result cache for app.py.
+
+Every stage output folder (preprocessed recording, sorter output, waveforms, Phy export)
+gets a small marker file recording the stage key it was built with. A stage key is a
+hash of the stage's parameters and the keys of the stages it depends on; the first key
+in the chain is a content fingerprint of the raw recording. On a rerun a stage is reused
+when its marker matches the key computed for this run, and recomputed otherwise, which
+also invalidates everything downstream of it.
+
+Cached folders can be evicted least-recently-used first to keep the scratch volume
+under a size cap.
+"""
+import os
+import json
+import time
+import socket
+import shutil
+import hashlib
+from pathlib import Path
+
+MARKER_PREFIX = ".stage_"
+IN_PROGRESS_MARKER = ".in_progress"
+
+def _json_default(obj):
+    # numpy arrays/scalars (e.g. in probe dicts) are hashed by value, not by repr.
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+def fingerprint_file(path, sample_size=1 << 20):
+    """
+    Content fingerprint of a (large) file: its size plus the first, middle and last
+    sample_size bytes. Hashing multi-GB .rec files fully would cost as much as reading
+    them; the samples cover the header, the data and the end of the acquisition.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        for offset in (0, max(0, size // 2 - sample_size // 2), max(0, size - sample_size)):
+            f.seek(offset)
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+def stage_key(stage, params, upstream_keys=()):
+    """
+    Hash a stage name, its parameters and the keys of its upstream stages.
+    """
+    payload = json.dumps({"stage": stage, "params": params, "upstream": list(upstream_keys)},
+                         sort_keys=True, default=_json_default)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _marker_path(stage_dir, stage):
+    return Path(stage_dir) / f"{MARKER_PREFIX}{stage}.json"
+
+def read_marker(stage_dir, stage):
+    """
+    Return the marker dict stored for a stage in stage_dir, or None.
+    """
+    try:
+        with open(_marker_path(stage_dir, stage), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def is_stage_cached(stage_dir, stage, key):
+    """
+    True if stage_dir holds a completed result for this stage key.
+    A hit refreshes the entry's last-used time for LRU eviction.
+    """
+    marker = read_marker(stage_dir, stage)
+    if marker is None or marker.get("key") != key:
+        return False
+    marker["last_used"] = time.time()
+    _write_json(_marker_path(stage_dir, stage), marker)
+    return True
+
+def commit_stage(stage_dir, stage, key, params=None, evictable=True):
+    """
+    Record that stage_dir now holds the result for this stage key.
+    Call this only after the stage finished, so an interrupted stage is never reused.
+    """
+    now = time.time()
+    _write_json(_marker_path(stage_dir, stage), {
+        "stage": stage,
+        "key": key,
+        "params": params,
+        "evictable": evictable,
+        "created": now,
+        "last_used": now,
+    })
+
+def pin_stage(stage_dir, stage):
+    """
+    Exclude a stage folder from eviction, e.g. because a final output refers to it.
+    """
+    marker = read_marker(stage_dir, stage)
+    if marker is not None and marker.get("evictable", True):
+        marker["evictable"] = False
+        _write_json(_marker_path(stage_dir, stage), marker)
+
+def invalidate_stage(stage_dir):
+    """
+    Remove a stale or partial stage output folder.
+    """
+    if Path(stage_dir).exists():
+        print(f"Removing stale stage output: {stage_dir}")
+        shutil.rmtree(str(stage_dir))
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2, default=_json_default)
+    os.replace(tmp_path, path)
+
+def folder_size(folder):
+    """
+    Total size in bytes of all files below folder.
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def mark_in_progress(output_base):
+    """
+    Flag a recording folder as being processed so eviction leaves it alone.
+    """
+    _write_json(Path(output_base) / IN_PROGRESS_MARKER,
+                {"host": socket.gethostname(), "pid": os.getpid(), "started": time.time()})
+
+def clear_in_progress(output_base):
+    try:
+        os.remove(Path(output_base) / IN_PROGRESS_MARKER)
+    except OSError:
+        pass
+
+def _is_in_progress(output_base):
+    try:
+        with open(Path(output_base) / IN_PROGRESS_MARKER, "r") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if info.get("host") != socket.gethostname():
+        return True
+    try:
+        os.kill(info["pid"], 0)
+    except ProcessLookupError:
+        return False  # stale marker left by a crashed run
+    except (OSError, KeyError, TypeError):
+        pass
+    return True
+
+def evict_lru(root, size_cap_bytes):
+    """
+    Delete evictable cached stage folders below root, least recently used first, until
+    their total size is at most size_cap_bytes. Folders of recordings that are
+    currently being processed are never evicted. Returns the number of bytes freed.
+    """
+    entries = []
+    for marker_path in Path(root).glob(f"*/*/{MARKER_PREFIX}*.json"):
+        stage_dir = marker_path.parent
+        try:
+            with open(marker_path, "r") as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not marker.get("evictable", True):
+            continue
+        entries.append((marker.get("last_used", 0), stage_dir))
+
+    # A folder can hold several markers (e.g. waveforms + its extensions); use the newest.
+    last_used = {}
+    for used, stage_dir in entries:
+        last_used[stage_dir] = max(used, last_used.get(stage_dir, 0))
+    sizes = {stage_dir: folder_size(stage_dir) for stage_dir in last_used}
+    total = sum(sizes.values())
+
+    freed = 0
+    for stage_dir in sorted(last_used, key=last_used.get):
+        if total <= size_cap_bytes:
+            break
+        if _is_in_progress(stage_dir.parent):
+            continue
+        print(f"Evicting cached stage output {stage_dir} ({sizes[stage_dir] / 1024 ** 3:.2f} GB).")
+        shutil.rmtree(str(stage_dir), ignore_errors=True)
+        total -= sizes[stage_dir]
+        freed += sizes[stage_dir]
+    return freed
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Storage formats for the preprocessed recording written by app.py.
+
+'binary' is the plain float binary folder that the sorter and Phy can read in place.
+'zarr' stores the traces in a chunked, Blosc-zstd compressed zarr container; every
+parallel writer produces whole zarr chunks, and downstream stages read the chunks they
+need lazily. The footprint and write/read throughput of every save are reported so the
+trade-off can be chosen per rig.
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+
+from stage_cache import folder_size
+
+def preprocessed_folder_name(preproc_format):
+    """
+    Folder name of the preprocessed recording (spikeinterface appends '.zarr' for zarr).
+    """
+    return "preprocessed_recording_output.zarr" if preproc_format == "zarr" else "preprocessed_recording_output"
+
+def save_preprocessed(recording, folder, preproc_format="binary", compression_level=5,
+                      zarr_chunk_duration="1s", **job_kwargs):
+    """
+    Save recording to folder in the requested format.
+    Returns the saved (lazily read) recording and a storage report dict.
+
+    For zarr the write chunks are zarr_chunk_duration long and become the zarr chunks,
+    so parallel writers never share a chunk and readers decompress small pieces.
+    """
+    start = time.perf_counter()
+    if preproc_format == "zarr":
+        from numcodecs import Blosc
+        compressor = Blosc(cname="zstd", clevel=compression_level, shuffle=Blosc.BITSHUFFLE)
+        job_kwargs = {key: value for key, value in job_kwargs.items()
+                      if key not in ("total_memory", "chunk_memory", "chunk_size", "chunk_duration")}
+        folder = Path(folder)
+        if folder.suffix != ".zarr":
+            folder = folder.parent / f"{folder.stem}.zarr"
+        saved = recording.save(format="zarr", folder=str(folder), overwrite=True, compressor=compressor,
+                               chunk_duration=zarr_chunk_duration, **job_kwargs)
+    else:
+        saved = recording.save(folder=str(folder), overwrite=True, **job_kwargs)
+    write_seconds = time.perf_counter() - start
+
+    data_bytes = sum(saved.get_num_samples(segment_index) for segment_index in range(saved.get_num_segments())) \
+        * saved.get_num_channels() * saved.get_dtype().itemsize
+    stored_bytes = folder_size(folder)
+    report = {
+        "format": preproc_format,
+        "data_bytes": int(data_bytes),
+        "stored_bytes": int(stored_bytes),
+        "compression_ratio": round(data_bytes / max(stored_bytes, 1), 3),
+        "write_MB_per_s": round(data_bytes / write_seconds / 1e6, 1),
+    }
+    report["read_MB_per_s"] = measure_read_throughput(saved)
+    print(f"Preprocessed recording ({preproc_format}): {stored_bytes / 1e6:.1f} MB on disk for "
+          f"{data_bytes / 1e6:.1f} MB of traces (ratio {report['compression_ratio']:.2f}), "
+          f"write {report['write_MB_per_s']:.0f} MB/s, read {report['read_MB_per_s']:.0f} MB/s.")
+    return saved, report
+
+def measure_read_throughput(recording, max_seconds=30.0, chunk_seconds=1.0):
+    """
+    Read up to max_seconds of traces in chunk_seconds pieces and return MB/s.
+    """
+    fs = recording.get_sampling_frequency()
+    num_samples = min(recording.get_num_samples(0), int(max_seconds * fs))
+    chunk_size = max(1, int(chunk_seconds * fs))
+    n_bytes = 0
+    start = time.perf_counter()
+    for start_frame in range(0, num_samples, chunk_size):
+        traces = recording.get_traces(segment_index=0, start_frame=start_frame,
+                                      end_frame=min(start_frame + chunk_size, num_samples))
+        # Binary recordings return memmap views; copying makes the pages actually be read.
+        n_bytes += np.array(traces, copy=True).nbytes
+    return round(n_bytes / max(time.perf_counter() - start, 1e-9) / 1e6, 1)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Sorter parameter sweeps on one preprocessed recording.
+
+The recording is preprocessed once with the app.py preprocessing stage (and its stage
+cache, so a recording already processed by app.py with the same preprocessing
+parameters is not preprocessed again). Every sorter configuration of the grid then runs
+in its own worker process against the same memory-mapped preprocessed binary, several
+at a time. The runtime, unit and spike counts of every configuration and the pairwise
+agreement between their sortings are written to a comparison table.
+
+The grid is a JSON object mapping a sorter name to its parameters; list values are
+swept (Cartesian product), scalar values are fixed:
+
+    {"kilosort4": {"Th_universal": [8, 9, 10], "Th_learned": [7, 8]},
+     "mountainsort5": {"scheme2_detect_channel_radius": [100, 700]}}
+
+Any spikeinterface sorter can be used. Kilosort4 runs on the CPU and MountainSort5 gets
+the settings of the old sorting_scheme2 pipeline (old_app.py), without its own
+filtering and whitening since the input is already preprocessed, unless the grid
+overrides them.
+"""
+import os
+import json
+import time
+import argparse
+import itertools
+from pathlib import Path
+
+from scheduler import run_concurrent_batch, split_budget
+from stage_cache import stage_key
+
+DEFAULT_PRB_FILE = Path(__file__).parent / "nancyprobe_linearprobelargespace.prb"
+
+# Fixed parameters per sorter, applied before the grid's own values.
+SORTER_DEFAULTS = {
+    "kilosort4": {"torch_device": "cpu"},
+    "mountainsort5": {"scheme": "2", "detect_sign": 0, "scheme2_phase1_detect_channel_radius": 700,
+                      "scheme2_detect_channel_radius": 700, "filter": False, "whiten": False},
+}
+
+def expand_grid(grid):
+    """
+    Expand a {sorter: {param: value or [values]}} grid into a list of
+    (config name, sorter, params) tuples. The name includes a short hash of the params.
+    """
+    configs = []
+    for sorter, sweep in grid.items():
+        names = list(sweep)
+        values = [value if isinstance(value, list) else [value] for value in sweep.values()]
+        for combination in itertools.product(*values):
+            params = dict(SORTER_DEFAULTS.get(sorter, {}), **dict(zip(names, combination)))
+            configs.append((f"{sorter}_{stage_key(sorter, params)[:8]}", sorter, params))
+    return configs
+
+def load_grid(grid):
+    """
+    Parse the --grid argument, a JSON string or the path of a JSON file.
+    """
+    if os.path.isfile(grid):
+        with open(grid, "r") as f:
+            return json.load(f)
+    return json.loads(grid)
+
+def preprocess_once(args, probe_object):
+    """
+    Run (or reuse) the app.py preprocessing stage and return the preprocessed folder.
+    """
+    import app
+
+    job = app.make_recording_job(
+        args.recording_file, args.output_folder,
+        probe_object=probe_object, sort_params={}, stream_id=args.stream_id, rec_reader=args.rec_reader,
+        freq_min=args.freq_min, freq_max=args.freq_max, whiten_dtype=args.whiten_dtype, force_cpu=True,
+        ms_before=1, ms_after=1, n_jobs=args.n_jobs, total_memory=args.total_memory,
+        compute_pc_features=False, compute_amplitudes=False, random_spikes_max=200, pc_n_components=3,
+        pc_mode="by_channel_local", spike_amp_peak_sign="neg", phy_binary="link", split_by_group=False,
+        quantize=False, preproc_format="binary", zarr_compression_level=5
+    )
+    job["stage_keys"] = app.compute_stage_keys(job)
+    os.makedirs(job["output_base"], exist_ok=True)
+    start = time.perf_counter()
+    job = app.run_preprocessing_stage(job)
+    print(f"Preprocessing took {time.perf_counter() - start:.1f} s.")
+    return job["preproc_rec_dir"], job["stage_keys"]["preprocessing"], job["output_base"]
+
+def run_config(name, sorter, params, preprocessed_folder, preprocessing_key, config_folder, n_jobs):
+    """
+    Worker entry point: run one sorter configuration on the preprocessed recording and
+    write its result.json. A configuration whose result.json matches the same parameters
+    and preprocessed recording is not run again. Returns 'complete' or 'failed'.
+    """
+    config_folder = Path(config_folder)
+    result_path = config_folder / "result.json"
+    try:
+        with open(result_path, "r") as f:
+            previous = json.load(f)
+        if previous.get("status") == "ok" and previous.get("preprocessing_key") == preprocessing_key:
+            print(f"[sweep] Reusing {name}.")
+            return "complete"
+    except (OSError, ValueError):
+        pass
+
+    import spikeinterface as si
+    import spikeinterface.sorters as ss
+
+    result = {"name": name, "sorter": sorter, "params": params, "preprocessing_key": preprocessing_key}
+    os.makedirs(config_folder, exist_ok=True)
+    sorter_params = dict(params)
+    if "n_jobs" in ss.get_default_sorter_params(sorter):
+        sorter_params.setdefault("n_jobs", n_jobs)
+    start = time.perf_counter()
+    try:
+        recording = si.load_extractor(preprocessed_folder)
+        sorting = ss.run_sorter(sorter, recording, folder=str(config_folder / "sorter_output"),
+                                remove_existing_folder=True, verbose=False, **sorter_params)
+        sorting = sorting.save(folder=str(config_folder / "sorting"), overwrite=True)
+        result.update(status="ok", runtime_s=round(time.perf_counter() - start, 2),
+                      num_units=len(sorting.unit_ids), num_spikes=int(sorting.count_total_num_spikes()))
+    except Exception as e:
+        result.update(status="failed", runtime_s=round(time.perf_counter() - start, 2), error=str(e))
+        print(f"[sweep] {name} failed: {e}")
+    with open(result_path, "w") as f:
+        json.dump(result, f, indent=2)
+    return "complete" if result["status"] == "ok" else "failed"
+
+def compare_sortings(results, sweep_folder, delta_ms=0.4, match_score=0.5):
+    """
+    Pairwise agreement between the successful configurations. Two units match when
+    their agreement score (matched spikes / union of spikes) is at least match_score.
+    Adds 'consensus_units' (units matched in at least one other sorting) to every
+    result and returns the list of pairwise rows.
+    """
+    import spikeinterface as si
+    from spikeinterface.comparison import compare_two_sorters
+
+    ok = [result for result in results if result["status"] == "ok"]
+    sortings = {result["name"]: si.load_extractor(Path(sweep_folder) / result["name"] / "sorting") for result in ok}
+    matched_units = {result["name"]: set() for result in ok}
+    pairs = []
+    for result_a, result_b in itertools.combinations(ok, 2):
+        name_a, name_b = result_a["name"], result_b["name"]
+        comparison = compare_two_sorters(sortings[name_a], sortings[name_b], sorting1_name=name_a,
+                                         sorting2_name=name_b, delta_time=delta_ms, match_score=match_score)
+        match_12 = comparison.hungarian_match_12
+        matched = [(unit_a, unit_b) for unit_a, unit_b in match_12.items() if unit_b != -1]
+        scores = [float(comparison.agreement_scores.at[unit_a, unit_b]) for unit_a, unit_b in matched]
+        matched_units[name_a].update(unit_a for unit_a, _ in matched)
+        matched_units[name_b].update(unit_b for _, unit_b in matched)
+        pairs.append({"a": name_a, "b": name_b, "matched_units": len(matched),
+                      "mean_agreement": round(sum(scores) / len(scores), 3) if scores else 0.0})
+    for result in ok:
+        result["consensus_units"] = len(matched_units[result["name"]])
+    return pairs
+
+def write_tables(results, pairs, sweep_folder):
+    """
+    Print the per-configuration and pairwise tables and save them as TSV and JSON.
+    """
+    header = ["config", "sorter", "status", "runtime_s", "units", "spikes", "consensus_units", "params"]
+    rows = [[result["name"], result["sorter"], result["status"], f"{result.get('runtime_s', 0):.1f}",
+             str(result.get("num_units", "")), str(result.get("num_spikes", "")),
+             str(result.get("consensus_units", "")),
+             json.dumps({key: value for key, value in result["params"].items()
+                         if SORTER_DEFAULTS.get(result["sorter"], {}).get(key) != value})]
+            for result in results]
+    pair_header = ["config_a", "config_b", "matched_units", "mean_agreement"]
+    pair_rows = [[pair["a"], pair["b"], str(pair["matched_units"]), f"{pair['mean_agreement']:.3f}"] for pair in pairs]
+
+    for table_header, table_rows, file_name in ((header, rows, "sweep_results.tsv"),
+                                                (pair_header, pair_rows, "sweep_agreement.tsv")):
+        widths = [max(len(row[i]) for row in table_rows + [table_header]) for i in range(len(table_header))]
+        print()
+        for row in [table_header] + table_rows:
+            print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+        with open(Path(sweep_folder) / file_name, "w") as f:
+            f.write("\n".join("\t".join(row) for row in [table_header] + table_rows) + "\n")
+    with open(Path(sweep_folder) / "sweep_results.json", "w") as f:
+        json.dump({"configs": results, "agreement": pairs}, f, indent=2)
+    print(f"\nSweep tables saved to: {sweep_folder}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep sorter parameters on one preprocessed recording.")
+    parser.add_argument("--recording-file", type=str, required=True,
+                        help="Recording (.rec) to sweep.")
+    parser.add_argument("--grid", type=str, required=True,
+                        help="Sorter grid as a JSON string or JSON file: {sorter: {param: value or [values]}}.")
+    parser.add_argument("--output-folder", type=str, default=".",
+                        help="Output folder; app.py's preprocessed recording under <output-folder>/proc is reused "
+                             "(default: current directory).")
+    parser.add_argument("--prb-file", type=str, default=str(DEFAULT_PRB_FILE),
+                        help="Probe file (default: the default probe of app.py).")
+    parser.add_argument("--stream-id", type=str, default="trodes",
+                        help="Stream ID of the recording (default: 'trodes').")
+    parser.add_argument("--rec-reader", type=str, default="native", choices=["native", "neo"],
+                        help="Reader used for .rec files (default: 'native').")
+    parser.add_argument("--freq-min", type=float, default=300,
+                        help="Minimum frequency for bandpass filtering (default: 300).")
+    parser.add_argument("--freq-max", type=float, default=6000,
+                        help="Maximum frequency for bandpass filtering (default: 6000).")
+    parser.add_argument("--whiten-dtype", type=str, default="float32",
+                        help="Data type for whitening (default: 'float32').")
+    parser.add_argument("--n-jobs", type=int, default=os.cpu_count(),
+                        help="Total number of cores, shared by the concurrent configurations (default: all).")
+    parser.add_argument("--total-memory", type=str, default="4G",
+                        help="Chunk memory for preprocessing (default: '4G').")
+    parser.add_argument("--max-workers", type=int, default=2,
+                        help="Number of sorter configurations run concurrently (default: 2).")
+    parser.add_argument("--delta-ms", type=float, default=0.4,
+                        help="Spike time tolerance in ms when comparing sortings (default: 0.4).")
+    parser.add_argument("--match-score", type=float, default=0.5,
+                        help="Minimum agreement score for two units to match (default: 0.5).")
+    args = parser.parse_args()
+
+    from probeinterface import read_prb
+
+    configs = expand_grid(load_grid(args.grid))
+    if not configs:
+        print("The grid contains no sorter configurations.")
+        return
+    print(f"Sweeping {len(configs)} sorter configuration(s) on {args.recording_file}.")
+
+    preprocessed_folder, preprocessing_key, output_base = preprocess_once(args, read_prb(args.prb_file))
+    sweep_folder = Path(output_base) / "sweep"
+    os.makedirs(sweep_folder, exist_ok=True)
+
+    max_workers = max(1, min(args.max_workers, len(configs)))
+    n_jobs, _ = split_budget(args.n_jobs, args.total_memory, max_workers)
+    jobs = [(name, dict(name=name, sorter=sorter, params=params, preprocessed_folder=str(preprocessed_folder),
+                        preprocessing_key=preprocessing_key, config_folder=str(sweep_folder / name), n_jobs=n_jobs), 0)
+            for name, sorter, params in configs]
+    start = time.perf_counter()
+    # Sorters only read the preprocessed binary, so no extra scratch is reserved for it.
+    run_concurrent_batch(run_config, jobs, max_workers=max_workers, n_jobs=n_jobs, scratch_folder=str(sweep_folder))
+    print(f"Sorter configurations took {time.perf_counter() - start:.1f} s.")
+
+    results = []
+    for name, sorter, params in configs:
+        try:
+            with open(sweep_folder / name / "result.json", "r") as f:
+                results.append(json.load(f))
+        except (OSError, ValueError):
+            results.append({"name": name, "sorter": sorter, "params": params, "status": "failed"})
+    pairs = compare_sortings(results, sweep_folder, delta_ms=args.delta_ms, match_score=args.match_score)
+    write_tables(results, pairs, sweep_folder)
+
+if __name__ == "__main__":
+    import multiprocessing as mp
+    mp.set_start_method("fork", force=True)
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Per-sorting waveform cache for the sorting analyzer and the Phy export of app.py.
+
+Every change of --ms-before/--ms-after, --pc-n-components or of the Phy export used to
+re-sample the spikes of every unit and read their waveforms from the preprocessed
+recording again. The cache folder (<recording>/waveform_cache) keeps, for one sorting:
+
+- random_spikes.npy: a seeded, time-stratified spike subsample. With the 'count_aware'
+  policy, units with many more spikes than the median unit get more waveforms (up to
+  COUNT_AWARE_MAX_FACTOR x --random-spikes-max), so their templates follow drift over
+  long sessions; units with few spikes keep all of them.
+- waveforms.npy: the subsampled waveforms (in the analyzer's sparse channel layout)
+  cut with a window --waveform-cache-margin wider than requested, read with a memmap.
+  Any --ms-before/--ms-after inside that window only slices it.
+- pc_features_<key>.npy and amplitudes_<key>.npy: the all-spike PC features of the
+  Phy export and the spike amplitudes, which are reused as long as the PC model (resp.
+  the units' peak channels and peak shifts) are unchanged.
+
+Every reuse prints (and returns for the stage metrics) the time the original
+computation took and the bytes of traces it had to read.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from scheduler import format_memory_size
+from stage_cache import is_stage_cached, commit_stage, invalidate_stage
+
+COUNT_AWARE_MAX_FACTOR = 4
+# Spikes this close to the start or end of a segment are not sampled, so every cached
+# window (up to this length on each side) holds real traces instead of zero padding.
+BORDER_MARGIN_MS = 5.0
+
+def subsample_spikes(spikes, num_units, max_spikes_per_unit, policy="uniform", seed=0,
+                     segment_samples=None, margin=0):
+    """
+    Indices into the spike vector of a seeded, time-stratified subsample. Every unit's
+    spikes are split into k equal strata (in time order) and one spike is drawn per
+    stratum. k is min(count, max_spikes_per_unit) with policy 'uniform'; with
+    'count_aware' it grows with the square root of the unit's count relative to the
+    median unit, up to COUNT_AWARE_MAX_FACTOR x max_spikes_per_unit.
+    """
+    rng = np.random.default_rng(seed)
+    valid = np.ones(len(spikes), dtype=bool)
+    if segment_samples is not None and margin > 0:
+        num_samples = np.asarray(segment_samples)[spikes["segment_index"]]
+        valid = (spikes["sample_index"] >= margin) & (spikes["sample_index"] < num_samples - margin)
+    candidates = np.flatnonzero(valid)
+    # Spike vectors are sorted by time, so a stable sort keeps every unit's spikes in time order.
+    candidates = candidates[np.argsort(spikes["unit_index"][candidates], kind="stable")]
+    counts = np.bincount(spikes["unit_index"][candidates], minlength=num_units)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    targets = np.minimum(counts, max_spikes_per_unit)
+    if policy == "count_aware" and np.any(counts > 0):
+        reference = max(1.0, float(np.median(counts[counts > 0])))
+        scaled = np.ceil(max_spikes_per_unit * np.sqrt(counts / reference)).astype(np.int64)
+        targets = np.minimum(counts, np.clip(scaled, max_spikes_per_unit,
+                                             COUNT_AWARE_MAX_FACTOR * max_spikes_per_unit))
+    elif policy != "uniform":
+        raise ValueError(f"Unknown random spikes policy '{policy}' (expected 'uniform' or 'count_aware').")
+
+    selected = []
+    for unit_index in np.flatnonzero(targets):
+        count, k = counts[unit_index], targets[unit_index]
+        strata = np.floor((np.arange(k) + rng.random(k)) * (count / k)).astype(np.int64)
+        selected.append(candidates[offsets[unit_index] + np.minimum(strata, count - 1)])
+    if not selected:
+        return np.zeros(0, dtype=np.int64)
+    return np.sort(np.concatenate(selected))
+
+def _depends_on(extension_name, name):
+    from spikeinterface.core.sortinganalyzer import get_extension_class
+
+    for dependency in get_extension_class(extension_name).depend_on:
+        for parent in dependency.split("|"):
+            if parent == name or _depends_on(parent, name):
+                return True
+    return False
+
+# spikeinterface has no public way to give an extension precomputed data: compute()
+# always recomputes it from the recording. install_extension therefore fills in the
+# extension's data and run_info and saves it itself, which is only known to work with
+# these versions (requirements.txt pins 0.102.3). With any other version the cache is
+# not installed into the analyzer and the extensions are computed by spikeinterface.
+INSTALL_EXTENSION_VERSIONS = ("0.102.",)
+
+def can_install_extensions():
+    """
+    Whether install_extension supports the installed spikeinterface version.
+    """
+    import spikeinterface
+
+    return spikeinterface.__version__.startswith(INSTALL_EXTENSION_VERSIONS)
+
+def install_extension(analyzer, name, params, data, runtime_s=0.0):
+    """
+    Save precomputed data as an analyzer extension, the way analyzer.compute() would
+    after running it (extensions that depend on it are deleted, since they were computed
+    from the old data). Raises RuntimeError unless can_install_extensions().
+    """
+    import spikeinterface
+    from spikeinterface.core.sortinganalyzer import get_extension_class
+
+    if not can_install_extensions():
+        raise RuntimeError(f"Installing cached analyzer extensions is not supported with spikeinterface "
+                           f"{spikeinterface.__version__}.")
+    existing = set(analyzer.get_loaded_extension_names())
+    if analyzer.format != "memory":
+        existing |= set(analyzer.get_saved_extension_names())
+    for other in sorted(existing):
+        if _depends_on(other, name):
+            analyzer.delete_extension(other)
+    # Extension internals, see INSTALL_EXTENSION_VERSIONS.
+    extension = get_extension_class(name)(analyzer)
+    extension.set_params(save=True, **params)
+    extension.data = dict(data)
+    extension.run_info["runtime_s"] = runtime_s
+    extension.run_info["run_completed"] = True
+    extension.save()
+    analyzer.extensions[name] = extension
+    return extension
+
+def waveform_dtype(analyzer):
+    """
+    dtype of the analyzer's waveforms: the recording's, or float32 for scaled integer traces.
+    """
+    dtype = np.dtype(analyzer.recording.get_dtype())
+    if np.issubdtype(dtype, np.integer) and analyzer.return_scaled:
+        dtype = np.dtype("float32")
+    return dtype.str
+
+def average_templates(analyzer, waveforms, some_spikes, block_size=4096):
+    """
+    Dense average templates (units x samples x channels) of sparse subsampled
+    waveforms, as the analyzer's templates extension computes them. The waveforms are
+    summed per unit in blocks of spikes (in the order they are stored, so the memmap is
+    read sequentially) and then scattered to each unit's channels in one step.
+    """
+    num_units = len(analyzer.unit_ids)
+    num_channels = len(analyzer.channel_ids)
+    unit_indices = some_spikes["unit_index"]
+    sums = np.zeros((num_units,) + waveforms.shape[1:])
+    for start in range(0, len(unit_indices), block_size):
+        np.add.at(sums, unit_indices[start:start + block_size], waveforms[start:start + block_size])
+    counts = np.bincount(unit_indices, minlength=num_units)
+    means = sums / np.maximum(counts, 1)[:, np.newaxis, np.newaxis]
+    if analyzer.sparsity is None:
+        return means
+
+    # Padded sparse channels go to an extra column that is dropped afterwards.
+    channel_indices = np.full((num_units, waveforms.shape[2]), num_channels)
+    for unit_index, unit_id in enumerate(analyzer.unit_ids):
+        unit_channels = analyzer.sparsity.unit_id_to_channel_indices[unit_id]
+        channel_indices[unit_index, :len(unit_channels)] = unit_channels
+    templates = np.zeros((num_units, waveforms.shape[1], num_channels + 1))
+    templates[np.arange(num_units)[:, np.newaxis], :, channel_indices] = means.transpose(0, 2, 1)
+    return templates[:, :, :num_channels]
+
+def write_pc_feature_ind(path, analyzer):
+    """
+    Phy's pc_feature_ind.npy (the channels of every unit's PC features), as written by
+    export_to_phy.
+    """
+    channel_indices = analyzer.sparsity.unit_id_to_channel_indices
+    pc_feature_ind = -np.ones((len(analyzer.unit_ids), max(len(c) for c in channel_indices.values())),
+                              dtype="int64")
+    for unit_index, unit_id in enumerate(analyzer.unit_ids):
+        pc_feature_ind[unit_index, :len(channel_indices[unit_id])] = channel_indices[unit_id]
+    np.save(str(path), pc_feature_ind)
+
+def _link_or_copy(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def _digest(params):
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+class WaveformCache:
+    """
+    Cached spike subsample, waveforms, PC features and amplitudes of one sorting.
+    The folder is reset when key (the analyzer stage key) changes; meta.json lists the
+    finished entries.
+    """
+    def __init__(self, folder, key, recording):
+        self.folder = Path(folder)
+        self.recording = recording
+        # Every reused entry saves a pass over the preprocessed traces.
+        self.trace_bytes = recording.get_total_memory_size()
+        if not is_stage_cached(self.folder, "waveform_cache", key):
+            invalidate_stage(self.folder)
+            os.makedirs(self.folder, exist_ok=True)
+            commit_stage(self.folder, "waveform_cache", key)
+        self.meta = {}
+        if (self.folder / "meta.json").exists():
+            with open(self.folder / "meta.json", "r") as f:
+                self.meta = json.load(f)
+
+    def _save_meta(self):
+        tmp_path = self.folder / f"meta.json.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp_path, self.folder / "meta.json")
+
+    def _reused(self, what, entry):
+        saved = {"seconds": entry["seconds"], "bytes": entry["bytes"]}
+        print(f"Reused cached {what}: saved ~{entry['seconds']:.1f} s and "
+              f"{format_memory_size(entry['bytes'])}B of trace reads.")
+        return saved
+
+    def random_spikes(self, sorting, max_spikes_per_unit, policy="uniform", seed=0):
+        """
+        Subsample indices into sorting.to_spike_vector(), computed once per parameters.
+        """
+        params = {"max_spikes_per_unit": max_spikes_per_unit, "policy": policy, "seed": seed}
+        entry = self.meta.get("random_spikes")
+        if entry is not None and entry["params"] == params:
+            return np.load(self.folder / "random_spikes.npy")
+        segment_samples = [self.recording.get_num_samples(segment_index)
+                           for segment_index in range(self.recording.get_num_segments())]
+        indices = subsample_spikes(sorting.to_spike_vector(), len(sorting.unit_ids), max_spikes_per_unit,
+                                   policy=policy, seed=seed, segment_samples=segment_samples,
+                                   margin=int(BORDER_MARGIN_MS * self.recording.sampling_frequency / 1000.0))
+        # Everything else in the cache was computed from the previous subsample.
+        for entry in self.meta.values():
+            if "path" in entry:
+                (self.folder / entry["path"]).unlink(missing_ok=True)
+        (self.folder / "waveforms.npy").unlink(missing_ok=True)
+        self.meta = {}
+        np.save(self.folder / "random_spikes.npy", indices)
+        self.meta["random_spikes"] = {"params": params, "num_spikes": int(len(indices))}
+        self._save_meta()
+        return indices
+
+    def waveforms(self, analyzer, some_spikes, ms_before, ms_after, margin_ms, dtype, job_kwargs):
+        """
+        Waveforms of some_spikes cut from ms_before to ms_after, sliced from the cached
+        waveforms when their window covers it and extracted (with margin_ms more on both
+        sides) otherwise. Returns (waveforms, reuse report or None).
+        """
+        from spikeinterface.core.waveform_tools import extract_waveforms_to_single_buffer
+
+        sampling_frequency = self.recording.sampling_frequency
+        nbefore = int(ms_before * sampling_frequency / 1000.0)
+        nafter = int(ms_after * sampling_frequency / 1000.0)
+        entry = self.meta.get("waveforms")
+        saved = None
+        if (entry is not None and entry["dtype"] == dtype
+                and entry["nbefore"] >= nbefore and entry["nafter"] >= nafter):
+            saved = self._reused(f"waveforms ({entry['ms_before']:g}-{entry['ms_after']:g} ms window)", entry)
+        else:
+            entry = {
+                "ms_before": ms_before + margin_ms,
+                "ms_after": ms_after + margin_ms,
+                "nbefore": int((ms_before + margin_ms) * sampling_frequency / 1000.0),
+                "nafter": int((ms_after + margin_ms) * sampling_frequency / 1000.0),
+                "dtype": dtype,
+            }
+            print(f"Extracting {len(some_spikes)} waveforms into the waveform cache "
+                  f"({entry['ms_before']:g} ms before, {entry['ms_after']:g} ms after)...")
+            t_start = time.perf_counter()
+            tmp_path = self.folder / "waveforms.tmp.npy"
+            extract_waveforms_to_single_buffer(
+                self.recording, some_spikes, analyzer.unit_ids, entry["nbefore"], entry["nafter"],
+                mode="memmap", return_scaled=analyzer.return_scaled, file_path=tmp_path, dtype=dtype,
+                sparsity_mask=None if analyzer.sparsity is None else analyzer.sparsity.mask,
+                copy=False, job_name="waveform_cache", **job_kwargs)
+            os.replace(tmp_path, self.folder / "waveforms.npy")
+            entry["seconds"] = time.perf_counter() - t_start
+            entry["bytes"] = self.trace_bytes
+            self.meta["waveforms"] = entry
+            self._save_meta()
+        cached = np.load(self.folder / "waveforms.npy", mmap_mode="r")
+        start = entry["nbefore"] - nbefore
+        return cached[:, start:start + nbefore + nafter, :], saved
+
+    def find_array(self, name, params):
+        """
+        (path, reuse report) of the cached array name for params, or (path, None) if it is
+        missing; path is where store_array expects it.
+        """
+        digest = _digest(params)
+        path = self.folder / f"{name}_{digest}.npy"
+        entry = self.meta.get(name)
+        if entry is not None and entry["digest"] == digest and path.exists():
+            return path, self._reused(name.replace("_", " "), entry)
+        return path, None
+
+    def store_array(self, name, path, seconds):
+        """
+        Record the array just written to path (from find_array) as the cached array
+        name, replacing the previous one.
+        """
+        entry = self.meta.get(name)
+        if entry is not None and entry["path"] != path.name:
+            (self.folder / entry["path"]).unlink(missing_ok=True)
+        self.meta[name] = {"digest": path.stem[len(name) + 1:], "path": path.name,
+                           "seconds": seconds, "bytes": self.trace_bytes}
+        self._save_meta()
+
+    def pc_features(self, analyzer, pc_key, phy_folder, job_kwargs):
+        """
+        Write Phy's pc_features.npy and pc_feature_ind.npy, linking the cached all-spike
+        PC features of the same PC model instead of projecting all spikes again.
+        Returns the reuse report or None.
+        """
+        path, saved = self.find_array("pc_features", {"principal_components": pc_key})
+        if saved is None:
+            print("Projecting all spikes on the principal components...")
+            t_start = time.perf_counter()
+            tmp_path = self.folder / "pc_features.tmp.npy"
+            analyzer.get_extension("principal_components").run_for_all_spikes(tmp_path, **job_kwargs)
+            os.replace(tmp_path, path)
+            self.store_array("pc_features", path, time.perf_counter() - t_start)
+        _link_or_copy(path, Path(phy_folder) / "pc_features.npy")
+        write_pc_feature_ind(Path(phy_folder) / "pc_feature_ind.npy", analyzer)
+        return saved
+
+    def spike_amplitudes(self, analyzer, peak_sign, job_kwargs):
+        """
+        Compute the spike_amplitudes extension, or install the cached amplitudes when
+        every unit's extremum channel and peak shift are unchanged (spike amplitudes do
+        not depend on the waveform window otherwise). Returns the reuse report or None.
+        """
+        from spikeinterface.core.template_tools import (get_template_extremum_channel,
+                                                        get_template_extremum_channel_peak_shift)
+
+        channels = get_template_extremum_channel(analyzer, peak_sign=peak_sign, outputs="index")
+        shifts = get_template_extremum_channel_peak_shift(analyzer, peak_sign=peak_sign)
+        path, saved = self.find_array("amplitudes", {
+            "peak_sign": peak_sign,
+            "channels": [int(channels[unit_id]) for unit_id in analyzer.unit_ids],
+            "shifts": [int(shifts[unit_id]) for unit_id in analyzer.unit_ids],
+        })
+        if saved is not None and can_install_extensions():
+            install_extension(analyzer, "spike_amplitudes", {"peak_sign": peak_sign},
+                              {"amplitudes": np.load(path)})
+            return saved
+        t_start = time.perf_counter()
+        extension = analyzer.compute("spike_amplitudes", peak_sign=peak_sign, **job_kwargs)
+        np.save(path, extension.data["amplitudes"])
+        self.store_array("amplitudes", path, time.perf_counter() - t_start)
+        return None
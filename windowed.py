@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Windowed sorting of long recordings for app.py (--window-duration).
+
+Kilosort4's memory (and GPU memory) grows with the number of spikes, so a 12-24 hour
+session needs far more than a one hour one. In windowed mode the preprocessed
+recording is sorted in overlapping time windows of a fixed length, one after another,
+and the window sortings are stitched back into one continuous sorting:
+
+- Units of consecutive windows are matched on the spikes they share in the overlap
+  (the same agreement score as sweep.py); a matched unit keeps its identity across the
+  whole session, unmatched units become new units.
+- Every window contributes the spikes of its core, i.e. up to the middle of the
+  overlaps with its neighbours, so no spike is counted twice.
+
+All windows are whitened with one whitening matrix, estimated once from random chunks
+spread over the whole session and cached next to the outputs, so that the traces (and
+the templates) of all windows are comparable. Windows are read lazily from the saved
+preprocessed binary, each window's sorting is cached so an interrupted run resumes
+with the next window, and the sorter's own working folder is removed after every
+window, so peak memory and scratch disk depend on the window length, not on the
+length of the session.
+"""
+import os
+import shutil
+
+import numpy as np
+
+from stage_cache import stage_key, read_marker, is_stage_cached, commit_stage, invalidate_stage
+
+WHITENING_CHUNKS = 100
+
+def cached_whitening(recording, cache_path, name="all", num_chunks=WHITENING_CHUNKS, seed=0):
+    """
+    Whitening matrix of a filtered recording, estimated from num_chunks random 1 s
+    chunks and stored as W_<name> in the cache_path .npz, so it is computed once per
+    recording (and channel group) and reused on every rerun.
+    """
+    from spikeinterface.preprocessing.whiten import compute_whitening_matrix
+
+    cached = {}
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            cached = dict(data)
+    if f"W_{name}" in cached:
+        return cached[f"W_{name}"]
+    chunk_size = int(min(recording.sampling_frequency, recording.get_num_samples(0) // num_chunks or 1))
+    W, _ = compute_whitening_matrix(recording, mode="global", apply_mean=False,
+                                    random_chunk_kwargs=dict(num_chunks_per_segment=num_chunks,
+                                                             chunk_size=chunk_size, seed=seed))
+    cached[f"W_{name}"] = W
+    tmp_path = f"{cache_path}.tmp{os.getpid()}.npz"
+    np.savez(tmp_path, **cached)
+    os.replace(tmp_path, cache_path)
+    return W
+
+def window_bounds(num_samples, window_samples, overlap_samples):
+    """
+    (start, end, core_start, core_end) of every window. Windows are window_samples long
+    and overlap by overlap_samples; cores split every overlap in the middle and together
+    cover [0, num_samples) exactly once.
+    """
+    if window_samples <= overlap_samples:
+        raise ValueError(f"Windows of {window_samples} samples must be longer than their overlap "
+                         f"({overlap_samples} samples).")
+    step = window_samples - overlap_samples
+    starts = list(range(0, max(1, num_samples - overlap_samples), step))
+    bounds = []
+    for i, start in enumerate(starts):
+        end = min(num_samples, start + window_samples)
+        core_start = 0 if i == 0 else (start + bounds[-1][1]) // 2
+        bounds.append([start, end, core_start, num_samples])
+        if i > 0:
+            bounds[-2][3] = core_start
+        if end == num_samples:
+            break
+    return [tuple(bound) for bound in bounds]
+
+def _overlap_sorting(spikes, units, lo, hi, sampling_frequency):
+    from spikeinterface.core import NumpySorting
+    mask = (spikes >= lo) & (spikes < hi)
+    return NumpySorting.from_samples_and_labels([spikes[mask] - lo], [units[mask]], sampling_frequency)
+
+def stitch_windows(window_spikes, bounds, sampling_frequency, delta_ms=0.4, match_score=0.5):
+    """
+    Stitch window sortings into one. window_spikes holds (global sample indices, unit ids)
+    per window. Returns (samples, global unit labels, number of matched units).
+    """
+    from spikeinterface.comparison import compare_two_sorters
+
+    labels_by_window = []
+    next_label = 0
+    matched = 0
+    for i, (samples, units) in enumerate(window_spikes):
+        unit_ids = np.unique(units)
+        mapping = {}
+        if i > 0 and len(unit_ids) and len(labels_by_window[-1]):
+            previous_samples, previous_units = window_spikes[i - 1]
+            lo, hi = bounds[i][0], bounds[i - 1][1]
+            comparison = compare_two_sorters(
+                _overlap_sorting(previous_samples, previous_units, lo, hi, sampling_frequency),
+                _overlap_sorting(samples, units, lo, hi, sampling_frequency),
+                delta_time=delta_ms, match_score=match_score)
+            for previous_unit, unit in comparison.hungarian_match_12.items():
+                if unit != -1:
+                    mapping[unit] = labels_by_window[-1][previous_unit]
+                    matched += 1
+        for unit in unit_ids:
+            if unit not in mapping:
+                mapping[unit] = next_label
+                next_label += 1
+        labels_by_window.append(mapping)
+
+    all_samples, all_labels = [], []
+    for (samples, units), (_, _, core_start, core_end), mapping in zip(window_spikes, bounds, labels_by_window):
+        core = (samples >= core_start) & (samples < core_end)
+        core_units, inverse = np.unique(units[core], return_inverse=True)
+        all_samples.append(samples[core])
+        all_labels.append(np.array([mapping[unit] for unit in core_units], dtype=np.int64)[inverse])
+    samples = np.concatenate(all_samples) if all_samples else np.zeros(0, np.int64)
+    labels = np.concatenate(all_labels) if all_labels else np.zeros(0, np.int64)
+    order = np.argsort(samples, kind="stable")
+    return samples[order], labels[order], matched
+
+def run_windowed_sorter(recording, windows_dir, windows_key, sort_params, window_duration, window_overlap,
+                        match_score=0.5):
+    """
+    Sort recording in overlapping windows with Kilosort4 and stitch the results.
+    Every window sorting is cached in windows_dir/w<index> under windows_key, so changing
+    only match_score re-stitches the cached windows. Once all windows are sorted,
+    windows_dir gets its own stage marker, so the window sortings count towards (and can
+    be evicted by) --cache-size-cap. Returns (sorting, report).
+    """
+    import spikeinterface as si
+    import spikeinterface.sorters as ss
+    from spikeinterface.core import NumpySorting
+
+    sampling_frequency = recording.sampling_frequency
+    num_samples = recording.get_num_samples(0)
+    bounds = window_bounds(num_samples, int(window_duration * sampling_frequency),
+                           int(window_overlap * sampling_frequency))
+    # Windows are read lazily from the saved binary instead of being copied for the sorter.
+    sort_params = dict({"use_binary_file": False}, **sort_params)
+
+    marker = read_marker(windows_dir, "sorting_windows")
+    if marker is not None and marker.get("key") != windows_key:
+        invalidate_stage(windows_dir)
+    window_spikes = []
+    for i, (start, end, _, _) in enumerate(bounds):
+        window_dir = windows_dir / f"w{i:03d}"
+        key = stage_key("sorting_window", {"start": start, "end": end}, [windows_key])
+        if is_stage_cached(window_dir, "sorting_window", key):
+            print(f"Reusing cached sorting of window {i + 1}/{len(bounds)}.")
+            window_sorting = si.load_extractor(window_dir / "sorting")
+        else:
+            invalidate_stage(window_dir)
+            print(f"Sorting window {i + 1}/{len(bounds)} ({start / sampling_frequency:.0f}-"
+                  f"{end / sampling_frequency:.0f} s)...")
+            sorted_window = ss.run_sorter("kilosort4", recording=recording.frame_slice(start, end),
+                                          folder=str(window_dir / "run"), **sort_params)
+            window_sorting = sorted_window.save(folder=str(window_dir / "sorting"), overwrite=True)
+            # Only the spikes are needed; the sorter's working files grow with the window.
+            shutil.rmtree(window_dir / "run", ignore_errors=True)
+            commit_stage(window_dir, "sorting_window", key)
+        spikes = window_sorting.to_spike_vector()
+        window_spikes.append((spikes["sample_index"].astype(np.int64) + start,
+                              np.asarray(window_sorting.unit_ids)[spikes["unit_index"]]))
+
+    commit_stage(windows_dir, "sorting_windows", windows_key)
+
+    samples, labels, matched = stitch_windows(window_spikes, bounds, sampling_frequency, match_score=match_score)
+    sorting = NumpySorting.from_samples_and_labels([samples], [labels], sampling_frequency)
+    report = {"windows": len(bounds), "units": len(sorting.unit_ids), "matched_across_windows": matched}
+    print(f"Stitched {len(bounds)} windows into {report['units']} units ({matched} unit matches across windows).")
+    return sorting, report
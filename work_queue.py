@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+File-backed work queue shared by several app.py workers (containers or nodes).
+
+Every worker scans the same data folder and tries to claim a recording before it
+processes it. A claim is a lease file in the queue folder on the shared output volume,
+created with O_CREAT | O_EXCL so exactly one worker wins. The worker that holds a lease
+keeps touching it (heartbeat) while the recording is processed and removes it when the
+recording is finished or has failed. A worker that dies stops heartbeating; once its
+lease is older than lease_seconds any other worker may take the recording over.
+
+Lease ages are measured against the file system's clock (the mtime of a freshly touched
+file), not the local clock, so workers on nodes with skewed clocks agree on expiry.
+No broker or database server is needed, only a shared folder with atomic create and
+rename, which local disks, NFS v3+ and SMB provide.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+
+LEASE_SUFFIX = ".lease"
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class WorkQueue:
+    """
+    Leases on recordings, stored as <folder>/<task id>.lease files. Task ids are derived
+    from the recording path relative to data_folder, so workers that mount the data
+    folder at different paths still agree on them.
+    """
+    def __init__(self, folder, data_folder, worker_id=None, lease_seconds=600.0):
+        self.folder = str(folder)
+        self.data_folder = os.path.abspath(data_folder)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        os.makedirs(self.folder, exist_ok=True)
+
+    def task_id(self, rec_path):
+        rel_path = os.path.relpath(os.path.abspath(rec_path), self.data_folder)
+        return hashlib.sha256(rel_path.replace(os.sep, "/").encode()).hexdigest()[:24]
+
+    def _lease_path(self, rec_path):
+        return os.path.join(self.folder, self.task_id(rec_path) + LEASE_SUFFIX)
+
+    def _fs_now(self):
+        clock_path = os.path.join(self.folder, f".clock-{self.worker_id}-{os.getpid()}")
+        with open(clock_path, "w"):
+            pass
+        now = os.stat(clock_path).st_mtime
+        os.remove(clock_path)
+        return now
+
+    def _read_lease(self, lease_path):
+        try:
+            with open(lease_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def claim(self, rec_path):
+        """
+        Try to take the lease on a recording. Returns True if this worker now holds it.
+        An expired lease (its holder stopped heartbeating) is taken over.
+        """
+        lease_path = self._lease_path(rec_path)
+        info = {"worker": self.worker_id, "recording": os.path.relpath(os.path.abspath(rec_path), self.data_folder),
+                "host": socket.gethostname(), "pid": os.getpid(), "claimed": time.time()}
+        for _ in range(2):
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            except FileExistsError:
+                if not self._expire(lease_path):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump(info, f)
+            return True
+        return False
+
+    def _expire(self, lease_path):
+        """
+        Remove lease_path if it has not been heartbeated for lease_seconds.
+        Returns True if the lease is gone (expired or released meanwhile).
+        """
+        try:
+            stat = os.stat(lease_path)
+        except FileNotFoundError:
+            return True
+        age = self._fs_now() - stat.st_mtime
+        if age < self.lease_seconds:
+            return False
+        # Check again right before the rename, so a lease that was re-claimed or
+        # heartbeated meanwhile is not taken over.
+        try:
+            current = os.stat(lease_path)
+        except FileNotFoundError:
+            return True
+        if current.st_ino != stat.st_ino or current.st_mtime != stat.st_mtime:
+            return False
+        # Only one worker can rename the expired lease away; the others get FileNotFoundError.
+        stale_path = f"{lease_path}.expired-{self.worker_id}"
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return False
+        try:
+            renamed = os.stat(stale_path)
+            fresh = renamed.st_ino != stat.st_ino or self._fs_now() - renamed.st_mtime < self.lease_seconds
+        except OSError:
+            fresh = False
+        if fresh:
+            # Another worker re-claimed it between our check and the rename: put it back.
+            try:
+                os.link(stale_path, lease_path)
+            except OSError:
+                # A third worker claimed the path meanwhile; the lease is lost for its owner
+                # and cannot be restored, so leave both files as they are.
+                print(f"[queue] Could not restore the lease {os.path.basename(lease_path)} taken over by mistake; "
+                      f"it is kept as {os.path.basename(stale_path)}.")
+                return False
+            os.remove(stale_path)
+            return False
+        stale = self._read_lease(stale_path) or {}
+        os.remove(stale_path)
+        print(f"[queue] Lease on {stale.get('recording', os.path.basename(lease_path))} held by "
+              f"{stale.get('worker', 'unknown worker')} expired after {age:.0f} s; re-queued.")
+        return True
+
+    def owns(self, rec_path):
+        info = self._read_lease(self._lease_path(rec_path))
+        return info is not None and info.get("worker") == self.worker_id
+
+    def release(self, rec_path):
+        """
+        Give up this worker's lease on a recording (no-op if it does not hold it).
+        """
+        if not self.owns(rec_path):
+            return
+        # Another worker may expire and re-claim the lease after the check above, so move
+        # it out of the way first and only delete it if it is still ours (as in _expire).
+        lease_path = self._lease_path(rec_path)
+        released_path = f"{lease_path}.released-{self.worker_id}"
+        try:
+            os.rename(lease_path, released_path)
+        except FileNotFoundError:
+            return
+        info = self._read_lease(released_path)
+        if info is not None and info.get("worker") == self.worker_id:
+            os.remove(released_path)
+            return
+        try:
+            os.link(released_path, lease_path)
+        except OSError:
+            print(f"[queue] Could not restore the lease {os.path.basename(lease_path)} released by mistake; "
+                  f"it is kept as {os.path.basename(released_path)}.")
+            return
+        os.remove(released_path)
+
+    def heartbeat(self):
+        """
+        Renew every lease held by this worker. Returns the number of leases renewed.
+        """
+        renewed = 0
+        for name in os.listdir(self.folder):
+            if not name.endswith(LEASE_SUFFIX):
+                continue
+            lease_path = os.path.join(self.folder, name)
+            info = self._read_lease(lease_path)
+            if info is not None and info.get("worker") == self.worker_id:
+                try:
+                    os.utime(lease_path)
+                    renewed += 1
+                except FileNotFoundError:
+                    pass
+        return renewed
+
+    def active_leases(self):
+        """
+        Lease records of all workers, with their age in seconds.
+        """
+        now = self._fs_now()
+        leases = []
+        for name in sorted(os.listdir(self.folder)):
+            if name.endswith(LEASE_SUFFIX):
+                lease_path = os.path.join(self.folder, name)
+                info = self._read_lease(lease_path)
+                try:
+                    age = now - os.stat(lease_path).st_mtime
+                except FileNotFoundError:
+                    continue
+                if info is not None:
+                    leases.append(dict(info, age=round(age, 1), expired=age >= self.lease_seconds))
+        return leases
+
+class LeaseKeeper:
+    """
+    Background thread that heartbeats a worker's leases every lease_seconds / 4, for as
+    long as the worker's main process is alive; use as a context manager.
+    """
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.work_queue.lease_seconds / 4):
+            try:
+                self.work_queue.heartbeat()
+            except OSError as e:
+                print(f"[queue] Heartbeat failed: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False